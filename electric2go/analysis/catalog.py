@@ -0,0 +1,173 @@
+# coding=utf-8
+
+"""
+Catalog of normalized result_dict files by system, city and time range.
+
+Only each file's metadata is read, see cmdline.read_metadata, so that
+files can be put in order and checked for gaps and overlaps before
+any of them is loaded in full. A directory's catalog is cached
+next to it, like the manifests in normalize.get_directory_manifest,
+and only files that were added or changed since are read again.
+"""
+
+import os
+
+from . import cmdline, merge, normalize
+from .jsonbackend import json
+
+
+# files normalize.py writes, in JSON or columnar format
+RESULT_FILE_EXTENSIONS = ('.json', '.npz')
+
+# metadata keys kept in catalog entries
+CATALOG_KEYS = ('system', 'city', 'starting_time', 'ending_time', 'time_step', 'missing')
+
+
+def get_catalog_file_name(directory):
+    # the manifest directory is not in `directory`, so it isn't catalogued itself
+    return os.path.join(normalize.get_manifest_dir_name(directory), 'catalog.json')
+
+
+def get_entry(filename, metadata):
+    entry = {key: metadata[key] for key in CATALOG_KEYS}
+    entry['filename'] = filename
+    return entry
+
+
+def catalog_file(filename):
+    """
+    :return: catalog entry, a dict of the file's system, city,
+    starting_time, ending_time, time_step, missing, and filename
+    """
+
+    return get_entry(filename, cmdline.read_metadata(filename))
+
+
+def _read_cache(filename):
+    try:
+        with open(filename, 'r') as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        # doesn't exist or is malformed
+        return {}
+
+    for file_info in cache.values():
+        if file_info['metadata']:
+            cmdline.decode_metadata(file_info['metadata'])
+
+    return cache
+
+
+def _write_cache(filename, cache):
+    try:
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            cmdline.write_json(cache, f)
+        os.rename(temp_filename, filename)
+    except (IOError, OSError):
+        pass
+
+
+def catalog_directory(directory):
+    """
+    Catalogs result_dict files in a directory. Files that can't be read
+    as result_dicts are left out.
+    :return: list of catalog entries, see catalog_file, in no particular order
+    """
+
+    cache_filename = get_catalog_file_name(directory)
+    known_files = _read_cache(cache_filename)
+
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(RESULT_FILE_EXTENSIONS):
+            continue
+
+        filename = os.path.join(directory, name)
+        if not os.path.isfile(filename):
+            continue
+
+        file_stat = os.stat(filename)
+        file_info = known_files.get(name)
+        if (file_info is None
+                or file_info['size'] != file_stat.st_size
+                or file_info['mtime'] != file_stat.st_mtime):
+            try:
+                metadata = cmdline.read_metadata(filename)
+                metadata = {key: metadata[key] for key in CATALOG_KEYS}
+            except (ValueError, KeyError, TypeError):
+                # not a result_dict, remember that so it's not read again
+                metadata = None
+
+            file_info = {
+                'size': file_stat.st_size,
+                'mtime': file_stat.st_mtime,
+                'metadata': metadata
+            }
+
+        files[name] = file_info
+
+    if files != known_files:
+        _write_cache(cache_filename, files)
+
+    return [get_entry(os.path.join(directory, name), file_info['metadata'])
+            for name, file_info in files.items()
+            if file_info['metadata']]
+
+
+def catalog_paths(paths):
+    """
+    :param paths: list of result_dict files or directories of them
+    :return: list of catalog entries, see catalog_file
+    """
+
+    entries = []
+    for path in paths:
+        if os.path.isdir(path):
+            entries.extend(catalog_directory(path))
+        else:
+            entries.append(catalog_file(path))
+
+    return entries
+
+
+def sort_entries(entries):
+    return sorted(entries, key=lambda entry: (entry['system'], entry['city'],
+                                              entry['starting_time'], entry['ending_time'],
+                                              entry['filename']))
+
+
+def select_time_range(entries, starting_time=None, ending_time=None):
+    """
+    :return: entries whose time range overlaps with the one given,
+    either end of which can be None for no limit
+    """
+
+    return [entry for entry in entries
+            if (starting_time is None or entry['ending_time'] >= starting_time)
+            and (ending_time is None or entry['starting_time'] <= ending_time)]
+
+
+def find_problems(entries):
+    """
+    Checks whether files can be merged in the order given,
+    with the same rule as merge.merge_two_dicts.
+    :param entries: catalog entries of the same system and city,
+    sorted by sort_entries
+    :return: list of tuple(problem, entry, next_entry), with problem
+    being 'gap' if there are data points missing between the two files
+    and 'overlap' if some data points are in both
+    """
+
+    problems = []
+    for entry, next_entry in zip(entries, entries[1:]):
+        expected_starting_time = merge.get_next_starting_time(entry)
+        if next_entry['starting_time'] > expected_starting_time:
+            problems.append(('gap', entry, next_entry))
+        elif next_entry['starting_time'] < expected_starting_time:
+            problems.append(('overlap', entry, next_entry))
+
+    return problems
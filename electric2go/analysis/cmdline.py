@@ -1,23 +1,33 @@
 # coding=utf-8
 
+import re
 import sys
+from collections import OrderedDict
 from datetime import datetime
 
-# This file will particularly be used with larger JSON files/objects
-# so try to get better-performing module first.
-# simplejson is usually slightly faster than json running my tests,
-# (simplejson=3.8.0, py2.7.8 & py3.4.2)
-# so load it if present. If not available, json is fine.
 try:
-    import simplejson as json
+    from collections.abc import Mapping
 except ImportError:
-    import json
+    # Python 2
+    from collections import Mapping
+
+# This file will particularly be used with larger JSON files/objects
+# so use the better-performing JSON module available, see jsonbackend.
+from . import jsonbackend, profiling, ranges, records
+from .jsonbackend import json  # will be either simplejson or json
 
 
 def json_serializer(obj):
     # default doesn't serialize dates... tell it to use isoformat()
     # syntax from http://blog.codevariety.com/2012/01/06/python-serializing-dates-datetime-datetime-into-json/
-    return obj.isoformat() if hasattr(obj, 'isoformat') else obj
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+
+    # dict-like objects that aren't dicts, like dataset.Dataset
+    if isinstance(obj, Mapping):
+        return dict(obj)
+
+    return obj
 
 
 def _strptime(t):
@@ -33,8 +43,7 @@ def json_deserializer(obj):
         # and 'changing_data' keys.
         # List items don't get passed into object_hook so we need to catch it separately. Sucks.
         if key == 'missing':
-            datetimes_as_string_list = obj[key]
-            obj[key] = [_strptime(t) for t in datetimes_as_string_list]
+            obj[key] = _decode_missing(obj[key], obj.get('time_step'), _strptime)
         elif key == 'changing_data':
             changing_data = obj[key]
             obj[key] = [(_strptime(item[0]), item[1]) for item in changing_data]
@@ -48,9 +57,209 @@ def json_deserializer(obj):
     return obj
 
 
-def write_json(data, fp=sys.stdout, indent=0):
-    json.dump(data, fp=fp, default=json_serializer, indent=indent)
+def parse_time(value):
+    """
+    Parses a datetime string written by json_serializer. Much faster than
+    strptime, which matters when reading millions of them.
+    :return: datetime, or value unchanged if it's not such a string
+    """
+
+    try:
+        # isoformat() output: YYYY-mm-DDTHH:MM:SS, with .ffffff if
+        # microseconds are not 0, as is the case for processing_started
+        if len(value) == 19 and value[10] == 'T':
+            return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                            int(value[11:13]), int(value[14:16]), int(value[17:19]))
+        elif len(value) == 26 and value[10] == 'T' and value[19] == '.':
+            return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                            int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                            int(value[20:26]))
+    except (TypeError, ValueError):
+        pass
+
+    return value
+
+
+def _decode_missing(missing, time_step, parse):
+    # Files written before missing data points were stored as ranges
+    # list each missing data point separately
+    if missing and not isinstance(missing[0], list):
+        return ranges.from_times([parse(t) for t in missing], time_step)
+
+    return [[parse(start), parse(end)] for start, end in missing]
+
+
+def _decode_parking(parking):
+    for key in ('starting_time', 'ending_time'):
+        if key in parking:
+            parking[key] = parse_time(parking[key])
+
+    if 'changing_data' in parking:
+        parking['changing_data'] = [(parse_time(item[0]), item[1])
+                                    for item in parking['changing_data']]
+
+    return records.make_parking(parking)
+
+
+def _decode_trip(trip):
+    for key in ('start', 'end'):
+        if isinstance(trip.get(key), dict) and 'time' in trip[key]:
+            trip[key]['time'] = parse_time(trip[key]['time'])
+
+    return records.make_trip(trip)
+
+
+def decode_metadata(metadata):
+    """
+    Parses datetimes in a result_dict's metadata loaded from JSON.
+    """
+
+    for key in ('starting_time', 'ending_time', 'processing_started'):
+        if key in metadata:
+            metadata[key] = parse_time(metadata[key])
+    if 'missing' in metadata:
+        metadata['missing'] = _decode_missing(metadata['missing'], metadata.get('time_step'), parse_time)
+
+    return metadata
+
+
+def decode_result_dict(obj):
+    """
+    Parses datetimes in a result_dict loaded from JSON.
+
+    Only the keys known to contain datetimes are looked at, which is much
+    faster than trying to parse every value like json_deserializer does.
+    Falls back to json_deserializer if obj doesn't look like a result_dict.
+
+    Trips and parkings are made into records, see records.py.
+    """
+
+    if not isinstance(obj, dict) or not isinstance(obj.get('metadata'), dict):
+        return jsonbackend.apply_object_hook(obj, json_deserializer)
+
+    decode_metadata(obj['metadata'])
+
+    for vin_parkings in obj.get('finished_parkings', {}).values():
+        vin_parkings[:] = [_decode_parking(parking) for parking in vin_parkings]
+
+    parkings = obj.get('unfinished_parkings', {})
+    for vin in parkings:
+        parkings[vin] = _decode_parking(parkings[vin])
+
+    for vin_trips in obj.get('finished_trips', {}).values():
+        vin_trips[:] = [_decode_trip(trip) for trip in vin_trips]
+
+    for key in ('unfinished_trips', 'unstarted_trips'):
+        trips = obj.get(key, {})
+        for vin in trips:
+            trips[vin] = _decode_trip(trips[vin])
+
+    return obj
+
+
+def metadata_first(data):
+    """
+    :return: result_dict with the same items, but with 'metadata' first,
+    so that it is at the start of the JSON written, see read_metadata.
+    Anything else is returned unchanged.
+    """
+
+    if not isinstance(data, Mapping) or 'metadata' not in data:
+        return data
+
+    # plain dicts only keep insertion order from Python 3.7
+    ordered = OrderedDict([('metadata', data['metadata'])])
+    for key in data:
+        if key != 'metadata':
+            ordered[key] = data[key]
+
+    return ordered
+
+
+def write_json(data, fp=sys.stdout, indent=0, profiler=profiling.NULL_PROFILER):
+    """
+    :param profiler: profiling.Profiler to record the time taken in, as stage 'write'
+    """
+
+    with profiler.stage('write'):
+        jsonbackend.dump(metadata_first(data), fp=fp, default=json_serializer, indent=indent)
 
 
 def read_json(fp=sys.stdin):
-    return json.load(fp=fp, object_hook=json_deserializer)
+    """
+    Reads a result_dict. Besides JSON, also accepts the columnar format
+    written by normalize.py --format npz.
+    """
+
+    # read raw bytes if possible, most backends are faster parsing those.
+    # Keep a reference to fp: if it was the only one, the buffer
+    # would be closed along with fp when fp is garbage collected.
+    binary_fp = getattr(fp, 'buffer', fp)
+    data = binary_fp.read()
+
+    # columnar files are zip files, JSON can't start with these bytes
+    if data[:4] == b'PK\x03\x04':
+        # import here so that numpy is only needed if it's actually used
+        from . import columnar
+        return columnar.read_npz(data)
+
+    return decode_result_dict(jsonbackend.loads(data))
+
+
+# how much of a file read_metadata reads at a time
+METADATA_CHUNK_SIZE = 64 * 1024
+
+_METADATA_START = re.compile(r'\s*\{\s*"metadata"\s*:\s*')
+
+
+def read_metadata(filename):
+    """
+    Reads just the metadata of a result_dict file, without parsing the rest.
+    write_json puts metadata first, so only the start of the file
+    needs to be read. Files written before that have their metadata
+    at the end, and are read and parsed in full.
+    """
+
+    with open(filename, 'rb') as fp:
+        data = fp.read(METADATA_CHUNK_SIZE)
+
+        if data[:4] == b'PK\x03\x04':
+            # import here so that numpy is only needed if it's actually used
+            from . import columnar
+            return columnar.read_npz_metadata(filename)
+
+        decoder = json.JSONDecoder()
+        while True:
+            # a chunk can end in the middle of a character, but that's past
+            # the metadata if the metadata can be decoded
+            text = data.decode('utf-8', 'replace')
+            match = _METADATA_START.match(text)
+            if not match:
+                break
+
+            try:
+                metadata, _ = decoder.raw_decode(text, match.end())
+                return decode_metadata(metadata)
+            except ValueError:
+                chunk = fp.read(METADATA_CHUNK_SIZE)
+                if not chunk:
+                    break
+                data += chunk
+
+        fp.seek(0)
+        return read_json(fp)['metadata']
+
+
+def read_data(dataset_directory=None):
+    """
+    Reads a result_dict from standard input, or if dataset_directory
+    is provided, opens it as a dataset.Dataset that can be used in place
+    of a result_dict.
+    """
+
+    if dataset_directory:
+        # import here so that numpy is only needed if it's actually used
+        from . import dataset
+        return dataset.Dataset(dataset_directory)
+
+    return read_json()
@@ -0,0 +1,721 @@
+# coding=utf-8
+
+"""
+Columnar binary format for result_dicts, as an alternative to JSON.
+
+Trips and parkings are stored as typed NumPy arrays, one per property,
+in a compressed .npz file. VINs and other strings are dictionary-encoded,
+and times are stored as int64 seconds since the epoch. Metadata, system and
+vehicles information is small and is stored as JSON within the file.
+
+Reading a file back gives the same result_dict as writing it to JSON with
+cmdline.write_json and reading it with cmdline.read_json would.
+"""
+
+from collections import OrderedDict
+import datetime
+import io
+
+import numpy as np
+
+from . import cmdline, jsonbackend
+from . import records as records_module
+
+
+FORMAT_NAME = 'electric2go-columnar'
+FORMAT_VERSION = 1
+
+# .npz files are zip files
+MAGIC = b'PK\x03\x04'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# values of a column's mask array
+ABSENT, PRESENT, NULL = 0, 1, 2
+
+# result_dict keys containing records:
+# either vin -> list of records, or vin -> single record
+LIST_GROUPS = ('finished_trips', 'finished_parkings')
+SINGLE_GROUPS = ('unfinished_trips', 'unfinished_parkings', 'unstarted_trips')
+TRIP_GROUPS = ('finished_trips', 'unfinished_trips', 'unstarted_trips')
+
+# dicts nested in trip records, stored as separate columns
+# named like 'start.lat' rather than as a JSON blob
+NESTED_KEYS = ('start', 'end')
+
+try:
+    _integer_types = (int, long)
+    _text_type = unicode
+except NameError:
+    # Python 3
+    _integer_types = (int,)
+    _text_type = str
+
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+
+_absent = object()  # marks a property missing in a record
+_nested = object()  # marks a property that is a nested dict
+
+
+def _get_time_columns(group):
+    # same fields as cmdline.decode_result_dict parses
+    if group in TRIP_GROUPS:
+        return {'start.time', 'end.time'}
+    else:
+        return {'starting_time', 'ending_time'}
+
+
+def _json_key(key):
+    # JSON object keys are always strings
+    if isinstance(key, _text_type):
+        return key
+    return next(iter(jsonbackend.json.loads(jsonbackend.json.dumps({key: 0}))))
+
+
+def _to_json_text(value):
+    return jsonbackend.json.dumps(value, default=cmdline.json_serializer,
+                                  separators=(',', ':'))
+
+
+def _to_seconds(value):
+    delta = value - EPOCH
+    return delta.days * 86400 + delta.seconds
+
+
+def _is_plain_datetime(value):
+    # times with microseconds or timezones can't be stored as seconds
+    return (isinstance(value, datetime.datetime) and value.tzinfo is None
+            and value.microsecond == 0)
+
+
+def _is_changing_data(value):
+    return (isinstance(value, (list, tuple))
+            and all(isinstance(item, (list, tuple)) and len(item) == 2
+                    and _is_plain_datetime(item[0])
+                    for item in value))
+
+
+class Writer(object):
+    """
+    Collects the arrays of an encoded result_dict in self.arrays.
+    Subclasses can store them elsewhere, see dataset.write_dataset.
+    """
+
+    def __init__(self):
+        self.arrays = {}
+
+    def _next_name(self):
+        # arrays get generic names, the manifest describes what they are
+        return 'a{}'.format(len(self.arrays))
+
+    def add(self, array, name=None):
+        name = name or self._next_name()
+        self.arrays[name] = array
+        return name
+
+    def allocate(self, dtype, length):
+        """
+        :return: tuple(name, array of zeros to be filled in)
+        """
+
+        array = np.zeros(length, dtype=dtype)
+        return self.add(array), array
+
+    def add_strings(self, strings):
+        """
+        Dictionary-encodes a list of strings.
+        :return: tuple(name of codes array, table description for manifest)
+        """
+
+        table = _StringTable()
+        codes = table.encode(strings)
+        table_description = table.write(self)
+
+        return self.add(np.array(codes, dtype=np.int32)), table_description
+
+
+class _StringTable(object):
+    # strings are added to the table a chunk at a time, and get codes
+    # in the order they are first seen
+
+    def __init__(self):
+        self.codes = {}
+
+    def encode(self, strings):
+        codes = self.codes
+        return [codes.setdefault(string, len(codes)) for string in strings]
+
+    def write(self, writer):
+        """
+        :return: table description for manifest
+        """
+
+        # store the table as a single UTF-8 blob plus offsets,
+        # fixed-width NumPy string arrays would waste a lot of space
+        ordered = sorted(self.codes, key=self.codes.get)
+        encoded = [string.encode('utf-8') for string in ordered]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+
+        return {
+            'blob': writer.add(np.frombuffer(b''.join(encoded), dtype=np.uint8)),
+            'offsets': writer.add(offsets)
+        }
+
+
+class _KindFinder(object):
+    """
+    Works out how a column's values can be stored, from the values
+    that are present, which can be given a chunk at a time.
+    """
+
+    def __init__(self, is_time_column, is_changing_data_column):
+        self.any_present = False
+        self.all_nested = True
+        self.all_datetime = is_time_column
+        self.all_changing_data = is_changing_data_column
+        self.types = set()
+        self.int_min = None
+        self.int_max = None
+
+    def add(self, present_values):
+        if not present_values:
+            return
+
+        self.any_present = True
+
+        if self.all_nested:
+            self.all_nested = all(value is _nested for value in present_values)
+        if self.all_datetime:
+            self.all_datetime = all(_is_plain_datetime(value) for value in present_values)
+        if self.all_changing_data:
+            self.all_changing_data = all(_is_changing_data(value) for value in present_values)
+
+        self.types.update(type(value) for value in present_values)
+
+        if self.types <= set(_integer_types):
+            chunk_min = min(present_values)
+            chunk_max = max(present_values)
+            if self.int_min is None or chunk_min < self.int_min:
+                self.int_min = chunk_min
+            if self.int_max is None or chunk_max > self.int_max:
+                self.int_max = chunk_max
+
+    def get_kind(self):
+        if not self.any_present:
+            return 'json'
+
+        if self.all_nested:
+            return 'dict'
+
+        if self.all_datetime:
+            return 'datetime'
+
+        if self.all_changing_data:
+            return 'changing_data'
+
+        types = self.types
+
+        if types == {bool}:
+            return 'bool'
+        elif types <= set(_integer_types):
+            if _INT64_MIN <= self.int_min and self.int_max <= _INT64_MAX:
+                return 'int'
+        elif types == {float}:
+            return 'float'
+        elif types == {_text_type}:
+            return 'str'
+
+        # everything else, including mixed types, stored as JSON text
+        return 'json'
+
+
+# NumPy types of columns of values that are stored as they are
+_VALUE_DTYPES = {
+    'bool': np.bool_,
+    'int': np.int64,
+    'float': np.float64,
+    'datetime': np.int64
+}
+
+
+class _ColumnEncoder(object):
+    """
+    Encodes a column into arrays allocated up front, so that
+    the column's values can be given a chunk of rows at a time.
+    """
+
+    def __init__(self, writer, name, kind, row_count, item_count):
+        """
+        :param item_count: for 'changing_data' columns,
+        the total number of items in all rows
+        """
+
+        self.name = name
+        self.kind = kind
+        self.table = None
+        self.row = 0
+        self.item = 0
+
+        self.column = {'name': name, 'kind': kind}
+        self.column['mask'], self.mask = writer.allocate(np.int8, row_count)
+
+        if kind == 'dict':
+            # only the mask is needed, the contents are separate columns
+            pass
+        elif kind in _VALUE_DTYPES:
+            self.column['values'], self.values = writer.allocate(_VALUE_DTYPES[kind], row_count)
+        elif kind == 'changing_data':
+            # ragged: all items of all rows in flat arrays,
+            # with offsets[row]:offsets[row+1] being the row's items
+            self.column['offsets'], self.offsets = writer.allocate(np.int64, row_count + 1)
+            self.column['times'], self.times = writer.allocate(np.int64, item_count)
+            self.column['values'], self.values = writer.allocate(np.int32, item_count)
+            self.table = _StringTable()
+        else:
+            # 'str' and 'json', dictionary-encoded
+            self.column['values'], self.values = writer.allocate(np.int32, row_count)
+            self.table = _StringTable()
+
+    def add(self, values):
+        """
+        :param values: values of the next rows, _absent for rows without the column
+        """
+
+        start = self.row
+        end = self.row = start + len(values)
+
+        mask = [ABSENT if value is _absent else (NULL if value is None else PRESENT)
+                for value in values]
+        self.mask[start:end] = mask
+
+        # rows without a value get a placeholder
+        present = [flag == PRESENT for flag in mask]
+        kind = self.kind
+
+        if kind == 'dict':
+            pass
+        elif kind == 'bool':
+            self.values[start:end] = [value is True for value in values]
+        elif kind == 'int':
+            self.values[start:end] = [value if is_present else 0
+                                      for value, is_present in zip(values, present)]
+        elif kind == 'float':
+            self.values[start:end] = [value if is_present else 0.0
+                                      for value, is_present in zip(values, present)]
+        elif kind == 'datetime':
+            self.values[start:end] = [_to_seconds(value) if is_present else 0
+                                      for value, is_present in zip(values, present)]
+        elif kind == 'str':
+            self.values[start:end] = self.table.encode(
+                [value if is_present else u'' for value, is_present in zip(values, present)])
+        elif kind == 'changing_data':
+            lengths = [len(value) if is_present else 0 for value, is_present in zip(values, present)]
+            self.offsets[start + 1:end + 1] = self.item + np.cumsum(lengths, dtype=np.int64)
+
+            items = [item for value, is_present in zip(values, present) if is_present
+                     for item in value]
+            item_start = self.item
+            item_end = self.item = item_start + len(items)
+
+            self.times[item_start:item_end] = [_to_seconds(item[0]) for item in items]
+            self.values[item_start:item_end] = self.table.encode(
+                [_to_json_text(item[1]) for item in items])
+        else:
+            self.values[start:end] = self.table.encode(
+                [_to_json_text(value) if is_present else u''
+                 for value, is_present in zip(values, present)])
+
+    def finish(self, writer):
+        """
+        :return: column description for manifest
+        """
+
+        if self.table is not None:
+            self.column['table'] = self.table.write(writer)
+
+        return self.column
+
+
+def _flatten(record, is_trip):
+    flat = {}
+    for key, value in record.items():
+        key = _json_key(key)
+        if is_trip and key in NESTED_KEYS and isinstance(value, (dict, records_module.Record)):
+            flat[key] = _nested
+            for nested_key, nested_value in value.items():
+                flat[key + '.' + _json_key(nested_key)] = nested_value
+        else:
+            flat[key] = value
+    return flat
+
+
+def _encode_group(writer, group, vins, load_records, vin_codes, chunk_size):
+    is_trip = group in TRIP_GROUPS
+    time_columns = _get_time_columns(group)
+
+    def get_chunks():
+        # tuple(number of records of each VIN, flattened records) for each chunk of VINs
+        step = chunk_size or max(len(vins), 1)
+        for start in range(0, len(vins), step):
+            records_lists = load_records(vins[start:start + step])
+            yield ([len(records) for records in records_lists],
+                   [_flatten(record, is_trip) for records in records_lists for record in records])
+
+    # with a single chunk, keep it for the second pass rather than load it again
+    chunks = None if chunk_size else list(get_chunks())
+
+    # First pass: find the columns, how to store them, and how big they are.
+    # Columns are in order first seen, which puts nested dict columns
+    # before the columns of their contents.
+    record_counts = []
+    kind_finders = OrderedDict()
+    item_counts = {}
+    for counts, flat_records in (chunks if chunks is not None else get_chunks()):
+        record_counts.extend(counts)
+
+        for flat_record in flat_records:
+            for path in flat_record:
+                if path not in kind_finders:
+                    kind_finders[path] = _KindFinder(path in time_columns,
+                                                     not is_trip and path == 'changing_data')
+
+        for path, kind_finder in kind_finders.items():
+            present_values = [flat_record[path] for flat_record in flat_records
+                              if flat_record.get(path) is not None]
+            kind_finder.add(present_values)
+
+            if kind_finder.all_changing_data:
+                item_counts[path] = item_counts.get(path, 0) + sum(len(value) for value in present_values)
+
+    # Second pass: fill in the columns
+    row_count = sum(record_counts)
+    encoders = [_ColumnEncoder(writer, path, kind_finder.get_kind(), row_count, item_counts.get(path, 0))
+                for path, kind_finder in kind_finders.items()]
+
+    for _, flat_records in (chunks if chunks is not None else get_chunks()):
+        for encoder in encoders:
+            encoder.add([flat_record.get(encoder.name, _absent) for flat_record in flat_records])
+
+    columns = [encoder.finish(writer) for encoder in encoders]
+
+    offsets = np.zeros(len(vins) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(record_counts, dtype=np.int64)
+
+    return {
+        'vins': writer.add(np.array([vin_codes[_json_key(vin)] for vin in vins], dtype=np.int32)),
+        'offsets': writer.add(offsets),
+        'columns': columns
+    }
+
+
+def encode_groups(writer, other, group_records, chunk_size=None):
+    """
+    Encodes a result_dict whose records are loaded as they are needed,
+    a chunk of VINs at a time.
+    :param other: keys of the result_dict other than records,
+    like metadata, stored as JSON
+    :param group_records: dict mapping result_dict keys with records,
+    like 'finished_trips', to tuple(list of VINs in the order they are
+    to be stored, function taking a list of VINs and returning a list
+    of lists of their records)
+    :param chunk_size: number of VINs to load at a time, or None to load
+    each group at once. Chunks are loaded twice, once to find out how to
+    store each column and once to store it.
+    :return: writer.arrays
+    """
+
+    groups = [group for group in LIST_GROUPS + SINGLE_GROUPS if group in group_records]
+
+    # VINs are dictionary-encoded across all groups
+    vin_codes = {}
+    for group in groups:
+        for vin in group_records[group][0]:
+            vin_codes.setdefault(_json_key(vin), len(vin_codes))
+
+    _, vin_table = writer.add_strings(sorted(vin_codes, key=vin_codes.get))
+
+    manifest = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'vin_table': vin_table,
+        'groups': {group: _encode_group(writer, group, group_records[group][0],
+                                        group_records[group][1], vin_codes, chunk_size)
+                   for group in groups},
+
+        # everything else is small, so keep it as JSON
+        'other': other
+    }
+
+    writer.add(np.frombuffer(_to_json_text(manifest).encode('utf-8'), dtype=np.uint8),
+               name='manifest')
+
+    return writer.arrays
+
+
+def _get_records_loader(group, records_by_vin):
+    # see encode_groups
+    def load_records(vins):
+        if group in LIST_GROUPS:
+            return [records_by_vin[vin] for vin in vins]
+        else:
+            return [[records_by_vin[vin]] for vin in vins]
+
+    return load_records
+
+
+def get_group_records(result_dict):
+    """
+    :return: group_records argument of encode_groups for result_dict's records
+    """
+
+    # keep VINs in the same order as in the dict, like JSON does.
+    # Some stats depend on the order, e.g. for ties in Counter.most_common.
+    return {group: (list(result_dict[group]), _get_records_loader(group, result_dict[group]))
+            for group in LIST_GROUPS + SINGLE_GROUPS if group in result_dict}
+
+
+def encode(result_dict, writer=None):
+    """
+    :param writer: Writer to add arrays to, a new one if None
+    :return: dict of arrays for numpy.savez
+    """
+
+    group_records = get_group_records(result_dict)
+
+    other = {key: value for key, value in result_dict.items()
+             if key not in group_records}
+
+    return encode_groups(writer or Writer(), other, group_records)
+
+
+def write_npz(result_dict, fp):
+    """
+    :param fp: file opened in binary mode
+    """
+
+    # numpy needs a seekable file, which stdout might not be
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **encode(result_dict))
+    fp.write(buffer.getvalue())
+
+
+def _decode_strings(arrays, table):
+    offsets = arrays[table['offsets']].tolist()
+    blob = arrays[table['blob']].tobytes()
+    return [blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+            for i in range(len(offsets) - 1)]
+
+
+def _get_datetime_decoder():
+    # Times repeat a lot in a dataset, so reuse datetime objects.
+    # They are immutable so that's safe.
+    cache = {}
+
+    def decode_datetime(seconds):
+        result = cache.get(seconds)
+        if result is None:
+            result = EPOCH + datetime.timedelta(seconds=seconds)
+            cache[seconds] = result
+        return result
+
+    return decode_datetime
+
+
+class RecordTable(object):
+    """
+    Decodes the records of one result_dict key, e.g. 'finished_trips',
+    either all at once or for one VIN at a time.
+    """
+
+    def __init__(self, arrays, group, group_manifest, vin_table, decode_datetime):
+        self.arrays = arrays
+        self.group = group
+        self.columns = group_manifest['columns']
+        self.time_columns = _get_time_columns(group)
+        self.decode_datetime = decode_datetime
+
+        self.vins = [vin_table[code] for code in arrays[group_manifest['vins']].tolist()]
+        self.offsets = arrays[group_manifest['offsets']].tolist()
+
+        # string tables of columns, decoded when first needed
+        self._tables = {}
+
+    def _get_table(self, column):
+        name = column['name']
+        if name not in self._tables:
+            table = _decode_strings(self.arrays, column['table'])
+            if column['kind'] != 'str':
+                # JSON text, keep both the text and the parsed values
+                table = (table, [jsonbackend.loads(text) if text else None for text in table])
+            self._tables[name] = table
+        return self._tables[name]
+
+    def _decode_json_values(self, column, start, end):
+        texts, decoded = self._get_table(column)
+
+        # Lists and dicts are mutable, so each row must get its own copy.
+        # Other values can be shared.
+        result = []
+        for code in self.arrays[column['values']][start:end].tolist():
+            value = decoded[code]
+            if isinstance(value, (list, dict)):
+                value = jsonbackend.loads(texts[code])
+            result.append(value)
+
+        return result
+
+    def _decode_column(self, column, start, end):
+        kind = column['kind']
+        values = self.arrays[column['values']]
+
+        if kind in ('bool', 'int', 'float'):
+            return values[start:end].tolist()
+        elif kind == 'datetime':
+            return [self.decode_datetime(seconds) for seconds in values[start:end].tolist()]
+        elif kind == 'str':
+            table = self._get_table(column)
+            return [table[code] for code in values[start:end].tolist()]
+        elif kind == 'changing_data':
+            offsets = self.arrays[column['offsets']][start:end + 1].tolist()
+            items_start, items_end = offsets[0], offsets[-1]
+
+            times = [self.decode_datetime(seconds) for seconds
+                     in self.arrays[column['times']][items_start:items_end].tolist()]
+            drifts = self._decode_json_values(column, items_start, items_end)
+            items = list(zip(times, drifts))
+
+            return [items[offsets[i] - items_start:offsets[i + 1] - items_start]
+                    for i in range(len(offsets) - 1)]
+        else:
+            values = self._decode_json_values(column, start, end)
+
+            if column['name'] in self.time_columns:
+                # times that couldn't be stored as seconds,
+                # parse them like read_json would
+                values = [cmdline.parse_time(value) for value in values]
+
+            return values
+
+    def decode_rows(self, start, end):
+        """
+        :return: list of records in rows start to end
+        """
+
+        records = [{} for _ in range(end - start)]
+
+        for column in self.columns:
+            mask = self.arrays[column['mask']][start:end]
+            name = column['name']
+
+            # find the dict the value goes into
+            if column['kind'] != 'dict' and '.' in name and name.split('.', 1)[0] in NESTED_KEYS:
+                parent_key, key = name.split('.', 1)
+            else:
+                parent_key, key = None, name
+
+            if column['kind'] == 'dict':
+                values = None
+            else:
+                values = self._decode_column(column, start, end)
+
+            for i in np.flatnonzero(mask == PRESENT).tolist():
+                target = records[i][parent_key] if parent_key else records[i]
+                target[key] = {} if values is None else values[i]
+
+            for i in np.flatnonzero(mask == NULL).tolist():
+                target = records[i][parent_key] if parent_key else records[i]
+                target[key] = None
+
+        if self.group in TRIP_GROUPS:
+            make_record = records_module.make_trip
+        else:
+            make_record = records_module.make_parking
+        return [make_record(record) for record in records]
+
+    def decode_vin(self, index):
+        """
+        :param index: index of the VIN in self.vins
+        :return: list of records for list groups like 'finished_trips',
+        or a single record for the other groups
+        """
+
+        records = self.decode_rows(self.offsets[index], self.offsets[index + 1])
+
+        if self.group in LIST_GROUPS:
+            return records
+        else:
+            return records[0]
+
+    def decode_all(self):
+        records = self.decode_rows(0, self.offsets[-1])
+
+        if self.group in LIST_GROUPS:
+            return {vin: records[self.offsets[i]:self.offsets[i + 1]]
+                    for i, vin in enumerate(self.vins)}
+        else:
+            return {vin: records[self.offsets[i]] for i, vin in enumerate(self.vins)}
+
+
+def decode_manifest(arrays):
+    """
+    :return: tuple(manifest, vin_table, decode_datetime function)
+    """
+
+    manifest = jsonbackend.loads(arrays['manifest'].tobytes())
+
+    if manifest.get('format') != FORMAT_NAME or manifest.get('version') != FORMAT_VERSION:
+        raise ValueError('Not a supported electric2go columnar file')
+
+    vin_table = _decode_strings(arrays, manifest['vin_table'])
+
+    return manifest, vin_table, _get_datetime_decoder()
+
+
+def decode(arrays):
+    """
+    :param arrays: mapping of array names to arrays, as returned by encode()
+    """
+
+    manifest, vin_table, decode_datetime = decode_manifest(arrays)
+
+    result_dict = cmdline.decode_result_dict(manifest['other'])
+
+    for group, group_manifest in manifest['groups'].items():
+        table = RecordTable(arrays, group, group_manifest, vin_table, decode_datetime)
+        result_dict[group] = table.decode_all()
+
+    return result_dict
+
+
+def is_columnar(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def read_npz(data):
+    """
+    :param data: contents of a file written by write_npz
+    """
+
+    with np.load(io.BytesIO(data), allow_pickle=False) as npz_file:
+        # NpzFile decompresses an array each time it is accessed,
+        # so get them all just once
+        arrays = {name: npz_file[name] for name in npz_file.files}
+
+    return decode(arrays)
+
+
+def read_npz_metadata(filename):
+    """
+    Reads just the metadata of a file written by write_npz. Only the
+    manifest is decompressed, not the arrays with trips and parkings.
+    """
+
+    with np.load(filename, allow_pickle=False) as npz_file:
+        manifest = jsonbackend.loads(npz_file['manifest'].tobytes())
+
+    if manifest.get('format') != FORMAT_NAME or manifest.get('version') != FORMAT_VERSION:
+        raise ValueError('Not a supported electric2go columnar file')
+
+    return cmdline.decode_metadata(manifest['other']['metadata'])
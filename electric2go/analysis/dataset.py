@@ -0,0 +1,272 @@
+# coding=utf-8
+
+"""
+Memory-mapped, lazily loaded access to normalized data.
+
+A dataset is a directory with the arrays of the columnar format
+(see columnar.py) saved as separate .npy files. Dataset opens the files
+with mmap, and only decodes records when they are accessed, one VIN
+at a time. An analysis that only looks at trips never reads parkings
+from disk.
+
+Dataset can be passed to analysis functions in place of a result_dict.
+Only the records of the VINs used most recently are kept decoded,
+so that a pass over all of them doesn't end up holding everything
+in memory.
+"""
+
+from collections import OrderedDict
+import os
+
+import numpy as np
+
+from . import cmdline, columnar, merge
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    # Python 2
+    from collections import MutableMapping
+
+
+# number of VINs whose records LazyRecords keeps decoded
+CACHE_SIZE = 64
+
+# number of VINs write_dataset_from_files encodes at a time
+WRITE_CHUNK_SIZE = 256
+
+
+class _DirectoryWriter(columnar.Writer):
+    # saves each array to a .npy file as soon as it is added. Arrays that
+    # are filled in a chunk at a time are memory-mapped from their files.
+
+    def __init__(self, directory):
+        columnar.Writer.__init__(self)
+        self.directory = directory
+        self.mapped = []
+
+    def _get_file_name(self, name):
+        return os.path.join(self.directory, name + '.npy')
+
+    def add(self, array, name=None):
+        name = name or self._next_name()
+        np.save(self._get_file_name(name), array, allow_pickle=False)
+        self.arrays[name] = None  # only the file is kept
+        return name
+
+    def allocate(self, dtype, length):
+        if not length:
+            # empty arrays can't be memory-mapped
+            array = np.zeros(0, dtype=dtype)
+            return self.add(array), array
+
+        name = self._next_name()
+        array = np.lib.format.open_memmap(self._get_file_name(name), mode='w+',
+                                          dtype=dtype, shape=(length,))
+        self.arrays[name] = None
+        self.mapped.append(array)
+        return name, array
+
+    def close(self):
+        for array in self.mapped:
+            array.flush()
+        self.mapped = []
+
+
+def _make_directory(directory):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+
+def write_dataset(result_dict, directory):
+    """
+    Writes result_dict as a dataset into directory, creating it if needed.
+    """
+
+    _make_directory(directory)
+
+    writer = _DirectoryWriter(directory)
+    columnar.encode(result_dict, writer)
+    writer.close()
+
+
+def _get_spool_loader(spool, group):
+    def load_records(vins):
+        return spool.load(group, vins)
+
+    return load_records
+
+
+def write_dataset_from_files(files, directory, chunk_size=WRITE_CHUNK_SIZE):
+    """
+    Merges normalized files, like merge.merge_all_files, and writes
+    the result as a dataset into directory, creating it if needed.
+    Finished trips and parkings are never all in memory at once: they are
+    merged into a merge.RecordSpool, then encoded chunk_size VINs at a time.
+    """
+
+    _make_directory(directory)
+
+    with merge.spool_merge_files(files) as (result_dict, spool):
+        if result_dict is None:
+            raise ValueError('No files to write a dataset from')
+
+        group_records = columnar.get_group_records(result_dict)
+        for group in columnar.LIST_GROUPS:
+            group_records[group] = (spool.get_vins(group), _get_spool_loader(spool, group))
+
+        other = {key: value for key, value in result_dict.items()
+                 if key not in group_records}
+
+        writer = _DirectoryWriter(directory)
+        columnar.encode_groups(writer, other, group_records, chunk_size)
+        writer.close()
+
+
+def is_dataset(path):
+    return os.path.isfile(os.path.join(path, 'manifest.npy'))
+
+
+class _MappedArrays(object):
+    # opens each array file when it is first needed
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.arrays = {}
+
+    def __getitem__(self, name):
+        if name not in self.arrays:
+            filename = os.path.join(self.directory, name + '.npy')
+            try:
+                self.arrays[name] = np.load(filename, mmap_mode='r', allow_pickle=False)
+            except ValueError:
+                # empty arrays can't be memory-mapped
+                self.arrays[name] = np.load(filename, allow_pickle=False)
+        return self.arrays[name]
+
+
+class LazyRecords(MutableMapping):
+    """
+    Dict-like view of e.g. dataset['finished_trips'], mapping VINs
+    to records. Records of a VIN are decoded when accessed. Records of
+    the cache_size VINs used most recently are kept, so that changes
+    made to them are seen the next time they are accessed. Changes to
+    records of a VIN that has since been dropped from the cache are lost.
+
+    Setting or deleting a VIN decodes all records, after which
+    this is a plain dict that keeps everything.
+    """
+
+    def __init__(self, table, cache_size=CACHE_SIZE):
+        self.table = table
+        self.cache_size = cache_size
+        self.records = OrderedDict()
+
+        # Index of VINs in the table. Set to None once all records
+        # have been decoded into self.records, after which self.records
+        # is all there is, and can be changed like a normal dict.
+        self.vin_indexes = {vin: i for i, vin in enumerate(table.vins)}
+
+    def __getitem__(self, vin):
+        if self.vin_indexes is None:
+            return self.records[vin]
+
+        if vin in self.records:
+            # move to the end, as the most recently used
+            records = self.records.pop(vin)
+        elif vin in self.vin_indexes:
+            records = self.table.decode_vin(self.vin_indexes[vin])
+        else:
+            raise KeyError(vin)
+
+        self.records[vin] = records
+        if len(self.records) > self.cache_size:
+            self.records.popitem(last=False)
+
+        return records
+
+    def __iter__(self):
+        if self.vin_indexes is None:
+            return iter(self.records)
+        return iter(self.table.vins)
+
+    def __len__(self):
+        if self.vin_indexes is None:
+            return len(self.records)
+        return len(self.table.vins)
+
+    def __contains__(self, vin):
+        if self.vin_indexes is None:
+            return vin in self.records
+        return vin in self.vin_indexes
+
+    def _load_all(self):
+        if self.vin_indexes is not None:
+            # keep records that are already decoded, they might have been changed
+            self.records = OrderedDict(
+                (vin, self.records[vin] if vin in self.records else self.table.decode_vin(index))
+                for index, vin in enumerate(self.table.vins))
+            self.vin_indexes = None
+
+    def __setitem__(self, vin, value):
+        self._load_all()
+        self.records[vin] = value
+
+    def __delitem__(self, vin):
+        self._load_all()
+        del self.records[vin]
+
+
+class Dataset(MutableMapping):
+    """
+    Dict-like view of a dataset directory with the same keys as a result_dict.
+    """
+
+    def __init__(self, directory, cache_size=CACHE_SIZE):
+        """
+        :param cache_size: number of VINs whose records are kept decoded
+        for each of e.g. finished trips and finished parkings, see LazyRecords
+        """
+
+        if not is_dataset(directory):
+            raise ValueError('Not a dataset directory: ' + directory)
+
+        arrays = _MappedArrays(directory)
+        manifest, vin_table, decode_datetime = columnar.decode_manifest(arrays)
+
+        # metadata, system, and vehicles are small, decode them right away
+        self.items_dict = cmdline.decode_result_dict(manifest['other'])
+
+        # records are decoded only once they are accessed
+        for group, group_manifest in manifest['groups'].items():
+            table = columnar.RecordTable(arrays, group, group_manifest,
+                                         vin_table, decode_datetime)
+            self.items_dict[group] = LazyRecords(table, cache_size)
+
+    def __getitem__(self, key):
+        return self.items_dict[key]
+
+    def __setitem__(self, key, value):
+        self.items_dict[key] = value
+
+    def __delitem__(self, key):
+        del self.items_dict[key]
+
+    def __iter__(self):
+        return iter(self.items_dict)
+
+    def __len__(self):
+        return len(self.items_dict)
+
+    def to_dict(self):
+        """
+        :return: a plain result_dict with all records loaded
+        """
+
+        result_dict = {}
+        for key, value in self.items_dict.items():
+            if isinstance(value, LazyRecords):
+                value = dict(value)
+            result_dict[key] = value
+
+        return result_dict
@@ -0,0 +1,175 @@
+# coding=utf-8
+
+"""
+Faster replacement for normalize.process_data.
+
+Most cars stay parked for many data points in a row, and their data
+doesn't change at all between data points. process_data still works out
+each car's position and parking drift every time, only to find out
+that nothing happened.
+
+FrameDiffEngine keeps state about the previous data point as arrays
+indexed by vehicle: whether each vehicle is parked, and whether its
+position was confirmed unchanged in the previous data point.
+For each new data point, it compares each car with the previous data
+point, and uses array operations to find cars that appeared, disappeared,
+or whose data changed. Only those are passed to normalize.process_car,
+so results are exactly the same as process_data's.
+
+Not everything is vectorized: each car is still looked at once in Python,
+to get its VIN with parser.get_car_basics and to compare its raw data
+with the previous data point's as a whole dict. Cars are dicts
+in the system's own format, with fields that differ by system and can
+be nested, so they would have to be unpacked into arrays field by field
+in Python first, which costs about as much as comparing them.
+Comparing whole dicts is also what makes it safe to skip process_car:
+any change in a car's data, including fields that parsers don't read
+today, gets the car processed again.
+"""
+
+import numpy as np
+
+from . import normalize
+
+
+class FrameDiffEngine(object):
+    """
+    Use an engine's process_data method in place of normalize.process_data.
+    An engine is meant to be used with one result_dict: if process_data is
+    called with a different one, the engine starts from scratch.
+    """
+
+    def __init__(self):
+        self.result_dict = None
+
+        # see normalize.SimpleEngine
+        self.settled = False
+
+    def reset(self, result_dict):
+        self.result_dict = result_dict
+
+        # VIN of each vehicle index, and the other way around
+        self.vins = []
+        self.vin_indexes = {}
+
+        # raw car data from the previous data point, for each vehicle
+        self.previous_cars = []
+
+        # per vehicle: is the vehicle in result_dict['unfinished_parkings']
+        self.parked = np.zeros(0, dtype=bool)
+
+        # per vehicle: was the vehicle in the previous data point, and was
+        # it checked to not have moved from the place it is parked at.
+        # If so, and if its data is the same in the current data point,
+        # process_car is guaranteed to not change anything for it.
+        self.steady = np.zeros(0, dtype=bool)
+
+        for vin in result_dict['unfinished_parkings']:
+            # get the index first, as it can replace self.parked with a larger array
+            index = self.get_vin_index(vin)
+            self.parked[index] = True
+
+    def get_vin_index(self, vin):
+        if vin not in self.vin_indexes:
+            index = len(self.vins)
+            self.vins.append(vin)
+            self.vin_indexes[vin] = index
+            self.previous_cars.append(None)
+
+            if index >= len(self.parked):
+                # grow arrays by doubling, so that this doesn't happen often
+                new_size = max(2 * len(self.parked), 64)
+                self.parked = np.resize(self.parked, new_size)
+                self.parked[index:] = False
+                self.steady = np.resize(self.steady, new_size)
+                self.steady[index:] = False
+
+        return self.vin_indexes[vin]
+
+    def process_data(self, parser, data_time, prev_data_time, available_cars, result_dict):
+        """
+        Same as normalize.process_data.
+        """
+
+        if result_dict is not self.result_dict:
+            self.reset(result_dict)
+
+        # This loop runs for every car, so keep it short.
+        # Dict comparison is done in C and stops at the first difference
+        previous_cars = self.previous_cars
+        vin_indexes = self.vin_indexes
+        get_car_basics = parser.get_car_basics
+
+        cars = []
+        indexes = []
+        basics = []
+        same_as_previous = []
+        for car in available_cars:
+            car_basics = get_car_basics(car)
+            index = vin_indexes.get(car_basics[0])
+            if index is None:
+                index = self.get_vin_index(car_basics[0])
+
+            cars.append(car)
+            indexes.append(index)
+            basics.append(car_basics)
+            same_as_previous.append(previous_cars[index] == car)
+
+        indexes = np.array(indexes, dtype=np.intp)
+
+        if len(np.unique(indexes)) != len(indexes):
+            # A VIN is listed more than once. This is rare, and results
+            # depend on the order cars are processed in. Leave it to
+            # process_data, then start comparing again from the next data point.
+            normalize.process_data(parser, data_time, prev_data_time, cars, result_dict)
+            self.settled = False
+            self.steady[:] = False
+            self.parked[:] = False
+            for vin in result_dict['unfinished_parkings']:
+                self.parked[self.vin_indexes[vin]] = True
+            return result_dict
+
+        available = np.zeros(len(self.parked), dtype=bool)
+        available[indexes] = True
+
+        # Cars that didn't change don't need to be processed at all.
+        # The rest need to go through process_car. Usually there are few:
+        # cars that just appeared, just ended a trip, moved, or had their
+        # data like fuel level change.
+        changed_positions = np.flatnonzero(
+            ~(self.steady[indexes] & np.array(same_as_previous, dtype=bool)))
+
+        steady = np.zeros(len(self.parked), dtype=bool)
+        steady[indexes] = True
+
+        settled = True
+        original_car_data = {}
+        vehicles = result_dict['vehicles']
+        for position in changed_positions.tolist():
+            car = cars[position]
+            vin, lat, lng = basics[position]
+
+            outcome = normalize.process_car(parser, data_time, prev_data_time,
+                                            vin, lat, lng, car,
+                                            result_dict, original_car_data)
+
+            if outcome != normalize.PARKED:
+                steady[indexes[position]] = False
+                settled = False
+
+            if vin not in vehicles:
+                vehicles[vin] = parser.get_car_unchanging_properties(original_car_data[vin])
+
+        # Cars that were parked, but are no longer available, have started a trip
+        for index in np.flatnonzero(self.parked & ~available).tolist():
+            normalize.process_unavailable_car(parser, prev_data_time,
+                                              self.vins[index], result_dict)
+
+        # All available cars are now parked, and no others are
+        self.parked = available
+        self.steady = steady
+        self.settled = settled
+        for index, car in zip(indexes.tolist(), cars):
+            previous_cars[index] = car
+
+        return result_dict
@@ -4,7 +4,7 @@ from collections import defaultdict
 from datetime import timedelta
 import os
 
-from . import cmdline, normalize
+from . import cmdline, normalize, ranges
 from .. import files, systems
 
 
@@ -107,14 +107,14 @@ def build_obj(data_frame, parser, result_dict):
     # - translink whole thing is a list so put_cars will just return its param. that works too I guess
 
     # `car in current_positions` here ultimately comes from a result_dict,
-    # which could be still used for other purposes - so dict.copy it first
+    # which could be still used for other purposes - so copy it to a dict first
     # to avoid undo_normalize and roll_out_changing_data creating side-effects
     # note: this isn't a deep copy, so nested dicts as seen for e.g. drivenow might break :(
     system_cars = (
         parser.put_car(
             roll_out_changing_data(
                 undo_normalize(
-                    dict.copy(car)
+                    dict(car)
                 ),
                 car.get('changing_data', None)
             )
@@ -148,7 +148,7 @@ def write_files(result_dict, location):
         # When generated, the file will not be written at all.
         # But I am already not recreating the originals *perfectly* due to being unable
         # to preserve list order, and recreating error data isn't high on my priority list...
-        if data_time in result_dict['metadata']['missing']:
+        if ranges.contains(result_dict['metadata']['missing'], data_time):
             continue
 
         file_name = files.get_file_name(city, data_time)
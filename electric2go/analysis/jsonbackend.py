@@ -0,0 +1,223 @@
+# coding=utf-8
+
+"""
+Pluggable JSON parsing and serializing.
+
+Loading data archives and reading normalized JSON files is dominated by JSON
+parsing, so use the fastest parser that is installed. Backends are tried
+in order of BACKEND_PREFERENCE; json from the standard library
+(or simplejson, if installed) is always available as the fallback.
+"""
+
+# simplejson is usually slightly faster than json running my tests,
+# (simplejson=3.8.0, py2.7.8 & py3.4.2)
+# so load it if present. If not available, json is fine.
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import codecs
+
+
+BACKEND_PREFERENCE = ['orjson', 'rapidjson', 'ujson', 'json']
+
+# backends that serialize to bytes write output to text streams
+# decoded this many bytes at a time
+WRITE_CHUNK_SIZE = 1024 * 1024
+
+
+def apply_object_hook(obj, object_hook):
+    # For parsers that don't support object_hook, emulate it by walking
+    # the parsed result. Like with object_hook, the innermost dicts are
+    # passed to object_hook first, and its return value replaces the dict.
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(value, (dict, list)):
+                obj[key] = apply_object_hook(value, object_hook)
+        return object_hook(obj)
+    elif isinstance(obj, list):
+        for i, value in enumerate(obj):
+            if isinstance(value, (dict, list)):
+                obj[i] = apply_object_hook(value, object_hook)
+    return obj
+
+
+class StandardBackend(object):
+    name = 'json'
+
+    @staticmethod
+    def loads(data, object_hook=None):
+        if isinstance(data, bytes):
+            # json.loads only accepts bytes on Python 3.6 and newer
+            data = data.decode('utf-8')
+        return json.loads(data, object_hook=object_hook)
+
+    @staticmethod
+    def dump(obj, fp, default=None, indent=None):
+        json.dump(obj, fp=fp, default=default, indent=indent)
+
+
+class OrjsonBackend(object):
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def loads(self, data, object_hook=None):
+        try:
+            result = self.orjson.loads(data)
+        except ValueError:
+            # orjson is stricter, e.g. it doesn't support integers over 64 bits.
+            # If it's not valid JSON, this will raise ValueError again.
+            return StandardBackend.loads(data, object_hook=object_hook)
+
+        if object_hook:
+            result = apply_object_hook(result, object_hook)
+        return result
+
+    def dump(self, obj, fp, default=None, indent=None):
+        if indent == 2:
+            option = self.orjson.OPT_INDENT_2
+        elif not indent:
+            option = 0
+        else:
+            # orjson only supports indenting by 2 spaces
+            return StandardBackend.dump(obj, fp, default, indent)
+
+        # orjson serializes datetimes itself, in the same isoformat() format
+        # that default would. Allow int keys like the standard library does.
+        option |= self.orjson.OPT_NON_STR_KEYS
+
+        try:
+            result = self.orjson.dumps(obj, default=default, option=option)
+        except TypeError:
+            # orjson is stricter, e.g. it doesn't support integers over 64 bits
+            return StandardBackend.dump(obj, fp, default, indent)
+
+        write_utf8(fp, result)
+
+
+def write_utf8(fp, data):
+    """
+    Writes UTF-8 encoded bytes to a text stream without decoding
+    all of data at once, which would need twice as much memory again
+    for a result_dict that might be hundreds of megabytes.
+    """
+
+    binary_fp = getattr(fp, 'buffer', None)
+    encoding = getattr(fp, 'encoding', None)
+    if binary_fp is not None and encoding and codecs.lookup(encoding).name == 'utf-8':
+        # e.g. files opened in text mode and sys.stdout. Text written
+        # before must get to the underlying stream before data does
+        fp.flush()
+        binary_fp.write(data)
+        return
+
+    # e.g. io.StringIO. The decoder keeps characters that are split
+    # between chunks until it gets the rest of their bytes
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for start in range(0, len(data), WRITE_CHUNK_SIZE):
+        fp.write(decoder.decode(data[start:start + WRITE_CHUNK_SIZE]))
+    fp.write(decoder.decode(b'', final=True))
+
+
+class RapidjsonBackend(object):
+    name = 'rapidjson'
+
+    def __init__(self):
+        import rapidjson
+        self.rapidjson = rapidjson
+
+    def loads(self, data, object_hook=None):
+        return self.rapidjson.loads(data, object_hook=object_hook)
+
+    def dump(self, obj, fp, default=None, indent=None):
+        self.rapidjson.dump(obj, fp, default=default, indent=indent)
+
+
+class UjsonBackend(object):
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+
+    def loads(self, data, object_hook=None):
+        result = self.ujson.loads(data)
+        if object_hook:
+            result = apply_object_hook(result, object_hook)
+        return result
+
+    @staticmethod
+    def dump(obj, fp, default=None, indent=None):
+        # ujson's handling of default differs between versions,
+        # writing is not performance-critical so use the standard library
+        StandardBackend.dump(obj, fp, default, indent)
+
+
+BACKENDS = {
+    'orjson': OrjsonBackend,
+    'rapidjson': RapidjsonBackend,
+    'ujson': UjsonBackend,
+    'json': StandardBackend
+}
+
+
+def get_backend(name):
+    """
+    :return: backend object with loads() and dump() methods
+    :raise ValueError: if backend name is unknown or its module is not installed
+    """
+
+    if name not in BACKENDS:
+        raise ValueError('Unknown JSON backend "{name}"'.format(name=name))
+
+    try:
+        return BACKENDS[name]()
+    except ImportError:
+        raise ValueError('JSON backend "{name}" is not installed'.format(name=name))
+
+
+def available_backends():
+    """
+    :return: list of names of backends that can be used,
+    in order of preference
+    """
+
+    result = []
+    for name in BACKEND_PREFERENCE:
+        try:
+            get_backend(name)
+            result.append(name)
+        except ValueError:
+            pass
+
+    return result
+
+
+backend = get_backend(available_backends()[0])
+
+
+def set_backend(name):
+    global backend
+    backend = get_backend(name)
+
+
+def loads(data, object_hook=None):
+    """
+    :param data: JSON document as bytes (UTF-8) or str.
+    Raw bytes are faster as they don't need to be decoded first
+    for most backends.
+    :raise ValueError: if data is not valid JSON
+    """
+    return backend.loads(data, object_hook=object_hook)
+
+
+def load(fp, object_hook=None):
+    return loads(fp.read(), object_hook=object_hook)
+
+
+def dump(obj, fp, default=None, indent=None):
+    backend.dump(obj, fp, default=default, indent=indent)
@@ -1,22 +1,119 @@
 # coding=utf-8
 
 from __future__ import print_function
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import timedelta
+import os
+import sys
+import tempfile
 
-from . import cmdline, normalize
+from . import cmdline, jsonbackend, normalize, ranges
+from .jsonbackend import json  # will be either simplejson or json
+
+
+def _join_parkings(parser, first_parking, two, vin):
+    """
+    Join a parking unfinished at the end of the first result_dict with
+    the parking starting at the first data point in `two`.
+    The joined parking is written back into `two`, replacing its first parking.
+    """
+
+    two_starting_time = two['metadata']['starting_time']
+
+    two_parkings = two['finished_parkings'].get(vin)
+    is_finished = bool(two_parkings) and two_parkings[0]['starting_time'] == two_starting_time
+    if is_finished:
+        second_parking = two_parkings[0]
+    else:
+        # car didn't move at all in `two`
+        second_parking = two['unfinished_parkings'][vin]
+
+    # car properties are from the start of the parking, as in process_data.
+    # changing_data is appended to only when it actually changes, so
+    # skip the first item from `two` if it is the same as the last one we have
+    joined = first_parking.copy()
+    joined['changing_data'] = list(first_parking['changing_data'])
+    if second_parking['changing_data'][0][1] != joined['changing_data'][-1][1]:
+        joined['changing_data'].append(second_parking['changing_data'][0])
+    joined['changing_data'].extend(second_parking['changing_data'][1:])
+
+    if is_finished:
+        joined['ending_time'] = second_parking['ending_time']
+        joined = normalize.calculate_parking(joined)
+        two_parkings[0] = joined
+
+        # The trip after the parking started out with the car's properties
+        # from `two`'s parking. Redo it based on the joined parking.
+        # It's either the first finished trip or the unfinished trip.
+        started_trip = normalize.start_trip(parser, joined['ending_time'], joined)
+
+        two_trips = two['finished_trips'].get(vin)
+        if two_trips:
+            started_trip['end'] = two_trips[0]['end']
+            two_trips[0] = normalize.calculate_trip(started_trip)
+        elif vin in two['unfinished_trips']:
+            two['unfinished_trips'][vin] = started_trip
+    else:
+        two['unfinished_parkings'][vin] = joined
+
+
+def get_next_starting_time(metadata):
+    """
+    :return: starting_time that a result_dict following the one
+    with this metadata must have to be merged with it
+    """
+
+    # Data points between the two are allowed only if they're known
+    # to be missing, e.g. when an archive was split into chunks
+    # and the last few data points of the first chunk were missing.
+    time_step = timedelta(seconds=metadata['time_step'])
+
+    next_starting_time = metadata['ending_time'] + time_step
+    while ranges.contains(metadata['missing'], next_starting_time):
+        next_starting_time += time_step
+
+    return next_starting_time
+
+
+def _check_consecutive(one, two):
+    one_ending_time = one['metadata']['ending_time']
+    two_starting_time = two['metadata']['starting_time']
+
+    if two_starting_time != get_next_starting_time(one['metadata']):
+        raise ValueError("Files don't appear to be in order. ending_time and starting_time "
+                         "must be consecutive, but instead they are {} and {}"
+                         .format(one_ending_time, two_starting_time))
 
 
 def merge_two_dicts(one, two):
     """
-    Merge two result_dicts:
-    - second dict's unstarted_trips are merged with first dict's unfinished_parkings and unfinished_trips as appropriate
+    Merge two result_dicts describing consecutive time periods. The result
+    is the same as if the whole time period had been normalized in one go:
+    - cars parked over the break have their parkings joined up,
+      along with the trip that starts from that parking
+    - cars parked at the end of first dict that are not found on the same
+      position at the start of second dict are moved to a trip starting
+      at first dict's ending_time
+    - second dict's unstarted_trips finish first dict's unfinished_trips,
+      if any; others are new cars and are kept as unstarted_trips
     - key merge on finished_trips, appending
     - key merge on finished_parkings, appending
+    - vehicles seen for the first time in second dict are added
     - merge metadata:
         - system, city, time_step stay the same
-        - missing from second is appended to missing from first
+        - missing ranges from first and second are joined
         - starting_time from first dict
         - ending_time from second dict
+
+    Merged output for ordinary daily files differs from what this function
+    gave before it was made to match a single normalize run. Cars parked at
+    first dict's ending_time that are missing from, or at another position
+    in, the first data point of second dict used to keep their parking
+    unfinished and be listed as a new car in unstarted_trips. That parking
+    is now ended at first dict's ending_time and followed by a trip,
+    as process_data does, so such cars have one more finished parking
+    and trip. Vehicles and missing ranges of both dicts are now kept too.
     :param one: first result_dict. if None, `two` is returned immediately
     :param two: second result_dict
     :return: merged result_dict
@@ -36,67 +133,56 @@ def merge_two_dicts(one, two):
 
         return one_sub
 
-    one_ending_time = one['metadata']['ending_time']
-    two_starting_time = two['metadata']['starting_time']
-
-    time_step = timedelta(seconds=one['metadata']['time_step'])
-    should_be_second_starting_time = one_ending_time + time_step
-    if two_starting_time != should_be_second_starting_time:
-        raise ValueError("Files don't appear to be in order. ending_time and starting_time "
-                         "must be consecutive, but instead they are {} and {}"
-                         .format(one_ending_time, two_starting_time))
-
-    for vin in two['unstarted_trips']:
-        unstarted_trip = two['unstarted_trips'][vin]
-
-        if (vin in one['unfinished_parkings']
-                and unstarted_trip['end']['time'] == two_starting_time
-                and one['unfinished_parkings'][vin]['lat'] == unstarted_trip['end']['lat']
-                and one['unfinished_parkings'][vin]['lng'] == unstarted_trip['end']['lng']):
-
-            # most common case, cars that were parked over the break
-
-            if (vin in two['finished_parkings']
-                    and two['finished_parkings'][vin][0]['starting_time'] == two_starting_time):
-
-                # merge unfinished parking with first one in two['finished_parkings']
-
-                parking_info = two['finished_parkings'][vin][0]
-                parking_info_start = one['unfinished_parkings'][vin]
+    _check_consecutive(one, two)
 
-                parking_info['starting_time'] = parking_info_start['starting_time']
-                parking_info = normalize.calculate_parking(parking_info)
+    parser = normalize.get_parser(one['metadata']['system'])
 
-                two['finished_parkings'][vin][0] = parking_info
-                one['unfinished_parkings'].pop(vin)  # delete
-
-            else:
-                # Cars were parked over the break but then didn't move at all the next day.
-                # Keep it as unfinished parking, without deleting it from the list.
-                # Because of code later on that updates one['unfinished_parkings'] with
-                # two['unfinished_parkings'], update the latter, giving it correct starting_time.
-
-                two['unfinished_parkings'][vin] = one['unfinished_parkings'][vin]
+    one_ending_time = one['metadata']['ending_time']
+    two_starting_time = two['metadata']['starting_time']
 
-        elif vin in one['unfinished_trips']:
+    for vin in list(one['unfinished_trips'].keys()):
+        if vin in two['unstarted_trips']:
             # trip spanning the break, merge the information from unfinished_trips and unstarted_trips
             # then append to finished_trips
 
-            trip_data = one['unfinished_trips'][vin]
-            trip_data.update(unstarted_trip)
+            trip_data = one['unfinished_trips'].pop(vin)
+            trip_data.update(two['unstarted_trips'].pop(vin))
 
             trip_data = normalize.calculate_trip(trip_data)
 
-            if vin in one['finished_trips']:
-                one['finished_trips'][vin].append(trip_data)
-            else:
-                one['finished_trips'][vin] = [trip_data]
+            one['finished_trips'].setdefault(vin, []).append(trip_data)
 
-            one['unfinished_trips'].pop(vin)  # delete
+    for vin in list(one['unfinished_parkings'].keys()):
+        parking = one['unfinished_parkings'].pop(vin)
+        unstarted_trip = two['unstarted_trips'].pop(vin, None)
+
+        if (unstarted_trip
+                and unstarted_trip['end']['time'] == two_starting_time
+                and parking['lat'] == unstarted_trip['end']['lat']
+                and parking['lng'] == unstarted_trip['end']['lng']):
+
+            # most common case, cars that were parked over the break
+            _join_parkings(parser, parking, two, vin)
 
         else:
-            # could be a brand new car entering service, log it
-            one['unstarted_trips'][vin] = unstarted_trip
+            # The car was either not there at the start of `two`,
+            # or it was somewhere else. Either way, process_data would have
+            # ended the parking and started a trip at one_ending_time.
+            finished_parking = normalize.end_parking(one_ending_time, parking)
+            one['finished_parkings'].setdefault(vin, []).append(finished_parking)
+
+            trip_data = normalize.start_trip(parser, one_ending_time, finished_parking)
+
+            if unstarted_trip:
+                # car reappeared in `two` so the trip is finished
+                trip_data.update(unstarted_trip)
+                trip_data = normalize.calculate_trip(trip_data)
+                one['finished_trips'].setdefault(vin, []).append(trip_data)
+            else:
+                one['unfinished_trips'][vin] = trip_data
+
+    # what is left in two['unstarted_trips'] are cars first seen in `two`
+    one['unstarted_trips'].update(two['unstarted_trips'])
 
     one = merge(one, two, 'finished_trips')
     one = merge(one, two, 'finished_parkings')
@@ -104,7 +190,14 @@ def merge_two_dicts(one, two):
     one['unfinished_parkings'].update(two['unfinished_parkings'])
     one['unfinished_trips'].update(two['unfinished_trips'])
 
-    one['metadata']['missing'].extend(two['metadata']['missing'])
+    # vehicle information is saved the first time we see the vehicle
+    for vin in two['vehicles']:
+        if vin not in one['vehicles']:
+            one['vehicles'][vin] = two['vehicles'][vin]
+
+    one['metadata']['missing'] = ranges.union(one['metadata']['missing'],
+                                              two['metadata']['missing'],
+                                              one['metadata']['time_step'])
 
     one['metadata']['ending_time'] = two['metadata']['ending_time']
 
@@ -119,6 +212,32 @@ def merge_all_dicts(dicts):
     return result_dict
 
 
+def merge_tree(dicts):
+    """
+    Same as merge_all_dicts, but merges adjacent pairs of dicts, then adjacent
+    pairs of the results, and so on. The result is the same, but dicts
+    being merged are of similar size, rather than one growing dict
+    being merged with each of the others in turn. Each level of the tree
+    can be merged in parallel, see parallel.merge_files.
+    """
+
+    dicts = list(dicts)
+    if not dicts:
+        return None
+
+    while len(dicts) > 1:
+        merged = [merge_two_dicts(dicts[i], dicts[i + 1])
+                  for i in range(0, len(dicts) - 1, 2)]
+
+        if len(dicts) % 2:
+            # odd one out is merged at the next level
+            merged.append(dicts[-1])
+
+        dicts = merged
+
+    return dicts[0]
+
+
 def load_all_files(files):
     for file_to_load in files:
         with open(file_to_load) as fp:
@@ -127,3 +246,130 @@ def load_all_files(files):
 
 def merge_all_files(files):
     return merge_all_dicts(load_all_files(files))
+
+
+# result_dict keys with lists of records that stay the same once merged,
+# and that stream_merge_files writes out as it goes
+STREAMED_KEYS = ('finished_trips', 'finished_parkings')
+
+
+def _dumps(obj):
+    return json.dumps(obj, default=cmdline.json_serializer)
+
+
+class RecordSpool(object):
+    """
+    Finished trips and parkings kept in a temporary file rather than
+    in memory, as JSON, along with where each VIN's records are in the file.
+    Records of a VIN can be added in parts, e.g. one file's worth at a time.
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.index = {key: OrderedDict() for key in STREAMED_KEYS}
+
+    def add(self, key, records_by_vin):
+        self.file.seek(0, os.SEEK_END)
+        for vin, records in records_by_vin.items():
+            if records:
+                # leave out the list's brackets, so that lists
+                # from different files can be joined up
+                data = _dumps(records)[1:-1].encode('utf-8')
+                self.index[key].setdefault(vin, []).append((self.file.tell(), len(data)))
+                self.file.write(data)
+
+    def get_vins(self, key):
+        return list(self.index[key])
+
+    def get_json(self, key, vin):
+        """
+        :return: JSON of the list of vin's records
+        """
+
+        parts = []
+        for position, length in self.index[key][vin]:
+            self.file.seek(position)
+            parts.append(self.file.read(length).decode('utf-8'))
+
+        return '[' + ','.join(parts) + ']'
+
+    def load(self, key, vins):
+        """
+        :return: list of lists of records of each VIN, as read_json would give
+        """
+
+        records_by_vin = {vin: jsonbackend.loads(self.get_json(key, vin)) for vin in vins}
+        cmdline.decode_result_dict({'metadata': {}, key: records_by_vin})
+
+        return [records_by_vin[vin] for vin in vins]
+
+    def close(self):
+        self.file.close()
+
+
+@contextmanager
+def spool_merge_files(files):
+    """
+    Merges files like merge_all_files, but without keeping all finished
+    trips and parkings in memory. Once a file is merged, none of the
+    finished trips and parkings so far will change, so they are moved
+    to a RecordSpool. Only the rest of the result_dict, like unfinished
+    trips and parkings, is kept. Memory used is then about that needed
+    for the largest of the files.
+    :return: context manager giving tuple(result_dict, spool), with
+    result_dict's finished trips and parkings in spool instead.
+    result_dict is None if there are no files.
+    """
+
+    spool = RecordSpool()
+
+    try:
+        result_dict = None
+        for loaded_dict in load_all_files(files):
+            result_dict = merge_two_dicts(result_dict, loaded_dict)
+
+            for key in STREAMED_KEYS:
+                spool.add(key, result_dict[key])
+                result_dict[key] = {}
+
+        yield result_dict, spool
+    finally:
+        spool.close()
+
+
+def _write_streamed(fp, spool, key):
+    # write a VIN -> records dict from spool, one VIN at a time
+    fp.write('{')
+    for i, vin in enumerate(spool.get_vins(key)):
+        if i:
+            fp.write(',')
+        fp.write(_dumps(vin) + ':' + spool.get_json(key, vin))
+    fp.write('}')
+
+
+def stream_merge_files(files, fp=sys.stdout):
+    """
+    Same as cmdline.write_json(merge_all_files(files), fp), but without
+    keeping all finished trips and parkings in memory, see spool_merge_files.
+    At the end, the JSON output is put together from the spool
+    one VIN at a time.
+    """
+
+    with spool_merge_files(files) as (result_dict, spool):
+        if result_dict is None:
+            # no files
+            fp.write(_dumps(result_dict))
+            return
+
+        # metadata goes first, as write_json puts it, see cmdline.read_metadata
+        fp.write('{')
+        fp.write(_dumps('metadata') + ':' + _dumps(result_dict['metadata']))
+        for key, value in result_dict.items():
+            if key == 'metadata':
+                continue
+            fp.write(',' + _dumps(key) + ':')
+            if key in STREAMED_KEYS:
+                _write_streamed(fp, spool, key)
+            else:
+                fp.write(_dumps(value))
+        fp.write('}')
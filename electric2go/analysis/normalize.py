@@ -1,17 +1,35 @@
 # coding=utf-8
 
+import bisect
 import os
-import codecs
 from collections import defaultdict
 import datetime
-import glob
+import itertools
+import pickle
+import re
 import tarfile
+import threading
+import time
 import zipfile
+import zlib
 
-from .cmdline import json  # will be either simplejson or json
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+from . import jsonbackend, profiling, ranges, records
+from .jsonbackend import json  # will be either simplejson or json
 from .. import dist, current_git_revision, files, systems
 
 
+# what process_car found happened to a car
+TRIP_ENDED = 'trip_ended'
+MOVED = 'moved'
+PARKED = 'parked'
+
+
 def calculate_parking(data):
     data['duration'] = (data['ending_time'] - data['starting_time']).total_seconds()
 
@@ -36,115 +54,216 @@ def calculate_trip(trip_data):
     return trip_data
 
 
-def process_data(parser, data_time, prev_data_time, available_cars, result_dict):
-    # declare local variable names for easier access
+def start_parking(parser, curr_time, vin, new_car_data):
+    changing = parser.get_car_changing_properties(new_car_data)
+
+    result = {
+        'vin': vin,
+
+        # car properties will not change during a parking period, so we don't need to save any
+        # starting/ending pairs except for starting_time and ending_time
+        'starting_time': curr_time,
+
+        # store initial version of changing data in to compare against later
+        # make it a list so new versions can be appended as needed
+        'changing_data': [(curr_time, parser.get_car_parking_drift(changing))]
+    }
+
+    # save the rest of properties straight in the parking object
+    result.update(changing)
+
+    return records.make_parking(result)
+
+
+def end_parking(prev_time, unfinished_parking):
+    # this takes in a finished_parking (already processed, so we can't run
+    # get_car_changing_properties() on it), because we have no current car
+    # info when a trip is starting as the car is missing from the API
+
+    result = unfinished_parking.copy()
+
+    result['ending_time'] = prev_time
+    result = calculate_parking(result)
+
+    return result
+
+
+def start_trip(parser, curr_time, just_finished_parking):
+    # this takes in a finished_parking (already processed, so we can't run
+    # get_car_changing_properties() on it), because we have no current car
+    # info when a trip is starting as the car is missing from the API.
+    # consequently, we take in the data we do have and convert it into
+    # trip information.
+
+    starting_data = just_finished_parking.copy()
+
+    starting_data['time'] = curr_time
+
+    # update with most recent changing data to cover "parking drift"
+    # (e.g. car changing during parking).
+    # otherwise, picking up a car that had been charging while parking
+    # would calculate 'fuel_use' from the value at the start of the parking
+    # (what is in 'fuel' key) and not at the end of the charging
+    # (what is in the last item of 'changing_data' key).
+    # there is always at least once value in changing_data list, per start_parking();
+    # the list contains tuples of (datetime, dataset) - we don't care about the datetime.
+    starting_data = parser.put_car_parking_drift(starting_data, starting_data['changing_data'][-1][1])
+
+    # at this point, `starting_data` contains the output of parser.get_car_changing_properties
+    # plus the following keys:
+    # - from start_parking: vin, starting_time, changing_data
+    # - from end_parking: ending_time
+    # - from calculate_parking: duration
+    # By excluding those keys, we can get the keys that are changing,
+    # and write them into the "start" dictionary.
+    keys_to_exclude = {'vin', 'starting_time', 'ending_time', 'duration', 'changing_data'}
+    result = {
+        'vin': starting_data['vin'],
+        'start': {key: starting_data[key] for key in starting_data
+                  if key not in keys_to_exclude}
+    }
+
+    return records.make_trip(result)
+
+
+def _get_ending_trip_data(parser, prev_time, vin, ending_car_info):
+    trip_data = {
+        'vin': vin,
+        'end': parser.get_car_changing_properties(ending_car_info)
+    }
+
+    trip_data['end']['time'] = prev_time
+
+    return records.make_trip(trip_data)
+
+
+def end_trip(parser, prev_time, vin, ending_car_info, unfinished_trip):
+    # save data at end of trip
+    ending_trip_data = _get_ending_trip_data(parser, prev_time, vin, ending_car_info)
+
+    # update with data from the start of the trip
+    trip_data = unfinished_trip
+    trip_data.update(ending_trip_data)
+
+    # calculate trip distance, duration, etc, based on start and end data
+    trip_data = calculate_trip(trip_data)
+
+    return trip_data
+
+
+def end_unstarted_trip(parser, prev_time, vin, ending_car_info):
+    # essentially the same as end_trip except all bits that depend on
+    # unfinished_trip have been removed - we can only return the end info
+
+    return _get_ending_trip_data(parser, prev_time, vin, ending_car_info)
+
+
+def process_car(parser, data_time, prev_data_time, vin, lat, lng, car,
+                result_dict, original_car_data):
+    """
+    Updates result_dict with one car's information from a data point.
+    Split out of process_data so that framediff can use the exact same logic.
+    """
+
     unfinished_trips = result_dict['unfinished_trips']
     unfinished_parkings = result_dict['unfinished_parkings']
-    unstarted_potential_trips = result_dict['unstarted_trips']
-    finished_parkings = result_dict['finished_parkings']
-    finished_trips = result_dict['finished_trips']
-    vehicles = result_dict['vehicles']
 
-    # internal, not returned
-    original_car_data = {}
+    # most of the time, none of these conditionals will be processed - most cars park for much more than one cycle
 
-    def start_parking(curr_time, vin, new_car_data):
-        changing = parser.get_car_changing_properties(new_car_data)
+    if vin not in unfinished_parkings and vin not in unfinished_trips:
+        # returning from an unknown trip, the first time we're seeing the car
 
-        result = {
-            'vin': vin,
+        # save original raw info
+        original_car_data[vin] = car
 
-            # car properties will not change during a parking period, so we don't need to save any
-            # starting/ending pairs except for starting_time and ending_time
-            'starting_time': curr_time,
+        result_dict['unstarted_trips'][vin] = end_unstarted_trip(parser, data_time, vin, car)
 
-            # store initial version of changing data in to compare against later
-            # make it a list so new versions can be appended as needed
-            'changing_data': [(curr_time, parser.get_car_parking_drift(changing))]
-        }
+        unfinished_parkings[vin] = start_parking(parser, data_time, vin, car)
 
-        # save the rest of properties straight in the parking object
-        result.update(changing)
+    if vin in unfinished_trips:
+        # trip has just finished
 
-        return result
+        result_dict['finished_trips'][vin].append(end_trip(parser, data_time, vin, car, unfinished_trips[vin]))
+        del unfinished_trips[vin]
 
-    def end_parking(prev_time, unfinished_parking):
-        # this takes in a finished_parking (already processed, so we can't run
-        # get_car_changing_properties() on it), because we have no current car
-        # info when a trip is starting as the car is missing from the API
+        unfinished_parkings[vin] = start_parking(parser, data_time, vin, car)
 
-        result = dict.copy(unfinished_parking)
+        return TRIP_ENDED
 
-        result['ending_time'] = prev_time
-        result = calculate_parking(result)
+    # this runs for every parked car at every data point, so look the parking up once
+    parking = unfinished_parkings.get(vin)
 
-        return result
+    if parking is not None and (lat != parking['lat'] or lng != parking['lng']):
+        # car has moved but the "trip" took exactly 1 cycle. consequently unfinished_trips and finished_parkings
+        # were never created in vins_that_just_became_unavailable loop. need to handle this manually
 
-    def start_trip(curr_time, just_finished_parking):
-        # this takes in a finished_parking (already processed, so we can't run
-        # get_car_changing_properties() on it), because we have no current car
-        # info when a trip is starting as the car is missing from the API.
-        # consequently, we take in the data we do have and convert it into
-        # trip information.
-
-        starting_data = dict.copy(just_finished_parking)
-
-        starting_data['time'] = curr_time
-
-        # update with most recent changing data to cover "parking drift"
-        # (e.g. car changing during parking).
-        # otherwise, picking up a car that had been charging while parking
-        # would calculate 'fuel_use' from the value at the start of the parking
-        # (what is in 'fuel' key) and not at the end of the charging
-        # (what is in the last item of 'changing_data' key).
-        # there is always at least once value in changing_data list, per start_parking();
-        # the list contains tuples of (datetime, dataset) - we don't care about the datetime.
-        starting_data = parser.put_car_parking_drift(starting_data, starting_data['changing_data'][-1][1])
-
-        # at this point, `starting_data` contains the output of parser.get_car_changing_properties
-        # plus the following keys:
-        # - from start_parking: vin, starting_time, changing_data
-        # - from end_parking: ending_time
-        # - from calculate_parking: duration
-        # By excluding those keys, we can get the keys that are changing,
-        # and write them into the "start" dictionary.
-        keys_to_exclude = {'vin', 'starting_time', 'ending_time', 'duration', 'changing_data'}
-        result = {
-            'vin': starting_data['vin'],
-            'start': {key: starting_data[key] for key in starting_data
-                      if key not in keys_to_exclude}
-        }
+        # end previous parking and start trip
+        finished_parking = end_parking(prev_data_time, parking)
+        result_dict['finished_parkings'][vin].append(finished_parking)
+        started_trip = start_trip(parser, prev_data_time, finished_parking)
 
-        return result
+        # end trip right away and start 'new' parking period in new position
+        result_dict['finished_trips'][vin].append(end_trip(parser, data_time, vin, car, started_trip))
+        unfinished_parkings[vin] = start_parking(parser, data_time, vin, car)
 
-    def _get_ending_trip_data(prev_time, vin, ending_car_info):
-        trip_data = {
-            'vin': vin,
-            'end': parser.get_car_changing_properties(ending_car_info)
-        }
+        return MOVED
 
-        trip_data['end']['time'] = prev_time
+    else:
+        # if we're here, we have an unfinished parking.
+        # test one more thing: if a car is parked and charging at the same time,
+        # its properties can change during the parking period.
+        # compare current data with last-stored data for the parking.
+        current_data = parser.get_car_parking_drift(parser.get_car_changing_properties(car))
 
-        return trip_data
+        # note, 'changing_data' is guaranteed to have at least one item
+        # because that's added in start_parking()
+        changing_data = parking['changing_data']
+        (previous_data_timestamp, previous_data) = changing_data[-1]
 
-    def end_trip(prev_time, vin, ending_car_info, unfinished_trip):
-        # save data at end of trip
-        ending_trip_data = _get_ending_trip_data(prev_time, vin, ending_car_info)
+        if previous_data != current_data:
+            changing_data.append(
+                (data_time, current_data)
+            )
 
-        # update with data from the start of the trip
-        trip_data = unfinished_trip
-        trip_data.update(ending_trip_data)
+        return PARKED
 
-        # calculate trip distance, duration, etc, based on start and end data
-        trip_data = calculate_trip(trip_data)
 
-        return trip_data
+def process_unavailable_car(parser, prev_data_time, vin, result_dict):
+    """
+    Updates result_dict for a parked car that is no longer available.
+    """
+
+    # trip has just started
+
+    unfinished_parkings = result_dict['unfinished_parkings']
 
-    def end_unstarted_trip(prev_time, vin, ending_car_info):
-        # essentially the same as end_trip except all bits that depend on
-        # unfinished_trip have been removed - we can only return the end info
+    finished_parking = end_parking(prev_data_time, unfinished_parkings[vin])
+    result_dict['finished_parkings'][vin].append(finished_parking)
+    del unfinished_parkings[vin]
 
-        return _get_ending_trip_data(prev_time, vin, ending_car_info)
+    result_dict['unfinished_trips'][vin] = start_trip(parser, prev_data_time, finished_parking)
+
+
+def process_data(parser, data_time, prev_data_time, available_cars, result_dict):
+    _process_data(parser, data_time, prev_data_time, available_cars, result_dict)
+
+    return result_dict
+
+
+def _process_data(parser, data_time, prev_data_time, available_cars, result_dict):
+    """
+    Does the work for process_data.
+    :return: True if processing the same data point again right away
+    would not change anything, i.e. all cars are confirmed to be parked
+    where they were, with no changes to their properties.
+    """
+
+    # declare local variable names for easier access
+    unfinished_parkings = result_dict['unfinished_parkings']
+    vehicles = result_dict['vehicles']
+
+    # internal, not returned
+    original_car_data = {}
 
     """
     Set this up as a defacto state machine with two states.
@@ -165,93 +284,249 @@ def process_data(parser, data_time, prev_data_time, available_cars, result_dict)
     A trip starts on prev_data_time and ends on data_time.
     """
 
+    settled = True
+    car_count = 0
+
     available_vins = set()
     for car in available_cars:
 
         vin, lat, lng = parser.get_car_basics(car)
         available_vins.add(vin)
+        car_count += 1
+
+        outcome = process_car(parser, data_time, prev_data_time, vin, lat, lng, car,
+                              result_dict, original_car_data)
+        if outcome != PARKED:
+            settled = False
 
-        # most of the time, none of these conditionals will be processed - most cars park for much more than one cycle
+    if car_count != len(available_vins):
+        # a VIN is listed more than once, process_car will find it moved each time
+        settled = False
 
-        if vin not in unfinished_parkings and vin not in unfinished_trips:
-            # returning from an unknown trip, the first time we're seeing the car
+    new_vins = available_vins - set(vehicles.keys())
+    for vin in new_vins:
+        # save info about a car that doesn't change over time
+        # (e.g. car model), we will only hit this once per car per dataset
 
-            # save original raw info
-            original_car_data[vin] = car
+        vehicles[vin] = parser.get_car_unchanging_properties(original_car_data[vin])
 
-            unstarted_potential_trips[vin] = end_unstarted_trip(data_time, vin, car)
+    vins_that_just_became_unavailable = set(unfinished_parkings.keys()) - available_vins
+    for vin in vins_that_just_became_unavailable:
+        process_unavailable_car(parser, prev_data_time, vin, result_dict)
 
-            unfinished_parkings[vin] = start_parking(data_time, vin, car)
+    return settled
 
-        if vin in unfinished_trips:
-            # trip has just finished
 
-            finished_trips[vin].append(end_trip(data_time, vin, car, unfinished_trips[vin]))
-            del unfinished_trips[vin]
+class SimpleEngine(object):
+    """
+    Processes data points with process_data. Like framediff.FrameDiffEngine,
+    it keeps track of whether the last data point processed is settled,
+    that is, processing the same data again would not change anything.
+    """
 
-            unfinished_parkings[vin] = start_parking(data_time, vin, car)
+    def __init__(self):
+        self.settled = False
 
-        elif vin in unfinished_parkings and (lat != unfinished_parkings[vin]['lat'] or lng != unfinished_parkings[vin]['lng']):
-            # car has moved but the "trip" took exactly 1 cycle. consequently unfinished_trips and finished_parkings
-            # were never created in vins_that_just_became_unavailable loop. need to handle this manually
+    def process_data(self, parser, data_time, prev_data_time, available_cars, result_dict):
+        self.settled = _process_data(parser, data_time, prev_data_time,
+                                     available_cars, result_dict)
 
-            # end previous parking and start trip
-            finished_parking = end_parking(prev_data_time, unfinished_parkings[vin])
-            finished_parkings[vin].append(finished_parking)
-            started_trip = start_trip(prev_data_time, finished_parking)
+        return result_dict
 
-            # end trip right away and start 'new' parking period in new position
-            finished_trips[vin].append(end_trip(data_time, vin, car, started_trip))
-            unfinished_parkings[vin] = start_parking(data_time, vin, car)
 
-        else:
-            # if we're here, we have an unfinished parking.
-            # test one more thing: if a car is parked and charging at the same time,
-            # its properties can change during the parking period.
-            # compare current data with last-stored data for the parking.
-            current_data = parser.get_car_parking_drift(parser.get_car_changing_properties(car))
+def get_index_file_name(archive_filename):
+    return archive_filename + '.index'
 
-            # note, 'changing_data' is guaranteed to have at least one item
-            # because that's added in start_parking()
-            (previous_data_timestamp, previous_data) = unfinished_parkings[vin]['changing_data'][-1]
 
-            if previous_data != current_data:
-                unfinished_parkings[vin]['changing_data'].append(
-                    (data_time, current_data)
-                )
+def get_manifest_dir_name(directory):
+    # next to the directory rather than in it, so that writing
+    # the manifest doesn't change the directory's mtime
+    return os.path.abspath(directory) + '.manifest'
 
-    new_vins = available_vins - set(vehicles.keys())
-    for vin in new_vins:
-        # save info about a car that doesn't change over time
-        # (e.g. car model), we will only hit this once per car per dataset
 
-        vehicles[vin] = parser.get_car_unchanging_properties(original_car_data[vin])
+# a directory's mtime is only trusted to show that no files were added
+# if it is at least this many seconds older than the last scan, as some
+# filesystems only keep mtime to the second or two
+MANIFEST_MTIME_MARGIN = 2
 
-    vins_that_just_became_unavailable = set(unfinished_parkings.keys()) - available_vins
-    for vin in vins_that_just_became_unavailable:
-        # trip has just started
 
-        finished_parking = end_parking(prev_data_time, unfinished_parkings[vin])
-        finished_parkings[vin].append(finished_parking)
-        del unfinished_parkings[vin]
+def _read_manifest_file(filename):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        # doesn't exist or is malformed
+        return None
 
-        unfinished_trips[vin] = start_trip(prev_data_time, finished_parking)
 
-    return result_dict
+def _write_manifest_file(filename, contents):
+    try:
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        # same as for tar indexes
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(contents, f)
+        os.rename(temp_filename, filename)
+    except (IOError, OSError):
+        pass
+
+
+class _ListdirEntry(object):
+    # stands in for os.DirEntry on Python 2
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def _scan_directory(directory):
+    if hasattr(os, 'scandir'):
+        # scandir is faster than listdir for large directories,
+        # and on some systems gets stat() results along with the names
+        return os.scandir(directory)
+    else:
+        # Python 2
+        return (_ListdirEntry(directory, name) for name in os.listdir(directory))
+
+
+def get_directory_manifest(directory, city):
+    """
+    Lists a city's data files in a directory. Directories collecting data
+    can hold hundreds of thousands of files, so the list is kept in
+    a manifest file and only updated when files are added or removed.
+    :return: dict mapping names of the city's data files to list(size, mtime)
+    """
+
+    manifest_filename = os.path.join(get_manifest_dir_name(directory), city + '.json')
+    manifest = _read_manifest_file(manifest_filename) or {}
+    known_files = manifest.get('files', {})
+
+    directory_mtime = os.stat(directory).st_mtime
+    if (manifest.get('directory_mtime') == directory_mtime
+            and directory_mtime < manifest.get('scanned_at', 0) - MANIFEST_MTIME_MARGIN):
+        # no files were added or removed since the last scan
+        return known_files
+
+    scanned_at = time.time()
+
+    # same files as matched by files.FILENAME_MASK
+    prefix = city + '_'
+    prefix_length = len(prefix)
+    file_time_regex = re.compile(r'\d{4}-\d\d-\d\d--\d\d-\d\d$')
+
+    city_files = {}
+    for entry in _scan_directory(directory):
+        name = entry.name
+        if not name.startswith(prefix) or not file_time_regex.match(name, prefix_length):
+            continue
+
+        # data files don't change once written, only stat new ones
+        file_info = known_files.get(name)
+        if file_info is None:
+            file_stat = entry.stat()
+            file_info = [file_stat.st_size, file_stat.st_mtime]
+
+        city_files[name] = file_info
+
+    _write_manifest_file(manifest_filename, {
+        'directory_mtime': directory_mtime,
+        'scanned_at': scanned_at,
+        'files': city_files
+    })
+
+    return city_files
+
+
+def _tarinfo_to_index(tarinfo):
+    return [tarinfo.name, tarinfo.offset, tarinfo.offset_data, tarinfo.size]
+
+
+def _tarinfo_from_index(member):
+    # TarInfo defaults to a regular file which is what extractfile() needs,
+    # beyond that it only uses the offsets and size
+    name, offset, offset_data, size = member
+
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.offset = offset
+    tarinfo.offset_data = offset_data
+    tarinfo.size = size
+
+    return tarinfo
+
+
+def convert_tar_to_zip(tar_filename, zip_filename):
+    """
+    Recompresses a tar archive, usually a .tgz, into a zip archive.
+    Members of a zip archive are compressed separately, so a single data point
+    can be read without decompressing everything before it in the archive.
+    Electric2goDataArchive can read the zip archive directly.
+    """
+
+    # stream mode reads the archive in one pass, which is all we need
+    with tarfile.open(tar_filename, 'r|*') as tar, \
+            zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zip_archive:
+        for tarinfo in tar:
+            if not tarinfo.isfile():
+                continue
+
+            zipinfo = zipfile.ZipInfo(tarinfo.name,
+                                      date_time=time.gmtime(tarinfo.mtime)[:6])
+            zipinfo.compress_type = zipfile.ZIP_DEFLATED
+            zipinfo.external_attr = (tarinfo.mode & 0xFFFF) << 16
+
+            f = tar.extractfile(tarinfo)
+            zip_archive.writestr(zipinfo, f.read())
+            f.close()
 
 
 class Electric2goDataArchive():
     last_file_time = None
 
-    load_data_point = None  # will be dynamically assigned
+    load_raw_data_point = None  # will be dynamically assigned
 
     handle_to_close = None  # will be assigned if we need to close something at the end
 
-    def __init__(self, city, filename):
-        if os.path.isfile(filename) and tarfile.is_tarfile(filename):
+    stream = False
+
+    def __init__(self, city, filename, stream=False):
+        if stream and os.path.isfile(filename) and tarfile.is_tarfile(filename):
+            # Handle being asked to read a tar file in a single forward pass.
+
+            # Random access to files in a .tgz is expensive: gzip can't
+            # seek, so getting to a file means decompressing the archive up to
+            # it. When all data points are processed in order anyway,
+            # it is cheaper to read the archive as a stream, once,
+            # from the start to the end. Only the current file is kept
+            # in memory, however large the archive.
+            # Data points can then only be read with iter_data_points(),
+            # load_data_point() is not available.
+
+            self.stream = True
+
+            self.tarfile = tarfile.open(filename, 'r|*')
+            self.handle_to_close = self.tarfile
+
+            # Reading the first file's header is cheap, but we'd have to read
+            # the whole stream to find the last file. Use the index
+            # if there is one, otherwise read until the stream runs out.
+            self.stream_first_member = self._next_stream_member()
+            if not self.stream_first_member:
+                raise ValueError('No data files found in ' + filename)
+            self.first_file_time = files.get_time_from_filename(self.stream_first_member.name)
+
+            index_tarinfos = self._read_tar_index(filename)
+            if index_tarinfos:
+                last_file = index_tarinfos[-1].name
+                self.last_file_time = files.get_time_from_filename(last_file)
+
+        elif os.path.isfile(filename) and tarfile.is_tarfile(filename):
             # Handle being provided a tar file.
 
-            self.load_data_point = self.tar_loader
+            self.load_raw_data_point = self.tar_loader
 
             # Performance comments:
             # The most efficient we can get is to scan the whole list of files
@@ -261,12 +536,15 @@ class Electric2goDataArchive():
             # We can get TarInfos with getmembers(), which does the whole-file
             # scan. We then associate TarInfos with their data timestamp,
             # as we ultimately fetch the data with the timestamp.
+            # For a .tgz, the whole-file scan means decompressing the whole
+            # archive, so the offsets are saved in an index file next to
+            # the archive and reused the next time the archive is opened.
 
             self.tarfile = tarfile.open(filename)
             self.handle_to_close = self.tarfile
 
-            # tarfile.getmembers() is in same order as files in the tarfile
-            all_files_tarinfos = self.tarfile.getmembers()
+            # in same order as files in the tarfile
+            all_files_tarinfos = self._get_tarinfos(filename)
 
             # Get time of first and last data point.
             # This implementation assumes that files in the tarfile
@@ -286,7 +564,7 @@ class Electric2goDataArchive():
             # see comments for tarfile logic above, the logic here is the same
             # only translated to zipfile module's idioms
 
-            self.load_data_point = self.zip_loader
+            self.load_raw_data_point = self.zip_loader
 
             # Performance comments:
             # If provided a filename in the constructor, ZipFile module will
@@ -318,20 +596,26 @@ class Electric2goDataArchive():
             self.city = city
             self.directory = os.path.split(filename)[0]
 
-            self.load_data_point = self.file_loader
+            self.load_raw_data_point = self.file_loader
 
             # Get time of first and last data point.
-            # First search for all files matching naming scheme
-            # for the current city, then find the min/max file, then its date.
+            # First get all files matching naming scheme for the current city
+            # from the directory's manifest, then find the min/max file,
+            # then its date.
             # This implementation requires that data files are named in
             # alphabetical-chronological order - it seems unusual and wrong
             # to do it any other way, so hopefully it won't be a problem.
             # There doesn't seem to be an easier/faster way to do this as
             # Python's directory lists all return in arbitrary order.
+            # The manifest also lets file_loader skip data points
+            # that have no file without looking for them.
+
+            self.file_names = get_directory_manifest(self.directory or os.curdir, self.city)
+            if not self.file_names:
+                raise ValueError('No data files found for {city} in {dir}'.format(
+                    city=self.city, dir=self.directory or os.curdir))
 
-            mask = files.FILENAME_MASK.format(city=self.city)
-            matching_files = glob.glob(os.path.join(self.directory, mask))
-            sorted_files = sorted(matching_files)
+            sorted_files = sorted(self.file_names)
 
             first_file = sorted_files[0]
             self.first_file_time = files.get_time_from_filename(first_file)
@@ -339,81 +623,477 @@ class Electric2goDataArchive():
             last_file = sorted_files[-1]
             self.last_file_time = files.get_time_from_filename(last_file)
 
+    @staticmethod
+    def _read_tar_index(filename):
+        archive_stat = os.stat(filename)
+
+        try:
+            with open(get_index_file_name(filename), 'r') as f:
+                index = json.load(f)
+
+            # only use the index if it was made for this version of the archive
+            if (index['size'] == archive_stat.st_size
+                    and index['mtime'] == archive_stat.st_mtime):
+                return [_tarinfo_from_index(member) for member in index['members']]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            # index doesn't exist or is malformed
+            pass
+
+        return None
+
+    @staticmethod
+    def _write_tar_index(filename, tarinfos):
+        index_filename = get_index_file_name(filename)
+        archive_stat = os.stat(filename)
+
+        index = {
+            'size': archive_stat.st_size,
+            'mtime': archive_stat.st_mtime,
+            'members': [_tarinfo_to_index(t) for t in tarinfos]
+        }
+
+        try:
+            # write to a temporary file then rename, so that an interrupted
+            # write can't leave a truncated index behind
+            temp_filename = index_filename + '.tmp'
+            with open(temp_filename, 'w') as f:
+                json.dump(index, f)
+            os.rename(temp_filename, index_filename)
+        except (IOError, OSError):
+            # the index is only an optimization, don't fail if
+            # e.g. the archive is in a read-only directory
+            pass
+
+    def _get_tarinfos(self, filename):
+        tarinfos = self._read_tar_index(filename)
+
+        if tarinfos is None:
+            tarinfos = self.tarfile.getmembers()
+            self._write_tar_index(filename, tarinfos)
+
+        return tarinfos
+
+    def _next_stream_member(self):
+        # Skip over directories and files not named like data files.
+        # Returns None once the stream runs out.
+        while True:
+            tarinfo = self.tarfile.next()
+
+            if tarinfo is None:
+                return None
+
+            # TarFile remembers every member it has seen. This is not needed
+            # for reading a stream and would make memory use grow
+            # with the archive size, so forget them.
+            self.tarfile.members = []
+
+            if not tarinfo.isfile():
+                continue
+
+            try:
+                files.get_time_from_filename(tarinfo.name)
+            except ValueError:
+                continue
+
+            return tarinfo
+
+    def load_data_point(self, t):
+        """
+        :return: parsed data point, or False if it is missing or malformed
+        """
+        return parse_data_point(self.load_raw_data_point(t))
+
+    def iter_data_points(self, starting_time, ending_time, time_step, skip_unchanged=False,
+                         profiler=profiling.NULL_PROFILER):
+        """
+        Yields data points from starting_time to ending_time,
+        every time_step seconds.
+        :param ending_time: datetime, or None to continue until
+        the end of the archive. Only allowed for streamed archives.
+        :param skip_unchanged: if True, data points that are byte-for-byte
+        the same as the previous valid data point are not parsed.
+        UnchangedDataPoint is yielded in place of their data.
+        :param profiler: profiling.Profiler to time reading and parsing with
+        :return: iterator of tuple(data_time, data), with data being False
+        if the data point is missing or malformed
+        """
+
+        raw_data_points = self.iter_raw_data_points(starting_time, ending_time, time_step)
+
+        previous_raw_data = None
+        while True:
+            # reading includes decompressing, for archives
+            with profiler.stage('read'):
+                item = next(raw_data_points, None)
+            if item is None:
+                return
+
+            t, raw_data = item
+            if skip_unchanged and raw_data is not None and raw_data == previous_raw_data:
+                # comparing bytes is much quicker than parsing them
+                yield t, UnchangedDataPoint(raw_data)
+                continue
+
+            with profiler.stage('parse'):
+                data = parse_data_point(raw_data)
+            if data:
+                previous_raw_data = raw_data
+            yield t, data
+
+    def iter_raw_data_points(self, starting_time, ending_time, time_step):
+        """
+        Like iter_data_points, but yields unparsed contents of data files.
+        :return: iterator of tuple(data_time, bytes), with bytes being None
+        if the data point is missing
+        """
+
+        if self.stream:
+            return self._stream_iter_raw_data_points(starting_time, ending_time, time_step)
+        else:
+            return self._random_access_iter_raw_data_points(starting_time, ending_time, time_step)
+
+    def _random_access_iter_raw_data_points(self, starting_time, ending_time, time_step):
+        step = datetime.timedelta(seconds=time_step)
+
+        t = starting_time
+        while t <= ending_time:
+            yield t, self.load_raw_data_point(t)
+
+            t += step
+
+    def _stream_iter_raw_data_points(self, starting_time, ending_time, time_step):
+        step = datetime.timedelta(seconds=time_step)
+
+        t = starting_time
+
+        tarinfo = self.stream_first_member
+        while tarinfo:
+            file_time = files.get_time_from_filename(tarinfo.name)
+
+            # Expected data points before this file's time were not
+            # in the archive, report them as missing
+            while t < file_time and (ending_time is None or t <= ending_time):
+                yield t, None
+                t += step
+
+            if ending_time is not None and t > ending_time:
+                return
+
+            # Skip files from before starting_time, or that are between
+            # data points we're interested in with this time_step
+            if file_time == t:
+                yield t, self._read_tar_member(tarinfo)
+                t += step
+
+            tarinfo = self._next_stream_member()
+
     def close(self):
         if self.handle_to_close:
             self.handle_to_close.close()
 
+    # The loaders return raw bytes of the data file, or None if the file
+    # is not found. The data is parsed separately in parse_data_point
+    # to let the JSON backend parse bytes directly without decoding them.
+
     def file_loader(self, t):
         filename = files.get_file_name(self.city, t)
+        if filename not in self.file_names:
+            # not in the directory when it was opened
+            return None
+
         filepath_to_load = os.path.join(self.directory, filename)
 
         try:
-            with open(filepath_to_load, 'r') as f:
-                result = json.load(f)
-            return result
-        except (IOError, ValueError):
-            # return False if file does not exist or is malformed
-            return False
+            with open(filepath_to_load, 'rb') as f:
+                return f.read()
+        except IOError:
+            # return None if file does not exist
+            return None
 
     def tar_loader(self, t):
         if t in self.tarinfos:
-            # tarfile.extractfile() doesn't support context managers
-            # on Python 2 :(
-
-            f = self.tarfile.extractfile(self.tarinfos[t])
+            return self._read_tar_member(self.tarinfos[t])
+        else:
+            # return None if file is not in the archive
+            return None
 
-            reader = codecs.getreader('utf-8')
+    def _read_tar_member(self, tarinfo):
+        # tarfile.extractfile() doesn't support context managers
+        # on Python 2 :(
 
-            try:
-                result = json.load(reader(f))
-            except ValueError:
-                # return False if file is not valid JSON
-                result = False
-
-            f.close()
+        f = self.tarfile.extractfile(tarinfo)
+        result = f.read()
+        f.close()
 
-            return result
-        else:
-            # return False if file is not in the archive
-            return False
+        return result
 
     def zip_loader(self, t):
         if t in self.zipinfos:
             with self.zipfile.open(self.zipinfos[t]) as f:
-                reader = codecs.getreader('utf-8')
+                return f.read()
+        else:
+            # return None if file is not in the archive
+            return None
 
-                try:
-                    result = json.load(reader(f))
-                except ValueError:
-                    # return False if file is not valid JSON
-                    result = False
 
-            return result
-        else:
-            # return False if file is not in the archive
-            return False
+class MultiDataArchive(Electric2goDataArchive):
+    """
+    Presents several archives or directories of data files, e.g. a week
+    of daily .tgz archives, as one continuous archive. Data points between
+    the end of one archive and the start of the next are reported as missing.
+
+    Only one of the archives is open at a time.
+    """
+
+    def __init__(self, city, filenames, stream=False):
+        self.city = city
+        self.stream = stream
+
+        if not self.stream:
+            self.load_raw_data_point = self.multi_loader
+
+        # Open each archive once to find its time range. For .tgz files
+        # this creates their index, so opening them again later is cheap.
+        self.archives = []  # list of tuple(first_file_time, last_file_time, filename)
+        for filename in filenames:
+            archive = self._open_archive(filename)
+            self.archives.append((archive.first_file_time, archive.last_file_time, filename))
+            archive.close()
+
+        # Order of the filenames doesn't matter
+        self.archives.sort(key=lambda archive: archive[0])
+
+        for previous, following in zip(self.archives, self.archives[1:]):
+            if previous[1] is not None and previous[1] >= following[0]:
+                raise ValueError('Archives {} and {} overlap in time'.format(
+                    previous[2], following[2]))
+
+        self.first_times = [archive[0] for archive in self.archives]
+
+        self.first_file_time = self.archives[0][0]
+        self.last_file_time = self.archives[-1][1]
+
+        # the currently open archive
+        self.current_index = None
+        self.current_archive = None
+
+    def _open_archive(self, filename):
+        if os.path.isdir(filename):
+            # Electric2goDataArchive is given a file in the directory
+            filename = os.path.join(filename, '')
+
+        return Electric2goDataArchive(self.city, filename, self.stream)
+
+    def _get_archive(self, index):
+        if index != self.current_index:
+            self.close()
+            self.current_archive = self._open_archive(self.archives[index][2])
+            self.current_index = index
+
+        return self.current_archive
+
+    def multi_loader(self, t):
+        # the last archive to start at or before t is the only one that can have it
+        index = bisect.bisect_right(self.first_times, t) - 1
+        if index < 0:
+            return None
+
+        return self._get_archive(index).load_raw_data_point(t)
+
+    def _stream_iter_raw_data_points(self, starting_time, ending_time, time_step):
+        step = datetime.timedelta(seconds=time_step)
+
+        t = starting_time
+        for index, (first_file_time, last_file_time, filename) in enumerate(self.archives):
+            if ending_time is not None and t > ending_time:
+                return
+
+            # Read the archive up to where the next one starts. Its own
+            # iterator reports gaps before its first file as missing.
+            archive_ending_time = ending_time
+            if index + 1 < len(self.archives):
+                next_first_file_time = self.archives[index + 1][0]
+                if archive_ending_time is None or archive_ending_time >= next_first_file_time:
+                    archive_ending_time = next_first_file_time - step
+
+            if archive_ending_time is not None and t > archive_ending_time:
+                continue
+
+            archive = self._get_archive(index)
+            if not archive.stream:
+                # zip archives and directories are read with random access,
+                # which needs an ending time
+                if archive_ending_time is None or archive_ending_time > archive.last_file_time:
+                    archive_ending_time = archive.last_file_time
+
+            for data_time, raw_data in archive.iter_raw_data_points(t, archive_ending_time, time_step):
+                yield data_time, raw_data
+                t = data_time + step
+
+    def close(self):
+        if self.current_archive:
+            self.current_archive.close()
+
+        self.current_index = None
+        self.current_archive = None
+
+
+class UnchangedDataPoint(object):
+    """
+    Stands in for a data point that is the same as the previous valid one,
+    and wasn't parsed. Use parse() if the data is needed after all.
+    """
+
+    def __init__(self, raw_data):
+        self.raw_data = raw_data
+
+    def parse(self):
+        return parse_data_point(self.raw_data)
+
+
+def parse_data_point(raw_data):
+    """
+    :param raw_data: bytes as returned by an Electric2goDataArchive loader
+    :return: parsed data, or False if raw_data is None or not valid JSON
+    """
+
+    if raw_data is None:
+        return False
+
+    try:
+        return jsonbackend.loads(raw_data)
+    except ValueError:
+        # return False if file is not valid JSON
+        return False
+
+
+def prefetch(iterable, depth):
+    """
+    Iterates over iterable in a background thread, keeping up to depth items
+    ready ahead of the consumer. Items are returned in the same order.
+    Exceptions raised by iterable are re-raised in the consumer.
+
+    Used to load and parse the next data points while process_data
+    is working on the current one. A single thread is used as
+    an Electric2goDataArchive can't be read from several threads at once.
+    """
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end_marker = object()
+
+    def put(item):
+        # Don't block forever on a full queue if the consumer has stopped
+        # iterating, e.g. after an exception or after close()
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def load():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((end_marker, None))
+        except Exception as e:
+            put((end_marker, e))
+
+    thread = threading.Thread(target=load)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item, error = items.get()
+
+            if item is end_marker:
+                if error:
+                    raise error
+                return
+
+            yield item
+    finally:
+        # stop the thread before the caller does anything else
+        # with the source of iterable, like closing the archive
+        stop.set()
+        thread.join()
+
 
+def get_vin_shard(vin, shard_count):
+    # Use CRC32 rather than hash(): string hashes are randomized
+    # per process, and all processes must agree which shard a VIN is in.
+    return zlib.crc32(u'{}'.format(vin).encode('utf-8')) % shard_count
 
-def batch_load_data(system, starting_filename, starting_time, ending_time, time_step):
+
+def filter_cars_by_vin_shard(parser, cars, vin_shard):
+    shard_index, shard_count = vin_shard
+
+    return [car for car in cars
+            if get_vin_shard(parser.get_car_basics(car)[0], shard_count) == shard_index]
+
+
+def get_parser(system):
     # get parser functions for the correct system
     try:
-        parser = systems.get_parser(system)
+        return systems.get_parser(system)
     except ImportError:
         msg = 'Unrecognized system "{sys}" (unable to import "{sys}.parse")'
         raise ValueError(msg.format(sys=system))
 
-    # get city name. split if we were provided a path including directory
-    file_name = os.path.split(starting_filename)[1]
-    city = files.get_city_from_filename(file_name)
 
-    # if we were provided with a file, not an archive, get its starting time
-    try:
-        starting_file_time = files.get_time_from_filename(file_name)
-    except ValueError:
-        # for archives, use low value so it is not chosen in max() below
+def get_city_from_filenames(filenames):
+    """
+    :param filenames: list of archive names, e.g. vancouver_2016-02-09.tgz.
+    Directories are ignored, as their names don't include the city.
+    :return: name of the city all the archives are for
+    """
+
+    cities = set(files.get_city_from_filename(os.path.split(filename)[1])
+                 for filename in filenames
+                 if not os.path.isdir(filename))
+
+    if len(cities) != 1:
+        raise ValueError('Could not work out a single city from names of archives: {}'
+                         .format(', '.join(filenames)))
+
+    return cities.pop()
+
+
+def open_data_archive(starting_filename, starting_time, ending_time, stream=False):
+    """
+    Opens the archive or directory of data files and works out the time range
+    to process.
+    :param starting_filename: archive, directory or first data file to use,
+    or a list of archives and directories to be read as one continuous archive
+    :param stream: read a tar archive in a single pass, see
+    Electric2goDataArchive. ending_time can be returned as None in that case,
+    meaning the data should be read until the archive runs out.
+    :return: tuple(city, data_archive, starting_time, ending_time)
+    """
+
+    if isinstance(starting_filename, (list, tuple)):
+        # several archives to be read as one, see MultiDataArchive
+        city = get_city_from_filenames(starting_filename)
         starting_file_time = datetime.datetime(year=1, month=1, day=1)
+        data_archive = MultiDataArchive(city, starting_filename, stream)
+
+    else:
+        # get city name. split if we were provided a path including directory
+        file_name = os.path.split(starting_filename)[1]
+        city = files.get_city_from_filename(file_name)
+
+        # if we were provided with a file, not an archive, get its starting time
+        try:
+            starting_file_time = files.get_time_from_filename(file_name)
+        except ValueError:
+            # for archives, use low value so it is not chosen in max() below
+            starting_file_time = datetime.datetime(year=1, month=1, day=1)
 
-    data_archive = Electric2goDataArchive(city, starting_filename)
+        data_archive = Electric2goDataArchive(city, starting_filename, stream)
 
     if not starting_time:
         # If starting_time is provided, use it.
@@ -422,24 +1102,26 @@ def batch_load_data(system, starting_filename, starting_time, ending_time, time_
         # 2) data_archive.first_file_time
         starting_time = max(starting_file_time, data_archive.first_file_time)
 
-    if (not ending_time) or ending_time > data_archive.last_file_time:
+    if data_archive.last_file_time is None:
+        # Time of last file is not known for streamed archives.
+        # Use ending_time as provided, if it is past the end of the archive
+        # or not provided, the stream will simply run out.
+        pass
+    elif (not ending_time) or ending_time > data_archive.last_file_time:
         # If ending_time not provided, scan until we get to the last file.
         # If provided, check if it is earlier than data actually available;
         # if not, only use what is available.
         ending_time = data_archive.last_file_time
 
-    # `t` will be the time of the current iteration. Start from the start.
-    t = starting_time
+    return city, data_archive, starting_time, ending_time
 
-    # prev_t will be the time of the previous *good* dataset.
-    # In the very first iteration of main loop, value of prev_t is not used.
-    # This initial value will be only used when there is no data at all,
-    # in which case it'll become the ending_time. We want ending_time
-    # to be at least somewhat useful, so assign t.
-    prev_t = t
 
-    # Set up the result_dict which will be built up then returned
-    result_dict = {
+def new_result_dict(system, city, starting_time, time_step):
+    """
+    :return: an empty result_dict, to be filled in by process_data
+    """
+
+    return {
         # These two dicts contain ongoing record of things that are happening.
         # The dicts are modified in each iteration as cars' trips and parkings
         # end or start.
@@ -474,40 +1156,212 @@ def batch_load_data(system, starting_filename, starting_time, ending_time, time_
             'city': city,
             'starting_time': starting_time,
             'time_step': time_step,
-            'missing': []  # appended to as we load data
+            'missing': []  # ranges of missing data points, see ranges.add
             # 'ending_time' will be added once all data is loaded
         }
     }
 
+
+def _start_batch(parser, system, city, starting_time, time_step, data_archive, data_points):
+    """
+    Sets up batch_load_data's result_dict based on the first data point.
+    :return: tuple(result_dict, prev_t, data_points)
+    """
+
+    # `t` will be the time of the current iteration. Start from the start.
+    t = starting_time
+
+    # prev_t will be the time of the previous *good* dataset.
+    # In the very first iteration of main loop, value of prev_t is not used.
+    # This initial value will be only used when there is no data at all,
+    # in which case it'll become the ending_time. We want ending_time
+    # to be at least somewhat useful, so assign t.
+    prev_t = t
+
+    # Set up the result_dict which will be built up then returned
+    result_dict = new_result_dict(system, city, starting_time, time_step)
+
     # With the first data point, make sure it's valid format for the system,
     # then extract and save data other than available cars.
     # See comment for result_dict['system'] definition above.
-    # Do not increment t so that same datapoint will be read again in the loop
-    first_data = data_archive.load_data_point(t)
-    first_available_cars = parser.get_cars(first_data)
+    # Put the data point back in front of the iterator so that
+    # it is processed in the loop like all the others. This means
+    # get_everything_except_cars must not change the data point.
+    first_data_point = next(data_points, (t, False))
+    first_available_cars = parser.get_cars(first_data_point[1])
     if not first_available_cars:
+        data_points.close()  # stops the prefetch thread, if any
+        data_archive.close()
         raise ValueError('First file found is invalid or contains no cars.'
                          'Provide starting_time for first valid dataset.')
-    result_dict['system'] = parser.get_everything_except_cars(first_data)
+    result_dict['system'] = parser.get_everything_except_cars(first_data_point[1])
 
-    # Loop until we get to end of dataset or until the limit requested.
-    while t <= ending_time:
-        # get current time's data
-        data = data_archive.load_data_point(t)
+    data_points = itertools.chain([first_data_point], data_points)
+
+    return result_dict, prev_t, data_points
+
+
+CHECKPOINT_INTERVAL = 300  # seconds
+
+# at least this many times as long as it takes to write a checkpoint
+# has to pass before the next one is written
+CHECKPOINT_MIN_RATIO = 50
 
-        # It seems very tempting to turn data_archive / Electric2goDataArchive
-        # into an iterator and just call next() rather than incrementing
-        # a timestamp here. However, we need the timestamp for
-        # missing_data_points list, so we'd have to have the iterator return
-        # the timestamp as well. At that point we might as well keep track
-        # of time in this loop.
+
+def write_checkpoint(filename, checkpoint):
+    # pickle keeps result_dict exactly as it is, including tuples
+    # and defaultdicts, and is quick to write and read.
+    # Write to a temporary file then rename, so that an interrupted
+    # write doesn't leave a broken checkpoint.
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_filename, filename)
+
+
+def read_checkpoint(filename):
+    """
+    :return: checkpoint written by batch_load_data. Only use
+    with trusted files, as it is read with pickle.
+    """
+
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def batch_load_data(system, starting_filename, starting_time, ending_time, time_step,
+                    vin_shard=None, stream=False, prefetch_depth=0, engine='simple',
+                    skip_unchanged=False, checkpoint_filename=None, resume=False,
+                    checkpoint_interval=CHECKPOINT_INTERVAL, profiler=profiling.NULL_PROFILER):
+    """
+    :param vin_shard: optional tuple(shard_index, shard_count). If provided,
+    only vehicles with get_vin_shard(vin, shard_count) == shard_index
+    will be processed. Used to split processing between several processes.
+    :param starting_filename: archive, directory or first data file,
+    or a list of these to be read as one continuous archive.
+    :param stream: if starting_filename is a tar archive, read it
+    in a single pass rather than with random access to its files.
+    Faster and uses less memory for .tgz archives.
+    :param prefetch_depth: if more than 0, load and parse up to this many
+    data points in a background thread while earlier ones are processed.
+    :param engine: 'simple' to process data points with process_data,
+    or 'framediff' to use the faster framediff.FrameDiffEngine,
+    which requires numpy. Results are the same.
+    :param skip_unchanged: if True, don't parse or process data points
+    that are byte-for-byte the same as the previous one, when processing
+    them wouldn't change anything. Results are the same.
+    The number of data points skipped is counted in profiler
+    as 'skipped_unchanged'.
+    :param checkpoint_filename: if provided, progress is saved to this file
+    every checkpoint_interval seconds, so that an interrupted run
+    can be continued with resume=True.
+    :param resume: continue from checkpoint_filename rather than
+    from the start. The result is the same as for an uninterrupted run.
+    Parameters must be the same as for the run that wrote the checkpoint.
+    :param profiler: profiling.Profiler to record time taken by each stage
+    of processing in. Not used to time anything by default.
+    """
+
+    parser = get_parser(system)
+
+    if engine == 'framediff':
+        # import here so that numpy is only needed if it's actually used
+        from . import framediff
+        engine = framediff.FrameDiffEngine()
+    elif engine == 'simple':
+        engine = SimpleEngine()
+    else:
+        raise ValueError('Unknown engine "{engine}"'.format(engine=engine))
+
+    checkpoint_params = {
+        'system': system,
+        'starting_filename': (os.path.abspath(starting_filename)
+                              if not isinstance(starting_filename, (list, tuple))
+                              else [os.path.abspath(f) for f in starting_filename]),
+        'starting_time': starting_time,
+        'ending_time': ending_time,
+        'time_step': time_step,
+        'vin_shard': vin_shard
+    }
+
+    if resume:
+        checkpoint = read_checkpoint(checkpoint_filename)
+        if checkpoint['params'] != checkpoint_params:
+            raise ValueError('Checkpoint is from a run with different parameters: {}'
+                             .format(checkpoint['params']))
+
+        # use the times worked out by the original run
+        starting_time = checkpoint['starting_time']
+        ending_time = checkpoint['ending_time']
+
+    city, data_archive, starting_time, ending_time = open_data_archive(
+        starting_filename, starting_time, ending_time, stream)
+
+    # when resuming, continue from the data point after the last one processed
+    data_points = data_archive.iter_data_points(checkpoint['t'] if resume else starting_time,
+                                                ending_time, time_step, skip_unchanged,
+                                                profiler)
+
+    if prefetch_depth > 0:
+        data_points = prefetch(data_points, prefetch_depth)
+
+    if resume:
+        result_dict = checkpoint['result_dict']
+        prev_t = checkpoint['prev_t']
+    else:
+        result_dict, prev_t, data_points = _start_batch(
+            parser, system, city, starting_time, time_step, data_archive, data_points)
+
+    # Loop until we get to end of dataset or until the limit requested.
+    # The iterator returns the timestamp of each data point with it,
+    # as we need it for process_data and the missing data points list.
+    last_checkpoint_time = time.time()
+    last_checkpoint_duration = 0
+    for t, data in data_points:
+        if checkpoint_filename and time.time() - last_checkpoint_time > max(
+                checkpoint_interval, last_checkpoint_duration * CHECKPOINT_MIN_RATIO):
+            # The state is as it was after the previous data point,
+            # so the run can be continued from t.
+            # Writing takes longer as result_dict grows. To keep it
+            # from slowing processing down, write less often then.
+            last_checkpoint_time = time.time()
+            with profiler.stage('checkpoint'):
+                write_checkpoint(checkpoint_filename, {
+                    'params': checkpoint_params,
+                    'starting_time': starting_time,
+                    'ending_time': ending_time,
+                    't': t,
+                    'prev_t': prev_t,
+                    'result_dict': result_dict
+                })
+            last_checkpoint_duration = time.time() - last_checkpoint_time
+
+        profiler.add_data_point()
+
+        if isinstance(data, UnchangedDataPoint):
+            if engine.settled:
+                # Nothing would change for any car, only prev_t
+                # would be updated. Do just that.
+                profiler.count('skipped_unchanged')
+                prev_t = t
+                continue
+
+            # Something happened in the previous data point, e.g. a car
+            # ended a trip, so cars need to be checked once more
+            with profiler.stage('parse'):
+                data = data.parse()
 
         if data:
-            # handle outer JSON structure and get a list we can loop through
-            available_cars = parser.get_cars(data)
+            with profiler.stage('get_cars'):
+                # handle outer JSON structure and get a list we can loop through
+                available_cars = parser.get_cars(data)
 
-            result_dict = process_data(parser, t, prev_t,
-                                       available_cars, result_dict)
+                if vin_shard:
+                    available_cars = filter_cars_by_vin_shard(parser, available_cars, vin_shard)
+
+            with profiler.stage('process_data'):
+                result_dict = engine.process_data(parser, t, prev_t,
+                                                  available_cars, result_dict)
 
             # update last valid data timestamp
             prev_t = t
@@ -532,10 +1386,7 @@ def batch_load_data(system, starting_filename, starting_time, ending_time, time_
 
         else:
             # Data file not found or was malformed, report it as missing.
-            result_dict['metadata']['missing'].append(t)
-
-        # get next data time according to provided time_step
-        t += datetime.timedelta(seconds=time_step)
+            ranges.add(result_dict['metadata']['missing'], t, time_step)
 
     data_archive.close()
 
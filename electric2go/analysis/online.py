@@ -0,0 +1,331 @@
+# coding=utf-8
+
+"""
+Normalizing data points one at a time, as they are downloaded.
+
+Rather than waiting for a day's archive and running batch_load_data on it,
+OnlineNormalizer keeps the state of process_data between data points,
+so that the day's result_dict is ready as soon as the day's last
+data point is downloaded.
+
+The state can be kept in memory, or in a state file when each data point
+is processed in a separate process, e.g. started by cron after downloading.
+The state file is a result_dict without its finished trips and parkings,
+which are appended to a separate log file instead. This way the files
+written for each data point stay small even late in the day.
+
+update_city holds a lock on the state file while it reads and rewrites it,
+so that runs that overlap, e.g. when a slow download runs into the next
+minute, take turns rather than losing each other's data points.
+"""
+
+import copy
+from collections import defaultdict
+from contextlib import contextmanager
+import datetime
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where runs must not overlap
+    fcntl = None
+
+from . import cmdline, jsonbackend, normalize, ranges
+from .jsonbackend import json
+from .. import files
+
+
+# result_dict keys with lists of records that are only ever appended to,
+# which are kept in the log file
+LOGGED_KEYS = ('finished_trips', 'finished_parkings')
+
+
+def get_state_file_path(city_data):
+    return os.path.join(files.get_data_dir(city_data), 'online_%s.json' % city_data['name'])
+
+
+def get_log_file_name(state_filename):
+    return state_filename + '.log'
+
+
+def get_lock_file_name(state_filename):
+    return state_filename + '.lock'
+
+
+@contextmanager
+def lock_state_file(state_filename):
+    """
+    Holds an exclusive lock for state_filename, waiting until any other
+    process holding it is done. The lock is released when the process
+    exits, so a run that crashes doesn't leave it held.
+    """
+
+    if fcntl is None:
+        yield
+        return
+
+    lock_filename = get_lock_file_name(state_filename)
+    if not os.path.exists(os.path.dirname(lock_filename)):
+        os.makedirs(os.path.dirname(lock_filename))
+
+    with open(lock_filename, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def get_daily_file_path(city_data, day):
+    # not in the data directory itself, where it could be picked up
+    # when archiving the day's data files
+    return os.path.join(files.get_data_dir(city_data) + '-normalized',
+                        '{city}_{day}.json'.format(city=city_data['name'],
+                                                   day=day.strftime('%Y-%m-%d')))
+
+
+class OnlineNormalizer(object):
+    """
+    Builds up a result_dict one data point at a time. The result is the same
+    as running batch_load_data on an archive of the same data points.
+    """
+
+    def __init__(self, system, city, time_step=60, state_filename=None):
+        """
+        :param state_filename: optional file to keep state in between runs.
+        If it exists, state is loaded from it. Use save() to update it.
+        """
+
+        self.system = system
+        self.city = city
+        self.time_step = time_step
+        self.parser = normalize.get_parser(system)
+
+        self.state_filename = state_filename
+        self.log_size = 0
+
+        # created once the first valid data point is found
+        self.result_dict = None
+
+        if state_filename and os.path.exists(state_filename):
+            self._load_state()
+
+    def get_last_data_time(self):
+        """
+        :return: time of the latest data point added, valid or not,
+        or None if no valid data point has been added yet
+        """
+
+        if not self.result_dict:
+            return None
+
+        metadata = self.result_dict['metadata']
+        last_missing = ranges.last_time(metadata['missing'])
+        if last_missing and last_missing > metadata['ending_time']:
+            return last_missing
+        return metadata['ending_time']
+
+    def add_data_point(self, t, raw_data):
+        """
+        Processes one data point. Data points must be added in time order.
+        :param t: time of the data point
+        :param raw_data: contents of the data file, bytes or str.
+        None if the data point is known to be missing.
+        :return: False if the data point was ignored, because it was older
+        than or not a whole number of time steps after the previous data point,
+        or because no valid data point with cars has been added yet.
+        True otherwise.
+        """
+
+        data = normalize.parse_data_point(raw_data)
+
+        # get cars before anything else looks at the data point,
+        # as get_everything_except_cars does for the first one
+        cars = self.parser.get_cars(data) if data else []
+
+        if not self.result_dict:
+            # Same as batch_load_data, the first data point has to be valid,
+            # and its system information is saved.
+            if not cars:
+                return False
+
+            self.result_dict = normalize.new_result_dict(self.system, self.city,
+                                                         t, self.time_step)
+            self.result_dict['system'] = self.parser.get_everything_except_cars(data)
+
+            # like prev_t in batch_load_data
+            self.result_dict['metadata']['ending_time'] = t
+
+        else:
+            last_data_time = self.get_last_data_time()
+            since_start = t - self.result_dict['metadata']['starting_time']
+            if t <= last_data_time or since_start.total_seconds() % self.time_step:
+                return False
+
+            # Data points skipped over were never downloaded
+            step = datetime.timedelta(seconds=self.time_step)
+            if last_data_time + step < t:
+                ranges.add_range(self.result_dict['metadata']['missing'],
+                                 last_data_time + step, t - step, self.time_step)
+
+        metadata = self.result_dict['metadata']
+        if data:
+            normalize.process_data(self.parser, t, metadata['ending_time'],
+                                   cars, self.result_dict)
+            metadata['ending_time'] = t
+        else:
+            ranges.add(metadata['missing'], t, self.time_step)
+
+        return True
+
+    def get_result_dict(self):
+        """
+        :return: result_dict for all data points added so far. It can be
+        passed to merge.merge_two_dicts, or written out with cmdline.write_json.
+        """
+
+        if not self.result_dict:
+            return None
+
+        result_dict = copy.deepcopy(self.result_dict)
+
+        # records written out to the log come before those still in memory
+        for key, vin, records in self._read_log():
+            result_dict[key][vin][:0] = records
+
+        return result_dict
+
+    def save(self):
+        """
+        Writes state to state_filename. Finished trips and parkings are
+        moved from memory to the log file.
+        """
+
+        if not self.result_dict:
+            return
+
+        log_filename = get_log_file_name(self.state_filename)
+        with open(log_filename, 'ab') as f:
+            # remove anything left over from an interrupted save()
+            f.truncate(self.log_size)
+            f.seek(self.log_size)
+
+            for key in LOGGED_KEYS:
+                for vin, records in self.result_dict[key].items():
+                    line = json.dumps([key, vin, records], default=cmdline.json_serializer)
+                    f.write(line.encode('utf-8') + b'\n')
+                self.result_dict[key] = defaultdict(list)
+
+            self.log_size = f.tell()
+
+        # The state file says how much of the log is valid. Replace it
+        # in one step so that it is consistent with the log even if
+        # interrupted, see _load_state().
+        state = dict(self.result_dict, log_size=self.log_size)
+        temp_filename = self.state_filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            cmdline.write_json(state, f)
+        os.rename(temp_filename, self.state_filename)
+
+    def reset(self):
+        """
+        Starts over, e.g. at the start of a new day. Data from the next valid
+        data point on will be in a new result_dict. Any state files are removed.
+        """
+
+        self.result_dict = None
+        self.log_size = 0
+
+        if self.state_filename:
+            for filename in (self.state_filename, get_log_file_name(self.state_filename)):
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    def _load_state(self):
+        with open(self.state_filename) as f:
+            state = cmdline.read_json(f)
+
+        # Ignore anything in the log past what the state file knows about,
+        # it's from a save() that was interrupted before it could finish
+        self.log_size = state.pop('log_size')
+
+        for key in LOGGED_KEYS:
+            state[key] = defaultdict(list)
+        state['vehicles'] = defaultdict(dict, state['vehicles'])
+
+        # process_data compares parking drift with the last value in
+        # changing_data. Drift is a tuple, and JSON turns it into a list,
+        # which would never compare equal.
+        for parking in state['unfinished_parkings'].values():
+            parking['changing_data'] = [(t, tuple(drift) if isinstance(drift, list) else drift)
+                                        for t, drift in parking['changing_data']]
+
+        self.result_dict = state
+
+    def _read_log(self):
+        """
+        :return: list of tuple(key, vin, records) for all records in the log
+        """
+
+        if not self.state_filename:
+            return []
+
+        log_filename = get_log_file_name(self.state_filename)
+        if not os.path.exists(log_filename):
+            return []
+
+        with open(log_filename, 'rb') as f:
+            lines = f.read(self.log_size).splitlines()
+
+        # decode datetimes for all records at once
+        logged = {'metadata': {}, 'finished_trips': {}, 'finished_parkings': {}}
+        for line in lines:
+            key, vin, records = jsonbackend.loads(line)
+            logged[key].setdefault(vin, []).extend(records)
+        logged = cmdline.decode_result_dict(logged)
+
+        return [(key, vin, records)
+                for key in LOGGED_KEYS
+                for vin, records in logged[key].items()]
+
+
+def update_city(city_data, t, time_step=60):
+    """
+    Adds the data point that download.save_one_city has just saved to
+    the city's state file. When the first data point of a new day (UTC)
+    comes in, the previous day's result_dict is written out to
+    get_daily_file_path() and a new one is started.
+    :param t: time passed to save_one_city
+    """
+
+    with open(files.get_current_file_path(city_data), 'rb') as f:
+        raw_data = f.read()
+
+    # data files are named by the minute, use the same time
+    t = t.replace(second=0, microsecond=0)
+
+    state_filename = get_state_file_path(city_data)
+    with lock_state_file(state_filename):
+        # A run that got the lock first with a later data point makes
+        # add_data_point ignore this one, as data points must be in order
+        _update_state(city_data, t, raw_data, time_step, state_filename)
+
+
+def _update_state(city_data, t, raw_data, time_step, state_filename):
+    normalizer = OnlineNormalizer(city_data['system'], city_data['name'],
+                                  time_step, state_filename)
+
+    if normalizer.result_dict and normalizer.result_dict['metadata']['starting_time'].date() != t.date():
+        result_dict = normalizer.get_result_dict()
+        day_filename = get_daily_file_path(city_data, result_dict['metadata']['starting_time'])
+        if not os.path.exists(os.path.dirname(day_filename)):
+            os.makedirs(os.path.dirname(day_filename))
+        with open(day_filename, 'w') as f:
+            cmdline.write_json(result_dict, f)
+
+        normalizer.reset()
+
+    normalizer.add_data_point(t, raw_data)
+
+    normalizer.save()
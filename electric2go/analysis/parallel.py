@@ -0,0 +1,207 @@
+# coding=utf-8
+
+from datetime import timedelta
+from multiprocessing import Pool
+
+from . import merge, normalize, profiling
+
+
+def split_time_range(parser, data_archive, starting_time, ending_time, time_step, chunk_count):
+    """
+    Splits the time range from starting_time to ending_time into up to
+    chunk_count contiguous chunks of roughly equal length.
+
+    normalize.batch_load_data requires its first data point to be valid
+    and contain cars, so each chunk after the first is moved forward
+    to start on such a data point. The data points skipped over this way
+    become part of the previous chunk.
+
+    :return: list of tuple(chunk_starting_time, chunk_ending_time)
+    """
+
+    step = timedelta(seconds=time_step)
+
+    frame_count = int((ending_time - starting_time).total_seconds() // time_step) + 1
+    chunk_length = -(-frame_count // chunk_count)  # division rounding up
+
+    chunk_starts = [starting_time]
+    for i in range(1, chunk_count):
+        t = max(starting_time + step * (i * chunk_length), chunk_starts[-1] + step)
+
+        while t <= ending_time:
+            data = data_archive.load_data_point(t)
+            if data and parser.get_cars(data):
+                break
+            t += step
+
+        if t > ending_time:
+            break
+
+        chunk_starts.append(t)
+
+    chunk_ends = [chunk_start - step for chunk_start in chunk_starts[1:]]
+    chunk_ends.append(ending_time)
+
+    return list(zip(chunk_starts, chunk_ends))
+
+
+def _load_chunk(args):
+    # must be a module-level function so it can be pickled by multiprocessing
+    (system, starting_filename, starting_time, ending_time, time_step,
+     prefetch_depth, engine, skip_unchanged) = args
+
+    # counts are passed back to the parent's profiler, see _add_counts
+    profiler = profiling.Profiler()
+    result_dict = normalize.batch_load_data(system, starting_filename, starting_time,
+                                            ending_time, time_step,
+                                            prefetch_depth=prefetch_depth, engine=engine,
+                                            skip_unchanged=skip_unchanged, profiler=profiler)
+    return result_dict, profiler.counts
+
+
+def _load_vin_shard(args):
+    # must be a module-level function so it can be pickled by multiprocessing
+    (system, starting_filename, starting_time, ending_time, time_step,
+     vin_shard, stream, prefetch_depth, engine, skip_unchanged) = args
+
+    profiler = profiling.Profiler()
+    result_dict = normalize.batch_load_data(system, starting_filename, starting_time,
+                                            ending_time, time_step, vin_shard=vin_shard,
+                                            stream=stream, prefetch_depth=prefetch_depth,
+                                            engine=engine, skip_unchanged=skip_unchanged,
+                                            profiler=profiler)
+    return result_dict, profiler.counts
+
+
+def _add_counts(profiler, results):
+    """
+    Adds up counts from each process in profiler.
+    :param results: list of tuple(result_dict, counts) from each process
+    :return: list of result_dicts
+    """
+
+    for _, counts in results:
+        for name, number in counts.items():
+            profiler.count(name, number)
+
+    return [result_dict for result_dict, _ in results]
+
+
+def merge_vin_shards(shard_results):
+    """
+    Combine result_dicts from batch_load_data_by_vin shards. Each vehicle
+    is only in one shard, so the per-vehicle dicts can be simply joined.
+    All shards read the same data points, so metadata is the same for all.
+    """
+
+    result_dict = shard_results[0]
+
+    for shard_result in shard_results[1:]:
+        for key in ('unfinished_trips', 'unfinished_parkings',
+                    'finished_trips', 'finished_parkings',
+                    'unstarted_trips', 'vehicles'):
+            result_dict[key].update(shard_result[key])
+
+    return result_dict
+
+
+def batch_load_data_by_vin(system, starting_filename, starting_time, ending_time, time_step, workers,
+                           stream=False, prefetch_depth=0, engine='simple',
+                           skip_unchanged=False, profiler=profiling.NULL_PROFILER):
+    """
+    Same as normalize.batch_load_data, but splits vehicles into shards
+    by VIN, and processes each shard in a separate process.
+    Each process reads all data points, so this helps most when there are
+    a lot of vehicles and process_data rather than loading data is the
+    bottleneck. Since each process reads all data points in order,
+    stream=True is a good fit.
+    :param profiler: profiling.Profiler that counts from all processes,
+    like data points skipped as unchanged, are added up in. Each shard
+    skips data points on its own, so a data point can be counted
+    more than once. Stages are not timed.
+    """
+
+    # fail early on unknown systems, rather than in each of the processes
+    normalize.get_parser(system)
+
+    shard_params = [(system, starting_filename, starting_time, ending_time, time_step,
+                     (shard_index, workers), stream, prefetch_depth, engine,
+                     skip_unchanged)
+                    for shard_index in range(workers)]
+
+    pool = Pool(processes=workers)
+    try:
+        shard_results = pool.map(_load_vin_shard, shard_params)
+    finally:
+        pool.close()
+        pool.join()
+
+    return merge_vin_shards(_add_counts(profiler, shard_results))
+
+
+def batch_load_data(system, starting_filename, starting_time, ending_time, time_step, workers,
+                    prefetch_depth=0, engine='simple', skip_unchanged=False,
+                    profiler=profiling.NULL_PROFILER):
+    """
+    Same as normalize.batch_load_data, but splits the time range into chunks
+    and normalizes each chunk in a separate process. The chunks' result_dicts
+    are then merged back together with merge.merge_two_dicts.
+    The result is the same as that of normalize.batch_load_data.
+    :param profiler: profiling.Profiler that counts from all processes,
+    like data points skipped as unchanged, are added up in.
+    Stages are not timed.
+    """
+
+    parser = normalize.get_parser(system)
+
+    city, data_archive, starting_time, ending_time = normalize.open_data_archive(
+        starting_filename, starting_time, ending_time)
+
+    chunks = split_time_range(parser, data_archive, starting_time, ending_time,
+                              time_step, workers)
+
+    data_archive.close()
+
+    chunk_params = [(system, starting_filename, chunk_start, chunk_end, time_step,
+                     prefetch_depth, engine, skip_unchanged)
+                    for chunk_start, chunk_end in chunks]
+
+    pool = Pool(processes=workers)
+    try:
+        chunk_results = pool.map(_load_chunk, chunk_params)
+    finally:
+        pool.close()
+        pool.join()
+
+    return merge.merge_all_dicts(_add_counts(profiler, chunk_results))
+
+
+def _load_and_merge_files(files):
+    # must be a module-level function so it can be pickled by multiprocessing
+    return merge.merge_tree(merge.load_all_files(files))
+
+
+def merge_files(files, workers):
+    """
+    Same as merge.merge_all_files, but reads files in several processes.
+    Files are split into a contiguous group for each process.
+    Each process reads and merges its group with merge.merge_tree,
+    and the groups' results are merged the same way, making one
+    balanced tree of merges. The result is the same as that of
+    merge.merge_all_files.
+    """
+
+    group_size = -(-len(files) // workers)  # division rounding up
+    groups = [files[i:i + group_size] for i in range(0, len(files), group_size)]
+
+    if len(groups) < 2:
+        return merge.merge_tree(merge.load_all_files(files))
+
+    pool = Pool(processes=len(groups))
+    try:
+        group_results = pool.map(_load_and_merge_files, groups)
+    finally:
+        pool.close()
+        pool.join()
+
+    return merge.merge_tree(group_results)
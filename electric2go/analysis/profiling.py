@@ -0,0 +1,186 @@
+# coding=utf-8
+
+"""
+Timing of the stages of a normalize run, see normalize.py --profile.
+Events, like data points skipped, can be counted as well.
+
+Stages are timed with `with profiler.stage('name'):`. Wall and CPU time
+are added up for each stage name. CPU time is per thread where possible,
+so stages run in the prefetch thread are counted correctly, though
+their wall time then overlaps with stages in the main thread.
+
+NULL_PROFILER does nothing and is used when profiling isn't enabled,
+so that code can be instrumented without checking if it is.
+"""
+
+from __future__ import print_function
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+# stages in the order they happen to a data point, for printing
+STAGES = ('read', 'parse', 'get_cars', 'process_data', 'checkpoint', 'write')
+
+try:
+    _wall_time = time.perf_counter
+except AttributeError:
+    # Python 2
+    _wall_time = time.time
+
+try:
+    _cpu_time = time.thread_time
+except AttributeError:
+    # before Python 3.7, only CPU time for the whole process is available
+    _cpu_time = getattr(time, 'process_time', None) or time.clock
+
+try:
+    _process_cpu_time = time.process_time
+except AttributeError:
+    # Python 2
+    _process_cpu_time = time.clock
+
+
+def get_peak_rss():
+    """
+    :return: peak resident set size of this process in bytes,
+    or None if it can't be found
+    """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # bytes on Mac OS, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+class _Stage(object):
+    __slots__ = ('profiler', 'name', 'wall_start', 'cpu_start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.wall_start = _wall_time()
+        self.cpu_start = _cpu_time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add(self.name, _wall_time() - self.wall_start,
+                          _cpu_time() - self.cpu_start)
+
+
+class Profiler(object):
+    def __init__(self):
+        self.wall_start = _wall_time()
+        self.cpu_start = _process_cpu_time()
+
+        self.data_points = 0
+
+        # stage name -> [calls, wall seconds, CPU seconds]
+        self.stages = {}
+
+        # event name -> count
+        self.counts = {}
+
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """
+        :return: context manager timing the code run in it as stage `name`
+        """
+        return _Stage(self, name)
+
+    def add(self, name, wall, cpu):
+        # stages can be timed in the prefetch thread as well
+        with self._lock:
+            totals = self.stages.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+
+    def add_data_point(self):
+        self.data_points += 1
+
+    def count(self, name, number=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + number
+
+    def get_summary(self):
+        """
+        :return: dict with the times so far, for writing as JSON
+        """
+
+        wall = _wall_time() - self.wall_start
+
+        # known stages first, in order, then any others
+        names = [name for name in STAGES if name in self.stages]
+        names += sorted(name for name in self.stages if name not in STAGES)
+
+        return {
+            'stages': [{'name': name,
+                        'calls': self.stages[name][0],
+                        'wall': self.stages[name][1],
+                        'cpu': self.stages[name][2]}
+                       for name in names],
+            'wall': wall,
+            'cpu': _process_cpu_time() - self.cpu_start,
+            'counts': dict(self.counts),
+            'data_points': self.data_points,
+            'data_points_per_second': self.data_points / wall if wall else None,
+            'peak_rss': get_peak_rss()
+        }
+
+    def print_summary(self, fp=sys.stderr):
+        summary = self.get_summary()
+
+        print('{:<15} {:>10} {:>10} {:>10} {:>8}'.format(
+            'stage', 'calls', 'wall s', 'CPU s', '% wall'), file=fp)
+        for stage in summary['stages']:
+            print('{:<15} {:>10} {:>10.2f} {:>10.2f} {:>8.1f}'.format(
+                stage['name'], stage['calls'], stage['wall'], stage['cpu'],
+                100.0 * stage['wall'] / summary['wall'] if summary['wall'] else 0), file=fp)
+        print('{:<15} {:>10} {:>10.2f} {:>10.2f}'.format(
+            'total', '', summary['wall'], summary['cpu']), file=fp)
+
+        print('{count} data points, {rate:.1f} per second'.format(
+            count=summary['data_points'], rate=summary['data_points_per_second'] or 0), file=fp)
+        for name in sorted(summary['counts']):
+            print('{name}: {count}'.format(name=name, count=summary['counts'][name]), file=fp)
+        if summary['peak_rss'] is not None:
+            print('peak RSS {size:.1f} MB'.format(size=summary['peak_rss'] / 1024.0 / 1024),
+                  file=fp)
+
+
+class NullProfiler(object):
+    """
+    Has the same methods as Profiler, but doesn't time anything.
+    """
+
+    def stage(self, name):
+        return self
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def add_data_point(self):
+        pass
+
+    def count(self, name, number=1):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,138 @@
+# coding=utf-8
+
+"""
+Functions for result_dict['metadata']['missing'].
+
+Missing data points are stored as a sorted list of [start, end] ranges,
+with both start and end being missing data points, and every time_step
+between them missing as well. An outage of several hours is then
+a single range rather than hundreds of datetimes.
+
+Ranges are lists rather than tuples so that they are the same after
+being written to JSON and read back.
+"""
+
+import bisect
+from datetime import datetime, timedelta
+
+
+def _step(time_step):
+    return timedelta(seconds=time_step)
+
+
+def add(missing, t, time_step):
+    """
+    Adds a missing data point. It must be later than any already in missing.
+    """
+
+    if missing and missing[-1][1] + _step(time_step) == t:
+        missing[-1][1] = t
+    else:
+        missing.append([t, t])
+
+
+def add_range(missing, start, end, time_step):
+    """
+    Adds missing data points from start to end, inclusive.
+    They must be later than any already in missing.
+    """
+
+    if missing and missing[-1][1] + _step(time_step) == start:
+        missing[-1][1] = end
+    else:
+        missing.append([start, end])
+
+
+def from_times(times, time_step):
+    """
+    :param times: list of missing datetimes, the format used
+    for result_dict['metadata']['missing'] before ranges.
+    :param time_step: if None, each time becomes its own range
+    :return: list of ranges
+    """
+
+    missing = []
+    for t in sorted(times):
+        if time_step:
+            add(missing, t, time_step)
+        else:
+            missing.append([t, t])
+
+    return missing
+
+
+def contains(missing, t):
+    """
+    :return: True if data point at t is missing
+    """
+
+    # index of the first range starting after t
+    index = bisect.bisect_right(missing, [t, datetime.max])
+
+    return index > 0 and missing[index - 1][1] >= t
+
+
+def count(missing, time_step):
+    """
+    :return: number of missing data points
+    """
+
+    return sum(int((end - start).total_seconds()) // time_step + 1
+               for start, end in missing)
+
+
+def last_time(missing):
+    """
+    :return: latest missing data point, or None if there are none
+    """
+
+    return missing[-1][1] if missing else None
+
+
+def clip(missing, from_time, to_time, time_step):
+    """
+    :return: new list of ranges with only data points
+    from from_time up to but not including to_time
+    """
+
+    result = []
+
+    # ranges ending before from_time can't be included
+    first_index = max(bisect.bisect_left(missing, [from_time, from_time]) - 1, 0)
+
+    for start, end in missing[first_index:]:
+        if start >= to_time:
+            break
+
+        if start < from_time:
+            # first data point in the range at from_time or later
+            steps = -(-int((from_time - start).total_seconds()) // time_step)
+            start += _step(time_step * steps)
+
+        if end >= to_time:
+            # last data point in the range before to_time
+            steps = -(-int((to_time - start).total_seconds()) // time_step) - 1
+            end = start + _step(time_step * steps)
+
+        if start <= end:
+            result.append([start, end])
+
+    return result
+
+
+def union(one, two, time_step):
+    """
+    :return: new list of ranges with data points missing in either one or two
+    """
+
+    result = []
+    step = _step(time_step)
+
+    for start, end in sorted(one + two):
+        if result and start <= result[-1][1] + step:
+            # overlapping or directly following the previous range
+            result[-1][1] = max(result[-1][1], end)
+        else:
+            result.append([start, end])
+
+    return result
@@ -0,0 +1,209 @@
+# coding=utf-8
+
+"""
+Compact records for trips, trip endpoints and parkings.
+
+A month of data has millions of these. As dicts, each carries its own
+hash table of several hundred bytes. Records keep their values in
+__slots__ instead, which takes a fraction of that.
+
+Records behave like dicts: they support record['key'], get(), `in`,
+update(), copy(), iteration, and comparison with dicts, so code working
+on result_dicts can handle both. Keys that a record has no slot for
+can still be set, they are kept in a dict made only when needed.
+
+Keys differ between systems, so a record class is made for each set of keys
+when it's first needed, see record_class(). cmdline.write_json turns
+records back into dicts when writing JSON.
+
+String values like VINs, addresses and models repeat in many records.
+They are interned when a record is made, so that each distinct string
+is only kept once, rather than once per record read from JSON or
+per data point it was parsed from.
+"""
+
+import re
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    # Python 2
+    from collections import MutableMapping
+
+
+# Keys added to records after they are made, see normalize.end_parking,
+# calculate_parking, end_trip, and calculate_trip. Records get slots
+# for these from the start.
+PARKING_KEYS = ('ending_time', 'duration')
+TRIP_KEYS = ('vin', 'start', 'end', 'distance', 'duration', 'speed', 'fuel_use')
+
+_IDENTIFIER_REGEX = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+
+try:
+    _string_types = basestring
+except NameError:
+    # Python 3
+    _string_types = str
+
+try:
+    from sys import intern as intern_string
+except ImportError:
+    # Python 2, where intern() only accepts byte strings.
+    # Unlike sys.intern, strings are never released, but the number
+    # of distinct strings in a result_dict is small.
+    _interned = {}
+
+    def intern_string(value):
+        return _interned.setdefault(value, value)
+
+_classes = {}
+
+_empty = {}
+
+
+class Record(MutableMapping):
+    # dict for keys that have no slot, made when first needed. Not using
+    # __dict__ for this, as keys in it would hide methods like items()
+    __slots__ = ('_extra',)
+
+    # set by record_class()
+    _keys = ()
+    _slot_keys = frozenset()
+
+    def __getitem__(self, key):
+        if key in self._slot_keys:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+
+        return self._get_extra()[key]
+
+    def __setitem__(self, key, value):
+        if key in self._slot_keys:
+            setattr(self, key, value)
+        else:
+            try:
+                self._extra[key] = value
+            except AttributeError:
+                self._extra = {key: value}
+
+    def __delitem__(self, key):
+        if key in self._slot_keys:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        else:
+            del self._get_extra()[key]
+
+    def __contains__(self, key):
+        if key in self._slot_keys:
+            return hasattr(self, key)
+
+        return key in self._get_extra()
+
+    def __iter__(self):
+        for key in self._keys:
+            if hasattr(self, key):
+                yield key
+
+        for key in self._get_extra():
+            yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def get(self, key, default=None):
+        if key in self._slot_keys:
+            return getattr(self, key, default)
+
+        return self._get_extra().get(key, default)
+
+    def copy(self):
+        # same class, so keys added later still get slots
+        return _rebuild(self._keys, list(self.items()))
+
+    def __reduce__(self):
+        # record classes are made on the fly, so they can't be pickled by name
+        return _rebuild, (self._keys, list(self.items()))
+
+    # dicts aren't hashable either
+    __hash__ = None
+
+    def _get_extra(self):
+        return getattr(self, '_extra', _empty)
+
+
+def _can_be_slot(key):
+    # keys like 'items' or 'get' would hide the methods
+    return (isinstance(key, _string_types) and _IDENTIFIER_REGEX.match(key) is not None
+            and not hasattr(Record, key))
+
+
+def record_class(keys):
+    """
+    :param keys: tuple of keys the records are expected to have
+    :return: a Record subclass with a slot for each of the keys
+    """
+
+    cls = _classes.get(keys)
+
+    if cls is None:
+        slot_keys = tuple(str(key) for key in keys if _can_be_slot(key))
+        cls = type(str('Record'), (Record,), {
+            '__module__': __name__,
+            '__slots__': slot_keys,
+            '_keys': slot_keys,
+            '_slot_keys': frozenset(slot_keys)
+        })
+        _classes[keys] = cls
+
+    return cls
+
+
+def _rebuild(keys, items):
+    record = record_class(keys)()
+    for key, value in items:
+        record[key] = value
+
+    return record
+
+
+def from_dict(data, extra_keys=()):
+    """
+    :param data: dict, or anything else with items()
+    :param extra_keys: keys that will be added to the record later
+    :return: Record with the same items as data
+    """
+
+    items = [(key, intern_string(value) if isinstance(value, _string_types) else value)
+             for key, value in data.items()]
+
+    keys = tuple(key for key, value in items)
+    keys += tuple(key for key in extra_keys if key not in keys)
+
+    return _rebuild(keys, items)
+
+
+def make_parking(data):
+    return from_dict(data, PARKING_KEYS)
+
+
+def make_trip(data):
+    """
+    :param data: dict with a trip's information. Its 'start' and 'end'
+    dicts, if any, are made into records too.
+    """
+
+    trip = from_dict(data, TRIP_KEYS)
+
+    for key in ('start', 'end'):
+        endpoint = trip.get(key)
+        if endpoint is not None and not isinstance(endpoint, Record):
+            trip[key] = from_dict(endpoint)
+
+    return trip
@@ -1,10 +1,14 @@
 # coding=utf-8
 
-from collections import Counter, OrderedDict
+from collections import OrderedDict
 from datetime import timedelta
+import bisect
 import csv
+import numbers
 import numpy as np
 
+from . import ranges
+
 
 def write_csv(f, items):
     """
@@ -52,11 +56,69 @@ def is_trip_weird(trip):
     return False
 
 
+def get_weird_trips_mask(trips_table):
+    """
+    Vectorized is_trip_weird, with the same criteria.
+    :param trips_table: as returned by get_trips_table
+    :return: boolean array, True for weird trips
+    """
+
+    duration = trips_table['duration']
+    distance = trips_table['distance']
+    fuel_use = trips_table['fuel_use']
+
+    return (((duration < 4*60) & (distance <= 0.01) & (fuel_use > -2))
+            | ((duration == 1*60) & (distance <= 0.05) & (fuel_use > -2)))
+
+
+def get_trips_table(finished_trips):
+    """
+    Converts finished trips into arrays of the properties that stats_dict
+    uses, so that it can compute stats over all trips at once rather than
+    trip by trip. Trips are in the same order as in finished_trips.
+    :return: dict with 'vins', list of VINs in the order of finished_trips,
+    and arrays 'vin_index' (index into 'vins'), 'duration', 'distance'
+    and 'fuel_use', with an item for each trip. 'fuel_use' is an integer
+    array if all fuel uses are integers, otherwise 'fuel_use_is_int'
+    marks which of them were integers.
+    """
+
+    vins = []
+    trip_counts = []
+    durations = []
+    distances = []
+    fuel_uses = []
+    for vin, vin_trips in finished_trips.items():
+        vins.append(vin)
+        trip_counts.append(len(vin_trips))
+        for trip in vin_trips:
+            durations.append(trip['duration'])
+            distances.append(trip['distance'])
+            fuel_uses.append(trip['fuel_use'])
+
+    trips_table = {
+        'vins': vins,
+        'vin_index': np.repeat(np.arange(len(vins)), np.array(trip_counts, dtype=np.intp)),
+        'duration': np.array(durations, dtype=np.float64),
+        'distance': np.array(distances, dtype=np.float64)
+    }
+
+    # keep fuel use as integers if it is, binned values are printed as they are
+    fuel_use_is_int = [isinstance(fuel_use, numbers.Integral) for fuel_use in fuel_uses]
+    if all(fuel_use_is_int):
+        trips_table['fuel_use'] = np.array(fuel_uses, dtype=np.int64)
+    else:
+        trips_table['fuel_use'] = np.array(fuel_uses, dtype=np.float64)
+        trips_table['fuel_use_is_int'] = np.array(fuel_use_is_int, dtype=np.bool_)
+
+    return trips_table
+
+
 def stats_dict(data_dict):
     starting_time = data_dict['metadata']['starting_time']
     ending_time = data_dict['metadata']['ending_time']
 
-    all_trips = [trip for vin in data_dict['finished_trips'] for trip in data_dict['finished_trips'][vin]]
+    trips_table = get_trips_table(data_dict['finished_trips'])
 
     all_known_vins = set()
     all_known_vins.update(data_dict['unfinished_trips'].keys())
@@ -65,21 +127,26 @@ def stats_dict(data_dict):
     all_known_vins.update(data_dict['finished_parkings'].keys())
     all_known_vins.update(data_dict['unstarted_trips'].keys())
 
-    def stats_for_collection(collection, collection_binned, days=1.0, over=False, under=False, most_common_count=10):
+    def stats_for_collection(collection, collection_binned, days=1.0, over=False, under=False, most_common_count=10,
+                             binned_is_int=None):
         """
+        :type collection: numpy.ndarray
+        :type collection_binned: numpy.ndarray
+        :param binned_is_int: numpy.ndarray marking which of collection_binned
+        were integers, if they have been converted to floats
         :type over: list
         :type under: list
         """
 
-        def dataset_count_over(trips, thresholds, is_over=True):
+        def dataset_count_over(sorted_values, thresholds, is_over=True):
             results = []
             for threshold in thresholds:
                 if is_over:
-                    trip_count = len([x for x in trips if x > threshold])
+                    trip_count = len(sorted_values) - np.searchsorted(sorted_values, threshold, side='right')
                 else:
-                    trip_count = len([x for x in trips if x < threshold])
+                    trip_count = np.searchsorted(sorted_values, threshold, side='left')
 
-                results.append((threshold, trip_count))
+                results.append((threshold, int(trip_count)))
 
             return results
 
@@ -89,27 +156,41 @@ def stats_dict(data_dict):
                 quartiles_dict[i] = np.percentile(quartiles_collection, i) / quartiles_days
             return quartiles_dict
 
+        def most_common(values, count, is_int=None):
+            # same as Counter(values).most_common(count),
+            # values with the same count are in the order they are first seen
+            unique, first_indexes, counts = np.unique(values, return_index=True, return_counts=True)
+            order = np.lexsort((first_indexes, -counts))[:count]
+            common_values = unique[order].tolist()
+            if is_int is not None:
+                # like Counter, the value is of the type it was first seen as
+                common_values = [int(value) if value_is_int else value
+                                 for value, value_is_int in zip(common_values, is_int[first_indexes[order]])]
+            return list(zip(common_values, counts[order].tolist()))
+
+        sorted_collection = np.sort(collection)
+
         result = OrderedDict()
         result['count all'] = len(collection)
         result['mean'] = np.mean(collection)
         result['std'] = np.std(collection)
-        quartiles_overall = quartiles(collection, 1.0)
+        quartiles_overall = quartiles(sorted_collection, 1.0)
         result['median'] = quartiles_overall[50]
         result['quartiles'] = quartiles_overall
-        result['most common binned values'] = Counter(collection_binned).most_common(most_common_count)
+        result['most common binned values'] = most_common(collection_binned, most_common_count, binned_is_int)
 
         if days != 1.0:
             days *= 1.0  # make sure it's a decimal
             result['mean per day'] = result['mean'] / days
-            quartiles_per_day = quartiles(collection, days)
+            quartiles_per_day = quartiles(sorted_collection, days)
             result['median per day'] = quartiles_per_day[50]
             result['quartiles per day'] = quartiles_per_day
 
         if over and result['count all'] > 0:
-            result['thresholds over'] = dataset_count_over(collection, over)
+            result['thresholds over'] = dataset_count_over(sorted_collection, over)
 
         if under and result['count all'] > 0:
-            result['thresholds under'] = dataset_count_over(collection, under, is_over=False)
+            result['thresholds under'] = dataset_count_over(sorted_collection, under, is_over=False)
 
         return result
 
@@ -151,71 +232,65 @@ def stats_dict(data_dict):
 
         return result
 
-    def duration(collection):
-        return [coll_trip['duration']/60 for coll_trip in collection]
-
-    def distance(collection):
-        return [coll_trip['distance'] for coll_trip in collection]
-
-    def fuel(collection):
-        return [coll_trip['fuel_use'] for coll_trip in collection]
-
     def collection_round(collection, round_to):
-        return [round_to * int(coll_value * (1.0 / round_to)) for coll_value in collection]
-
-    trips_weird = []
-    trips_good = []
-    trips_refueled = []
-    trip_counts_by_vin = {}
-    for trip in all_trips:
-        # Find and exclude "weird" trips, that are likely to be system errors caused by things like GPS misreads
-        # rather than actual trips.
-        # Not all errors will be caught - sometimes it is impossible to tell. Consequently,
-        # this operates on a best-effort basis, catching some of the most common and obvious problems.
-        # Various "weird" trips like that are somewhat less than 1% of a test dataset (Vancouver, Jan 27 - Feb 3)
-        # and the conditions below catch roughly 50-80% of them.
-        if is_trip_weird(trip):
-            trips_weird.append(trip)
-        else:
-            trips_good.append(trip)
-
-            trip_counts_by_vin[trip['vin']] = trip_counts_by_vin.get(trip['vin'], 0) + 1
-
-            # TODO: also collect short distance but long duration and/or fuel use - these are likely to be round trips.
-            # Some sort of heuristic might have to be developed that establishes ratios of duration/fuel use
-            # that make a trip likely a round trip. Complicating matters is the fact that fuel use is quite unreliable.
-
-            if 'fuel_use' in trip and trip['fuel_use'] < 0:
-                # collect trips that have included a refuel, for use in stats to be added later
-                trips_refueled.append(trip)
-
-    for vin in all_known_vins:
-        # fill in trip count for cars with 0 trips, if any
-        if vin not in trip_counts_by_vin:
-            trip_counts_by_vin[vin] = 0
+        # like int(), astype rounds towards zero. Multiplying integers by
+        # an integer round_to keeps them integers.
+        return (collection * (1.0 / round_to)).astype(np.int64) * round_to
+
+    # Find and exclude "weird" trips, that are likely to be system errors caused by things like GPS misreads
+    # rather than actual trips.
+    # Not all errors will be caught - sometimes it is impossible to tell. Consequently,
+    # this operates on a best-effort basis, catching some of the most common and obvious problems.
+    # Various "weird" trips like that are somewhat less than 1% of a test dataset (Vancouver, Jan 27 - Feb 3)
+    # and the conditions in is_trip_weird catch roughly 50-80% of them.
+    weird_mask = get_weird_trips_mask(trips_table)
+    good_mask = ~weird_mask
+
+    # TODO: also collect short distance but long duration and/or fuel use - these are likely to be round trips.
+    # Some sort of heuristic might have to be developed that establishes ratios of duration/fuel use
+    # that make a trip likely a round trip. Complicating matters is the fact that fuel use is quite unreliable.
+
+    all_trips_count = len(weird_mask)
+    weird_trips_count = int(np.count_nonzero(weird_mask))
+    good_trips_count = all_trips_count - weird_trips_count
+
+    durations = trips_table['duration'] / 60
+    good_durations = durations[good_mask]
+    good_distances = trips_table['distance'][good_mask]
+    good_fuel_uses = trips_table['fuel_use'][good_mask]
+    if 'fuel_use_is_int' in trips_table:
+        good_fuel_uses_is_int = trips_table['fuel_use_is_int'][good_mask]
+    else:
+        good_fuel_uses_is_int = None
+
+    # trip counts for cars with good trips, in the order they are first seen,
+    # then 0 for the rest of the known cars
+    trip_counts = np.bincount(trips_table['vin_index'][good_mask], minlength=len(trips_table['vins']))
+    trip_counts = trip_counts[trip_counts > 0]
+    trips_per_car = np.concatenate((trip_counts,
+                                    np.zeros(len(all_known_vins) - len(trip_counts), dtype=trip_counts.dtype)))
 
     time_elapsed_seconds = (ending_time - starting_time).total_seconds()
     time_elapsed_days = time_elapsed_seconds * 1.0 / (24*60*60)
 
-    time_missing_seconds = len(data_dict['metadata']['missing']) * data_dict['metadata']['time_step']
+    time_step = data_dict['metadata']['time_step']
+    time_missing_seconds = ranges.count(data_dict['metadata']['missing'], time_step) * time_step
     time_missing_ratio = time_missing_seconds * 1.0 / time_elapsed_seconds
 
-    trips_per_car = list(trip_counts_by_vin.values())
-
     stats = OrderedDict()
     stats['starting time'] = starting_time
     stats['ending time'] = ending_time
 
     stats['missing data ratio'] = time_missing_ratio
 
-    stats['total vehicles'] = len(trip_counts_by_vin)
-    stats['total trips'] = len(trips_good)
-    stats['total trips per day'] = len(trips_good) / time_elapsed_days
+    stats['total vehicles'] = len(trips_per_car)
+    stats['total trips'] = good_trips_count
+    stats['total trips per day'] = good_trips_count / time_elapsed_days
 
     stats['time elapsed seconds'] = time_elapsed_seconds
     stats['time elapsed days'] = time_elapsed_days
 
-    stats['utilization ratio'] = sum(duration(trips_good)) / len(trip_counts_by_vin) / (time_elapsed_seconds/60)
+    stats['utilization ratio'] = np.sum(good_durations) / len(trips_per_car) / (time_elapsed_seconds/60)
 
     stats.update(format_stats('trips per car',
                               stats_for_collection(trips_per_car,
@@ -223,17 +298,16 @@ def stats_dict(data_dict):
                                                    time_elapsed_days)))
 
     stats.update(format_stats('distance per trip',
-                              stats_for_collection(distance(trips_good),
-                                                   collection_round(distance(trips_good), 0.5),
+                              stats_for_collection(good_distances,
+                                                   collection_round(good_distances, 0.5),
                                                    over=[5, 10])))
 
     stats.update(format_stats('duration per trip',
-                              stats_for_collection(duration(trips_good),
-                                                   collection_round(duration(trips_good), 5),
+                              stats_for_collection(good_durations,
+                                                   collection_round(good_durations, 5),
                                                    over=[2*60, 5*60, 10*60])))
 
-    parking_durations = duration(trip for vin in data_dict['finished_trips']
-                                 for trip in data_dict['finished_trips'][vin])
+    parking_durations = durations
     stats.update(format_stats('duration per parking',
                               stats_for_collection(parking_durations,
                                                    collection_round(parking_durations, 5),
@@ -244,29 +318,120 @@ def stats_dict(data_dict):
     # - or at least in addition to
 
     stats.update(format_stats('fuel use stats',
-                              stats_for_collection(fuel(trips_good),
-                                                   fuel(trips_good),
+                              stats_for_collection(good_fuel_uses,
+                                                   good_fuel_uses,
                                                    under=[1, 5],
-                                                   over=[1, 5, 10])))
+                                                   over=[1, 5, 10],
+                                                   binned_is_int=good_fuel_uses_is_int)))
 
     # get some stats on weird trips as outlined above
-    if len(trips_weird) > 0:
-        stats['weird trip count'] = len(trips_weird)
-        stats['weird trips per day'] = len(trips_weird) * 1.0 / time_elapsed_days
-        stats['weird trip ratio'] = len(trips_weird) * 1.0 / len(all_trips)
+    if weird_trips_count > 0:
+        weird_durations = durations[weird_mask]
+        weird_distances = trips_table['distance'][weird_mask]
+
+        stats['weird trip count'] = weird_trips_count
+        stats['weird trips per day'] = weird_trips_count * 1.0 / time_elapsed_days
+        stats['weird trip ratio'] = weird_trips_count * 1.0 / all_trips_count
 
         stats.update(format_stats('weird trips duration',
-                                  stats_for_collection(duration(trips_weird),
-                                                       duration(trips_weird))))
+                                  stats_for_collection(weird_durations,
+                                                       weird_durations)))
         stats.update(format_stats('weird trips distance',
-                                  stats_for_collection(distance(trips_weird),
-                                                       collection_round(distance(trips_weird), 0.002),
+                                  stats_for_collection(weird_distances,
+                                                       collection_round(weird_distances, 0.002),
                                                        under=[0.01, 0.02])))
 
     return stats
 
 
-def stats_slice(data_dict, from_time, to_time):
+def _trip_start(trip):
+    return trip['start']['time']
+
+
+def _trip_end(trip):
+    return trip['end']['time']
+
+
+def _parking_start(parking):
+    return parking['starting_time']
+
+
+def _parking_end(parking):
+    return parking['ending_time']
+
+
+def _index_records(records, get_start, get_end):
+    """
+    :return: tuple(starting times, latest ending time up to each record).
+    Records of a VIN are in order, so both lists are sorted and can be
+    searched with bisect. The latest ending time is used rather than
+    the record's own so that the list is sorted even if records overlap.
+    """
+
+    starts = []
+    latest_ends = []
+    latest_end = None
+    for record in records:
+        starts.append(get_start(record))
+        end = get_end(record)
+        if latest_end is None or end > latest_end:
+            latest_end = end
+        latest_ends.append(latest_end)
+
+    return starts, latest_ends
+
+
+def build_time_index(data_dict):
+    """
+    Index finished trips and parkings by time, for stats_slice to find
+    those in a time range without looking at all of them.
+    Build it once and pass it to each stats_slice of the same data_dict.
+    """
+
+    return {
+        'finished_trips': {vin: _index_records(trips, _trip_start, _trip_end)
+                           for vin, trips in data_dict['finished_trips'].items()},
+        'finished_parkings': {vin: _index_records(parkings, _parking_start, _parking_end)
+                              for vin, parkings in data_dict['finished_parkings'].items()}
+    }
+
+
+def _is_in_slice(start, end, from_time, to_time):
+    # normal records, within the slice
+    return ((from_time <= start <= end <= to_time)
+
+            # records spanning from_time
+            or (start < from_time < end < to_time)
+
+            # records spanning to_time
+            or (from_time < start < to_time < end)
+
+            # records spanning the whole slice from from_time to to_time
+            or (start < from_time and end > to_time))
+
+
+def _slice_records(records_by_vin, index_by_vin, from_time, to_time, get_start, get_end):
+    sliced = {}
+
+    for vin, records in records_by_vin.items():
+        starts, latest_ends = index_by_vin[vin]
+
+        # records before `first` end before from_time,
+        # and records from `last` on start after to_time
+        first = bisect.bisect_left(latest_ends, from_time)
+        last = bisect.bisect_right(starts, to_time)
+
+        vin_records = [record for record in records[first:last]
+                       if _is_in_slice(get_start(record), get_end(record), from_time, to_time)]
+
+        # filter out cars with no records
+        if vin_records:
+            sliced[vin] = vin_records
+
+    return sliced
+
+
+def stats_slice(data_dict, from_time, to_time, time_index=None):
     """
     Get a slice of data_dict containing only activity between
     from_time and to_time.
@@ -281,83 +446,68 @@ def stats_slice(data_dict, from_time, to_time):
     This is necessarily slightly imprecise, for instance cut-off
     parts of trips can be getting classified as mini weird trips.
     However, accuracy for utilization ratio is well under 1%.
+
+    :param time_index: result of build_time_index(data_dict), built here
+    if not provided. When slicing the same data_dict many times, build it
+    once and pass it in.
     """
 
+    if time_index is None:
+        time_index = build_time_index(data_dict)
+
     result_dict = {
-        'finished_trips': {},
-        'finished_parkings': {},
+        'finished_trips': _slice_records(data_dict['finished_trips'], time_index['finished_trips'],
+                                         from_time, to_time, _trip_start, _trip_end),
+        'finished_parkings': _slice_records(data_dict['finished_parkings'], time_index['finished_parkings'],
+                                            from_time, to_time, _parking_start, _parking_end),
         'unfinished_trips': {},
         'unfinished_parkings': {},
         'unstarted_trips': {},
         'metadata': dict.copy(data_dict['metadata'])
     }
 
-    for vin in data_dict['finished_trips']:
-        # first do the rough filtering
-        # use dict.copy to avoid changing trip durations in the passed-by-reference data_dict
-        trips = [dict.copy(trip) for trip in data_dict['finished_trips'][vin]
-                 # normal trips, within the day
-                 if (from_time <= trip['start']['time'] <= trip['end']['time'] <= to_time)
-
-                 # trips spanning starting_time
-                 or (trip['start']['time'] < from_time < trip['end']['time'] < to_time)
-
-                 # trips spanning starting_time
-                 or (from_time < trip['start']['time'] < to_time < trip['end']['time'])
-
-                 # trips spanning whole day from from_time to to_time
-                 or (trip['start']['time'] < from_time and trip['end']['time'] > to_time)]
-
-        # then trim off ends of trips that straddle dataset borders (either from_time
-        # or to_time).
-        # this will hit on accuracy of trip duration statistics, but improve
-        # accuracy of utilization ratio calculation.
-        # need to only look at first_trip and last_trip in the newly filtered list
-        # because by definition only one trip each will straddle from_time and to_time.
-        if len(trips):
-            first_trip = trips[0]
-            if first_trip['start']['time'] < from_time:
-                first_trip['start']['time'] = from_time
-                first_trip['duration'] = (first_trip['end']['time'] - from_time).total_seconds()
-                # not recalculating speed since it'll be pretty meaningless on the changed duration
-
-            last_trip = trips[-1]
-            if last_trip['end']['time'] > to_time:
-                last_trip['end']['time'] = to_time
-                last_trip['duration'] = (to_time - last_trip['start']['time']).total_seconds()
-
-        result_dict['finished_trips'][vin] = trips
-
-    # filter out cars with no trips
-    result_dict['finished_trips'] = {vin: trips for vin, trips in result_dict['finished_trips'].items()
-                                     if len(trips) > 0}
-
-    for vin in data_dict['finished_parkings']:
-        # first do the rough filtering
-        # see comments for finished_trips filter above for reasoning
-        parks = [dict.copy(park) for park in data_dict['finished_parkings'][vin]
-                 if (from_time <= park['starting_time'] <= park['ending_time'] <= to_time)
-                 or (park['starting_time'] < from_time < park['ending_time'] < to_time)
-                 or (from_time < park['starting_time'] < to_time < park['ending_time'])
-                 or (park['starting_time'] < from_time and park['ending_time'] > to_time)]
-
-        # trim off ends as for finished_trips
-        if len(parks):
-            first_park = parks[0]
-            if first_park['starting_time'] < from_time:
-                first_park['starting_time'] = from_time
-                first_park['duration'] = (first_park['ending_time'] - from_time).total_seconds()
-
-            last_park = parks[-1]
-            if last_park['ending_time'] > to_time:
-                last_park['ending_time'] = to_time
-                last_park['duration'] = (to_time - last_park['starting_time']).total_seconds()
-
-        result_dict['finished_parkings'][vin] = parks
-
-    # filter out cars with no parkings
-    result_dict['finished_parkings'] = {vin: parkings for vin, parkings in result_dict['finished_parkings'].items()
-                                        if len(parkings) > 0}
+    # Trim off ends of trips that straddle dataset borders (either from_time
+    # or to_time).
+    # this will hit on accuracy of trip duration statistics, but improve
+    # accuracy of utilization ratio calculation.
+    # need to only look at first_trip and last_trip in the filtered list
+    # because by definition only one trip each will straddle from_time and to_time.
+    # Only those are copied, along with the start or end being changed,
+    # to avoid changing trip times and durations in the passed-by-reference
+    # data_dict. The rest are shared with data_dict.
+    for trips in result_dict['finished_trips'].values():
+        first_trip = trips[0]
+        if first_trip['start']['time'] < from_time:
+            first_trip = first_trip.copy()
+            first_trip['start'] = first_trip['start'].copy()
+            first_trip['start']['time'] = from_time
+            first_trip['duration'] = (first_trip['end']['time'] - from_time).total_seconds()
+            # not recalculating speed since it'll be pretty meaningless on the changed duration
+            trips[0] = first_trip
+
+        last_trip = trips[-1]
+        if last_trip['end']['time'] > to_time:
+            last_trip = last_trip.copy()
+            last_trip['end'] = last_trip['end'].copy()
+            last_trip['end']['time'] = to_time
+            last_trip['duration'] = (to_time - last_trip['start']['time']).total_seconds()
+            trips[-1] = last_trip
+
+    # trim off ends as for finished_trips
+    for parks in result_dict['finished_parkings'].values():
+        first_park = parks[0]
+        if first_park['starting_time'] < from_time:
+            first_park = first_park.copy()
+            first_park['starting_time'] = from_time
+            first_park['duration'] = (first_park['ending_time'] - from_time).total_seconds()
+            parks[0] = first_park
+
+        last_park = parks[-1]
+        if last_park['ending_time'] > to_time:
+            last_park = last_park.copy()
+            last_park['ending_time'] = to_time
+            last_park['duration'] = (to_time - last_park['starting_time']).total_seconds()
+            parks[-1] = last_park
 
     # TODO: should we add unfinished into finished, trimming them?
     # to_time is already non-inclusive (e.g. from_time being 04:00, to_time will be 03:59),
@@ -379,11 +529,11 @@ def stats_slice(data_dict, from_time, to_time):
     result_dict['metadata']['ending_time'] = to_time
 
     # adjust missing data points
-    # note that the list comp implicitly does a copy of the `missing` list, which is good,
+    # note that clip returns a new list, which is good,
     # because we need the original missing list for next iterations
-    result_dict['metadata']['missing'] = [missing_datetime for missing_datetime
-                                          in data_dict['metadata']['missing']
-                                          if from_time <= missing_datetime < to_time]
+    result_dict['metadata']['missing'] = ranges.clip(data_dict['metadata']['missing'],
+                                                     from_time, to_time,
+                                                     data_dict['metadata']['time_step'])
 
     # TODO: there is a bug here somewhere:
     # analysing the same time period from two differently-cut datasets gives different results.
@@ -431,6 +581,10 @@ def stats(data_dict, output_file, tz_offset):
     # Next, create slices of data_dict containing a day's and week's
     # (where available) data to get more detailed statistics automatically
 
+    # slices are found with an index built once, rather than
+    # by looking at all trips and parkings for each slice
+    time_index = build_time_index(data_dict)
+
     time_step = timedelta(seconds=data_dict['metadata']['time_step'])
     slice_time = data_dict['metadata']['starting_time'] - time_step
 
@@ -448,7 +602,7 @@ def stats(data_dict, output_file, tz_offset):
         # during the data period, as the highest car count during the data period will be used
         # for all slices
         if one_day_from_time >= data_dict['metadata']['starting_time']:
-            sliced_dict = stats_slice(data_dict, one_day_from_time, slice_time)
+            sliced_dict = stats_slice(data_dict, one_day_from_time, slice_time, time_index)
 
             result = repr_floats(stats_dict(sliced_dict))
 
@@ -456,7 +610,7 @@ def stats(data_dict, output_file, tz_offset):
 
         seven_days_from_time = slice_time - timedelta(days=7) + time_step
         if seven_days_from_time >= data_dict['metadata']['starting_time']:
-            sliced_dict = stats_slice(data_dict, seven_days_from_time, slice_time)
+            sliced_dict = stats_slice(data_dict, seven_days_from_time, slice_time, time_index)
 
             result = repr_floats(stats_dict(sliced_dict))
 
@@ -0,0 +1,230 @@
+# coding=utf-8
+
+"""
+Generates archives of made-up data points in a system's raw API format,
+for benchmarking with more data than the samples in tests.py have.
+
+Cars park at random positions within the city's bounds and go on trips
+at a given rate. Each data point is built like generate.build_obj does,
+with the system parser's put_car and put_cars, so only systems with those
+are supported. The same parameters and seed always give the same archive.
+"""
+
+import copy
+import datetime
+import gzip
+import io
+import os
+import random
+import tarfile
+import zipfile
+
+from . import jsonbackend
+from .. import files, systems
+
+
+# used for cities without BOUNDS
+DEFAULT_BOUNDS = {'NORTH': 0.1, 'SOUTH': 0.0, 'EAST': 0.1, 'WEST': 0.0}
+
+# trip duration range, in seconds
+TRIP_DURATION = (5 * 60, 45 * 60)
+
+# cars with less fuel than this are charged or refueled after their next trip
+REFUEL_LEVEL = 25
+
+STREETS = ['Main', 'Oak', 'Granville', 'Cambie', 'Fraser', 'Victoria', 'Nanaimo',
+           'Hastings', 'Broadway', 'King Edward', 'Kingsway', 'Commercial']
+
+
+def _car2go_properties(rng, index):
+    return {
+        'license_plate': 'BC {:04d}'.format(index),
+        'fuel_type': 'ED',
+        'electric': True,
+        'app_required': False,
+        'cleanliness_interior': rng.choice(['GOOD', 'GOOD', 'UNACCEPTABLE']),
+        'cleanliness_exterior': rng.choice(['GOOD', 'GOOD', 'UNACCEPTABLE'])
+    }
+
+
+def _drivenow_properties(rng, index):
+    return {
+        'name': 'Car {}'.format(index),
+        'license_plate': 'M-DN {:04d}'.format(index),
+        'model': 'MINI',
+        'color': rng.choice(['midnight_black', 'pepper_white']),
+        'fuel_type': 'P',
+        'electric': False,
+        'transmission': 'A',
+        'rentalPrice': {'paidReservationPrice': {'amount': 0.15},
+                        'isOfferDrivePriceActive': False},
+        'make': 'BMW',
+        'group': 'MINI',
+        'series': 'MINI',
+        'modelIdentifier': 'mini',
+        'equipment': [],
+        'carImageUrl': 'https://de.drive-now.com/static/drivenow/img/cars/{model}/{color}/{density}.png',
+        'carImageBaseUrl': 'https://de.drive-now.com/static/drivenow/img/cars/',
+        'routingModelName': 'MINI',
+        'variant': 'COOPER',
+        'isPreheatable': False,
+        'api_estimated_range': 150,
+        'cleanliness_interior': 'CLEAN',
+        'parkingSpaceId': None,
+        'isInParkingSpace': False,
+        'price_offer': False,
+        'price_offer_details': {}
+    }
+
+
+# properties of cars that stay the same, by system. The simulation
+# adds lat, lng, fuel, address and charging.
+CAR_PROPERTIES = {
+    'car2go': _car2go_properties,
+    'drivenow': _drivenow_properties
+}
+
+# what put_cars needs from result_dict['system']
+SYSTEM_INFO = {
+    'car2go': {},
+    'drivenow': {'cars': {}}
+}
+
+
+def _random_position(rng, bounds):
+    return (round(rng.uniform(bounds['SOUTH'], bounds['NORTH']), 6),
+            round(rng.uniform(bounds['WEST'], bounds['EAST']), 6))
+
+
+def _address(rng):
+    return '{} {} St'.format(rng.randint(1, 4000), rng.choice(STREETS))
+
+
+def iter_data_points(system='car2go', city='vancouver',
+                     starting_time=datetime.datetime(2016, 2, 9), duration=datetime.timedelta(days=1),
+                     time_step=60, fleet_size=500, trip_rate=5, missing_rate=0.01, seed=0):
+    """
+    :param duration: timedelta, data points are made from starting_time
+    up to but not including starting_time + duration
+    :param fleet_size: number of cars
+    :param trip_rate: average number of trips per car per day
+    :param missing_rate: chance of each data point being missing.
+    Data points at a whole hour are never missing, so that any hour
+    of the archive can be normalized on its own.
+    :param seed: seed for the random number generator
+    :return: iterator of tuple(data_time, bytes), with bytes being None
+    for missing data points
+    """
+
+    if system not in CAR_PROPERTIES:
+        raise ValueError('Making synthetic data for system "{system}" is not supported'
+                         .format(system=system))
+
+    parser = systems.get_parser(system)
+    city_data = systems.get_city_by_name(system, city)
+    bounds = city_data.get('BOUNDS', DEFAULT_BOUNDS)
+
+    rng = random.Random(seed)
+
+    # chance that a parked car starts a trip in a given data point
+    trip_chance = trip_rate * time_step / 86400.0
+
+    cars = []
+    for index in range(fleet_size):
+        car = CAR_PROPERTIES[system](rng, index)
+        car['vin'] = 'SYN{:014d}'.format(index)
+        car['lat'], car['lng'] = _random_position(rng, bounds)
+        car['address'] = _address(rng)
+        car['fuel'] = rng.randint(REFUEL_LEVEL, 100)
+        car['charging'] = False
+        cars.append({'car': car, 'trip_end': None})
+
+    # put_cars can change result_dict['system'], so don't use SYSTEM_INFO directly
+    result_dict = {'system': copy.deepcopy(SYSTEM_INFO[system])}
+
+    step = datetime.timedelta(seconds=time_step)
+    t = starting_time
+    while t < starting_time + duration:
+        available_cars = []
+        for state in cars:
+            car = state['car']
+
+            if state['trip_end'] is not None:
+                if t < state['trip_end']:
+                    continue
+
+                # trip ended, park somewhere else
+                state['trip_end'] = None
+                car['lat'], car['lng'] = _random_position(rng, bounds)
+                car['address'] = _address(rng)
+                car['fuel'] = max(car['fuel'] - rng.randint(1, 10), 0)
+                car['charging'] = car['electric'] and car['fuel'] < REFUEL_LEVEL
+                if not car['electric'] and car['fuel'] < REFUEL_LEVEL:
+                    car['fuel'] = 100
+
+            elif rng.random() < trip_chance:
+                state['trip_end'] = t + datetime.timedelta(seconds=rng.randint(*TRIP_DURATION))
+                continue
+
+            elif car['charging']:
+                # changes data during the parking, see get_car_parking_drift
+                car['fuel'] = min(car['fuel'] + 1, 100)
+                car['charging'] = car['fuel'] < 100
+
+            available_cars.append(parser.put_car(car))
+
+        is_missing = (t.minute or t.second) and rng.random() < missing_rate
+        if is_missing:
+            yield t, None
+        else:
+            data = parser.put_cars(available_cars, result_dict)
+            yield t, jsonbackend.json.dumps(data).encode('utf-8')
+
+        t += step
+
+
+def write_archive(filename, system='car2go', city='vancouver', **kwargs):
+    """
+    Writes an archive of synthetic data points, see iter_data_points
+    for the keyword arguments. The format follows from filename,
+    like for Electric2goDataArchive: .tgz, .zip, or a directory if
+    filename ends in a slash.
+    :return: number of data points written
+    """
+
+    data_points = ((t, data) for t, data in iter_data_points(system, city, **kwargs)
+                   if data is not None)
+
+    count = 0
+
+    if filename.endswith(os.path.sep):
+        if not os.path.exists(filename):
+            os.makedirs(filename)
+
+        for t, data in data_points:
+            with open(os.path.join(filename, files.get_file_name(city, t)), 'wb') as f:
+                f.write(data)
+            count += 1
+
+    elif filename.endswith('.zip'):
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for t, data in data_points:
+                zipinfo = zipfile.ZipInfo(files.get_file_name(city, t), t.timetuple()[:6])
+                zipinfo.compress_type = zipfile.ZIP_DEFLATED
+                archive.writestr(zipinfo, data)
+                count += 1
+
+    else:
+        # set gzip's timestamp so that the same data gives the same file
+        with open(filename, 'wb') as f:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0) as gz:
+                archive = tarfile.open(fileobj=gz, mode='w')
+                for t, data in data_points:
+                    tarinfo = tarfile.TarInfo(files.get_file_name(city, t))
+                    tarinfo.size = len(data)
+                    tarinfo.mtime = (t - datetime.datetime(1970, 1, 1)).total_seconds()
+                    archive.addfile(tarinfo, io.BytesIO(data))
+                    count += 1
+                archive.close()
+
+    return count
@@ -100,8 +100,21 @@ def get_current(city_data, max_cache_age):
     return api_text, cache
 
 
-def save(requested_system, requested_city, should_archive):
+def save(requested_system, requested_city, should_archive, should_normalize=False):
+    """
+    :param should_normalize: if True, also add each city's data point
+    to its online result_dict, see analysis.online
+    :return: tuple(time, failures, normalize_failures). failures lists
+    (system, city) of cities that couldn't be downloaded or saved,
+    normalize_failures those that were saved but couldn't be normalized.
+    """
+
     failures = []
+    normalize_failures = []
+
+    if should_normalize:
+        # import here as analysis code is not otherwise needed for downloading
+        from .analysis import online
 
     if requested_city == 'all':
         all_cities = systems.get_all_cities(requested_system)
@@ -119,7 +132,15 @@ def save(requested_system, requested_city, should_archive):
             # bypass cities that fail (like Ulm did in 2015-01) without killing whole script
             failures.append((city['system'], city['name']))
             continue
+
+        if should_normalize:
+            try:
+                online.update_city(city, t)
+            except Exception:
+                # the data point is saved, it can still be normalized
+                # later from the archive
+                normalize_failures.append((city['system'], city['name']))
     if session:
         session.close()
 
-    return t, failures
+    return t, failures, normalize_failures
@@ -126,7 +126,7 @@ def put_cars(cars, result_dict):
 def put_car(car):
     # inverse of get_car
 
-    mapped_keys = KEYS['unchanging']
+    mapped_keys = dict(KEYS['unchanging'])
     mapped_keys.update(KEYS['changing'])
 
     formatted_car = {original_key: car[mapped_key]
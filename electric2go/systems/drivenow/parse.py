@@ -78,8 +78,10 @@ def get_everything_except_cars(system_data_dict):
     result = system_data_dict.copy()
 
     # like `del result['cars']['items']`, except don't error
-    # when either of those keys are not there
+    # when either of those keys are not there. Copy result['cars'] first
+    # so that the cars aren't removed from system_data_dict as well.
     if 'cars' in result:
+        result['cars'] = result['cars'].copy()
         result['cars'].pop('items', None)
 
     return result
@@ -167,7 +169,7 @@ def put_cars(cars, result_dict):
 def put_car(car):
     # inverse of get_car
 
-    mapped_keys = KEYS['unchanging']
+    mapped_keys = dict(KEYS['unchanging'])
     mapped_keys.update(KEYS['changing'])
 
     formatted_car = {original_key: car[mapped_key]
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+from __future__ import print_function
+import argparse
+import codecs
+import copy
+import datetime
+import gc
+import io
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+from collections import defaultdict
+
+# ask script to look for the electric2go package in one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from electric2go import files
+from electric2go.analysis import cmdline, jsonbackend, normalize, records
+
+
+def load_raw_frames(filename, frame_limit):
+    city = files.get_city_from_filename(os.path.split(filename)[1])
+    data_archive = normalize.Electric2goDataArchive(city, filename)
+
+    raw_frames = []
+    for t, raw_data in data_archive.iter_raw_data_points(
+            data_archive.first_file_time, data_archive.last_file_time, 60):
+        # only benchmark valid data points
+        if normalize.parse_data_point(raw_data):
+            raw_frames.append(raw_data)
+        if len(raw_frames) >= frame_limit:
+            break
+
+    data_archive.close()
+
+    return raw_frames
+
+
+def benchmark_json(args):
+    if not os.path.exists(args.archive):
+        sys.exit('file not found: ' + args.archive)
+
+    raw_frames = load_raw_frames(args.archive, args.frames)
+    if not raw_frames:
+        sys.exit('no data points found in ' + args.archive)
+
+    def parse_with_codecs_reader():
+        # how archive loaders used to parse data files, for comparison
+        reader = codecs.getreader('utf-8')
+        for raw_data in raw_frames:
+            jsonbackend.json.load(reader(io.BytesIO(raw_data)))
+
+    def parse_with_backend(backend):
+        def parse():
+            for raw_data in raw_frames:
+                backend.loads(raw_data)
+        return parse
+
+    candidates = [('json with codecs reader', parse_with_codecs_reader)]
+    for name in jsonbackend.available_backends():
+        candidates.append((name, parse_with_backend(jsonbackend.get_backend(name))))
+
+    print('{count} data points, average {size:.0f} bytes'.format(
+        count=len(raw_frames), size=sum(len(r) for r in raw_frames) / len(raw_frames)))
+    print('{:<25} {:>14} {:>14}'.format('backend', 'ms per point', 'points per s'))
+
+    for name, function in candidates:
+        # best of several repeats to reduce noise
+        seconds = min(timeit.repeat(function, number=1, repeat=args.repeat))
+        per_frame = seconds / len(raw_frames)
+        print('{:<25} {:>14.3f} {:>14.1f}'.format(name, per_frame * 1000, 1 / per_frame))
+
+
+def benchmark_engine(args):
+    if not os.path.exists(args.archive):
+        sys.exit('file not found: ' + args.archive)
+
+    # import here so that numpy is only needed for this benchmark
+    from electric2go.analysis import framediff
+
+    parser = normalize.get_parser(args.system)
+
+    frames = []
+    for raw_data in load_raw_frames(args.archive, args.frames):
+        available_cars = parser.get_cars(normalize.parse_data_point(raw_data))
+        if available_cars:
+            frames.append(list(available_cars))
+    if not frames:
+        sys.exit('no data points found in ' + args.archive)
+
+    def process_with(engine):
+        def process():
+            if engine == 'framediff':
+                process_data = framediff.FrameDiffEngine().process_data
+            else:
+                process_data = normalize.process_data
+
+            # only the parts of result_dict that process_data uses
+            result_dict = {
+                'unfinished_trips': {},
+                'unfinished_parkings': {},
+                'finished_trips': defaultdict(list),
+                'finished_parkings': defaultdict(list),
+                'unstarted_trips': {},
+                'vehicles': defaultdict(dict)
+            }
+
+            # data point times only matter for the results, not for speed
+            prev_t = t = datetime.datetime(2016, 1, 1)
+            for available_cars in frames:
+                process_data(parser, t, prev_t, available_cars, result_dict)
+                prev_t = t
+                t += datetime.timedelta(minutes=1)
+        return process
+
+    print('{count} data points, average {cars:.0f} cars'.format(
+        count=len(frames), cars=sum(len(f) for f in frames) / len(frames)))
+    print('{:<25} {:>14} {:>14}'.format('engine', 'ms per point', 'points per s'))
+
+    for engine in ('simple', 'framediff'):
+        seconds = min(timeit.repeat(process_with(engine), number=1, repeat=args.repeat))
+        per_frame = seconds / len(frames)
+        print('{:<25} {:>14.3f} {:>14.1f}'.format(engine, per_frame * 1000, 1 / per_frame))
+
+
+def _records_to_dicts(result_dict):
+    # the form trips and parkings were kept in before records.py
+    def to_dict(record):
+        data = dict(record)
+        for key in ('start', 'end'):
+            if isinstance(data.get(key), records.Record):
+                data[key] = dict(data[key])
+        return data
+
+    for key in ('finished_trips', 'finished_parkings'):
+        for vin_list in result_dict[key].values():
+            vin_list[:] = [to_dict(item) for item in vin_list]
+
+    for key in ('unfinished_trips', 'unfinished_parkings', 'unstarted_trips'):
+        items = result_dict[key]
+        for vin in items:
+            items[vin] = to_dict(items[vin])
+
+
+def _import_tracemalloc():
+    try:
+        import tracemalloc
+    except ImportError:
+        sys.exit('tracemalloc is needed, it is available in Python 3.4 and later')
+
+    return tracemalloc
+
+
+def benchmark_memory(args):
+    tracemalloc = _import_tracemalloc()
+
+    if not os.path.exists(args.result_dict):
+        sys.exit('file not found: ' + args.result_dict)
+
+    def measure():
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0]
+
+    def load():
+        with open(args.result_dict, 'rb') as f:
+            return cmdline.read_json(f)
+
+    tracemalloc.start()
+    baseline = measure()
+
+    result_dict = load()
+    interned_records = measure() - baseline
+    del result_dict
+
+    # load again without interning strings, as they were before
+    intern_string = records.intern_string
+    records.intern_string = lambda value: value
+    try:
+        result_dict = load()
+    finally:
+        records.intern_string = intern_string
+    as_records = measure() - baseline
+
+    # convert in place, so that everything else in result_dict is shared
+    _records_to_dicts(result_dict)
+    as_dicts = measure() - baseline
+
+    tracemalloc.stop()
+
+    trip_count = sum(len(trips) for trips in result_dict['finished_trips'].values())
+    parking_count = sum(len(parkings) for parkings in result_dict['finished_parkings'].values())
+
+    print('{trips} finished trips, {parkings} finished parkings'.format(
+        trips=trip_count, parkings=parking_count))
+    print('{:<25} {:>14}'.format('form', 'MB in memory'))
+    for name, size in (('dicts', as_dicts), ('records', as_records),
+                       ('records, interned', interned_records)):
+        print('{:<25} {:>14.1f}'.format(name, size / 1024.0 / 1024))
+
+
+def _time_and_trace(function, setup, repeat):
+    """
+    :param setup: called before each run of function, not timed.
+    :return: tuple(seconds for the fastest run, peak memory allocated in bytes)
+    """
+
+    tracemalloc = _import_tracemalloc()
+
+    seconds = []
+    for _ in range(repeat):
+        setup_args = setup()
+        start = timeit.default_timer()
+        function(*setup_args)
+        seconds.append(timeit.default_timer() - start)
+
+    # tracing memory slows things down, so measure it in a separate run
+    setup_args = setup()
+    gc.collect()
+    tracemalloc.start()
+    function(*setup_args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(seconds), peak
+
+
+def benchmark_suite(args):
+    # fail before doing anything, _time_and_trace needs it
+    _import_tracemalloc()
+
+    # import here so that numpy and matplotlib are only needed for this benchmark
+    from electric2go.analysis import generate, graph, merge, stats, synthetic
+
+    starting_time = datetime.datetime(2016, 2, 9)
+    duration = datetime.timedelta(hours=args.hours)
+    time_step = 60
+    data_point_count = int(duration.total_seconds() // time_step)
+
+    print('{:<8} {:<15} {:>10} {:>14} {:>14}'.format(
+        'cars', 'benchmark', 'seconds', 'items per s', 'peak MB'))
+
+    for fleet_size in args.sizes:
+        temp_dir = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(temp_dir, '{city}_{t:%Y-%m-%d}.tgz'.format(
+                city=args.city, t=starting_time))
+            synthetic.write_archive(archive, args.system, args.city,
+                                    starting_time=starting_time, duration=duration,
+                                    time_step=time_step, fleet_size=fleet_size,
+                                    trip_rate=args.trip_rate, missing_rate=args.missing_rate,
+                                    seed=args.seed)
+
+            def load(first, last):
+                return normalize.batch_load_data(args.system, archive, first, last, time_step)
+
+            result_dict = load(None, None)
+
+            # hourly result_dicts to merge, like daily ones would be for longer periods
+            hour = datetime.timedelta(hours=1)
+            step = datetime.timedelta(seconds=time_step)
+            hourly = [load(starting_time + i * hour, starting_time + (i + 1) * hour - step)
+                      for i in range(int(args.hours))]
+
+            trip_count = sum(len(trips) for trips in result_dict['finished_trips'].values())
+            parking_count = sum(len(parkings) for parkings in result_dict['finished_parkings'].values())
+
+            output_dir = os.path.join(temp_dir, 'generated')
+            os.mkdir(output_dir)
+            image = os.path.join(temp_dir, 'graph.png')
+
+            # name, function, setup, item count
+            benchmarks = [
+                ('normalize', load, lambda: (None, None), data_point_count),
+                ('merge', merge.merge_all_dicts, lambda: (copy.deepcopy(hourly),),
+                 trip_count + parking_count),
+                ('stats', stats.stats_dict, lambda: (result_dict,), trip_count),
+                ('generate', generate.write_files, lambda: (result_dict, output_dir),
+                 data_point_count),
+                ('graph positions', graph.make_positions_graph,
+                 lambda: (result_dict, image, '.'), parking_count),
+                ('graph trips', graph.make_trips_graph, lambda: (result_dict, image), trip_count)
+            ]
+
+            for name, function, setup, item_count in benchmarks:
+                seconds, peak = _time_and_trace(function, setup, args.repeat)
+                print('{:<8} {:<15} {:>10.3f} {:>14.1f} {:>14.1f}'.format(
+                    fleet_size, name, seconds, item_count / seconds, peak / 1024.0 / 1024))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+def process_commandline():
+    parser = argparse.ArgumentParser(description='benchmarks for electric2go')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    json_parser = subparsers.add_parser(
+        'json', help='time parsing of data points with each available JSON backend')
+    json_parser.add_argument('archive', type=str,
+                             help='archive of data files to use')
+    json_parser.add_argument('-n', '--frames', type=int, default=200,
+                             help='number of data points to parse (default 200)')
+    json_parser.add_argument('-r', '--repeat', type=int, default=3,
+                             help='repeat each measurement REPEAT times '
+                                  'and use the best (default 3)')
+    json_parser.set_defaults(function=benchmark_json)
+
+    engine_parser = subparsers.add_parser(
+        'engine', help='time processing of data points with each normalize engine')
+    engine_parser.add_argument('system', type=str,
+                               help='system the archive is from (e.g. car2go)')
+    engine_parser.add_argument('archive', type=str,
+                               help='archive of data files to use')
+    engine_parser.add_argument('-n', '--frames', type=int, default=1000,
+                               help='number of data points to process (default 1000)')
+    engine_parser.add_argument('-r', '--repeat', type=int, default=3,
+                               help='repeat each measurement REPEAT times '
+                                    'and use the best (default 3)')
+    engine_parser.set_defaults(function=benchmark_engine)
+
+    memory_parser = subparsers.add_parser(
+        'memory', help='compare memory used by a result_dict with trips and parkings '
+                       'kept as records and as dicts, and with and without interned strings')
+    memory_parser.add_argument('result_dict', type=str,
+                               help='result_dict JSON file, as written by normalize.py')
+    memory_parser.set_defaults(function=benchmark_memory)
+
+    suite_parser = subparsers.add_parser(
+        'suite', help='time normalize, merge, stats, generate and graph on synthetic data '
+                      'with several fleet sizes, see scripts/synthetic.py')
+    suite_parser.add_argument('--system', type=str, default='car2go',
+                              help='system whose data format to use (default car2go)')
+    suite_parser.add_argument('--city', type=str, default='vancouver',
+                              help='city to use (default vancouver)')
+    suite_parser.add_argument('--sizes', type=int, nargs='+', default=[100, 400, 1600],
+                              help='fleet sizes to run benchmarks with (default 100 400 1600)')
+    suite_parser.add_argument('--hours', type=int, default=6,
+                              help='hours of data (default 6)')
+    suite_parser.add_argument('--trip-rate', type=float, default=5,
+                              help='average trips per car per day (default 5)')
+    suite_parser.add_argument('--missing-rate', type=float, default=0.01,
+                              help='chance of each data point being missing (default 0.01)')
+    suite_parser.add_argument('--seed', type=int, default=0,
+                              help='random seed (default 0)')
+    suite_parser.add_argument('-r', '--repeat', type=int, default=1,
+                              help='repeat each measurement REPEAT times '
+                                   'and use the best (default 1)')
+    suite_parser.set_defaults(function=benchmark_suite)
+
+    args = parser.parse_args()
+
+    args.function(args)
+
+
+if __name__ == '__main__':
+    process_commandline()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+
+# ask script to look for the electric2go package in one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from electric2go import files
+from electric2go.analysis import catalog, cmdline
+
+
+def process_commandline():
+    parser = argparse.ArgumentParser(
+        description='list normalized data files by system, city and time range, '
+                    'and find gaps and overlaps between them. Only the files\' '
+                    'metadata is read')
+    parser.add_argument('paths', type=str, nargs='+',
+                        help='normalized data files, or directories of them')
+    parser.add_argument('--system', type=str,
+                        help='only list files of this system')
+    parser.add_argument('--city', type=str,
+                        help='only list files of this city')
+    parser.add_argument('-st', '--starting-time', type=str,
+                        help='only list files with data at or after this time; '
+                             'format YYYY-mm-DD--HH-MM')
+    parser.add_argument('-et', '--ending-time', type=str,
+                        help='only list files with data at or before this time; '
+                             'format YYYY-mm-DD--HH-MM')
+    parser.add_argument('--json', action='store_true',
+                        help='print the catalog as JSON')
+    args = parser.parse_args()
+
+    for name in ('starting_time', 'ending_time'):
+        value = getattr(args, name)
+        if value:
+            try:
+                setattr(args, name, files.parse_date(value))
+            except ValueError:
+                sys.exit('time format not recognized: ' + value)
+
+    entries = catalog.catalog_paths(args.paths)
+    entries = [entry for entry in entries
+               if (not args.system or entry['system'] == args.system)
+               and (not args.city or entry['city'] == args.city)]
+    entries = catalog.select_time_range(catalog.sort_entries(entries),
+                                        args.starting_time, args.ending_time)
+
+    if args.json:
+        cmdline.write_json(entries, indent=2)
+        return
+
+    previous = None
+    for entry in entries:
+        if previous and (previous['system'], previous['city']) == (entry['system'], entry['city']):
+            for problem, _, _ in catalog.find_problems([previous, entry]):
+                print('  ' + problem)
+
+        print('{system:<10} {city:<15} {starting_time:%Y-%m-%d %H:%M} '
+              '{ending_time:%Y-%m-%d %H:%M}  {filename}'.format(**entry))
+
+        previous = entry
+
+
+if __name__ == '__main__':
+    process_commandline()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+
+# ask script to look for the electric2go package in one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from electric2go.analysis import cmdline, dataset
+
+
+def process_commandline():
+    parser = argparse.ArgumentParser(
+        description='convert normalized data into a dataset directory, which '
+                    'graph.py, stats.py, and video.py can read with --dataset '
+                    'without loading all of it into memory')
+    parser.add_argument('directory', type=str,
+                        help='dataset directory to create')
+    parser.add_argument('files', type=str, nargs='*',
+                        help='normalized files in time order, to be merged like '
+                             'merge.py does. Only about as much memory as the largest '
+                             'file needs is used. If none are given, reads normalized '
+                             'data from standard input, all of which is loaded into memory')
+
+    args = parser.parse_args()
+
+    if os.path.exists(args.directory) and os.listdir(args.directory):
+        sys.exit('directory is not empty: ' + args.directory)
+
+    if args.files:
+        dataset.write_dataset_from_files(args.files, args.directory)
+    else:
+        result_dict = cmdline.read_json()
+        dataset.write_dataset(result_dict, args.directory)
+
+    print(args.directory)
+
+
+if __name__ == '__main__':
+    process_commandline()
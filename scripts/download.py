@@ -19,12 +19,14 @@ def process_commandline():
     requested_system = sys.argv[1].lower()
     requested_city = sys.argv[2].lower()
 
-    if len(sys.argv) > 3:
-        requested_archive = (sys.argv[3].lower() == 'archive')
-    else:
-        requested_archive = False
+    # optional further arguments: "archive" and/or "normalize"
+    options = [arg.lower() for arg in sys.argv[3:]]
+    requested_archive = 'archive' in options
+    requested_normalize = 'normalize' in options
 
-    t, failures = save(requested_system, requested_city, should_archive=requested_archive)
+    t, failures, normalize_failures = save(requested_system, requested_city,
+                       should_archive=requested_archive,
+                       should_normalize=requested_normalize)
 
     end_time = datetime.datetime.utcnow()
 
@@ -35,6 +37,10 @@ def process_commandline():
         message = '!!! could not download or save information for system {system} city {city}'
         print(message.format(system=failed[0], city=failed[1]))
 
+    for failed in normalize_failures:
+        message = '!!! downloaded but could not normalize information for system {system} city {city}'
+        print(message.format(system=failed[0], city=failed[1]))
+
 
 if __name__ == '__main__':
     process_commandline()
@@ -9,19 +9,77 @@ import sys
 # ask script to look for the electric2go package in one directory up
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
-from electric2go.analysis import cmdline
-from electric2go.analysis.merge import merge_all_files
+from electric2go import files
+from electric2go.analysis import catalog, cmdline, parallel
+from electric2go.analysis.merge import merge_all_files, stream_merge_files
 
 
 def process_commandline():
     parser = argparse.ArgumentParser()
-    parser.add_argument('files', type=str, nargs='+',
-                        help='files to merge, must be in order')
+    parser.add_argument('paths', type=str, nargs='+',
+                        help='files to merge, or directories of them. Files are '
+                             'put in order by the time range in their metadata')
+    parser.add_argument('-st', '--starting-time', type=str,
+                        help='only merge files with data at or after this time; '
+                             'format YYYY-mm-DD--HH-MM')
+    parser.add_argument('-et', '--ending-time', type=str,
+                        help='only merge files with data at or before this time; '
+                             'format YYYY-mm-DD--HH-MM')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='read and merge files in WORKERS parallel processes (default 1)')
+    parser.add_argument('--stream', action='store_true',
+                        help='write out finished trips and parkings as each file is merged, '
+                             'rather than keeping them in memory. Uses about as much memory '
+                             'as the largest file needs, rather than all of them')
     args = parser.parse_args()
 
-    result_dict = merge_all_files(args.files)
+    if args.workers < 1:
+        sys.exit('workers must be at least 1')
 
-    cmdline.write_json(result_dict)
+    if args.stream and args.workers > 1:
+        sys.exit('--stream is not supported with --workers')
+
+    for name in ('starting_time', 'ending_time'):
+        value = getattr(args, name)
+        if value:
+            try:
+                setattr(args, name, files.parse_date(value))
+            except ValueError:
+                sys.exit('time format not recognized: ' + value)
+
+    # check the files from their metadata before loading any of them
+    try:
+        entries = catalog.catalog_paths(args.paths)
+    except (IOError, OSError, ValueError, KeyError) as e:
+        sys.exit('could not read metadata: {}'.format(e))
+
+    entries = catalog.select_time_range(catalog.sort_entries(entries),
+                                        args.starting_time, args.ending_time)
+
+    if not entries:
+        sys.exit('no files to merge')
+
+    cities = sorted(set((entry['system'], entry['city']) for entry in entries))
+    if len(cities) > 1:
+        sys.exit('files are from more than one city: ' +
+                 ', '.join('{} {}'.format(system, city) for system, city in cities))
+
+    problems = catalog.find_problems(entries)
+    if problems:
+        sys.exit('files are not consecutive:\n' + '\n'.join(
+            '{problem} between {one} ending {one_end} and {two} starting {two_start}'.format(
+                problem=problem, one=one['filename'], one_end=one['ending_time'],
+                two=two['filename'], two_start=two['starting_time'])
+            for problem, one, two in problems))
+
+    files_to_merge = [entry['filename'] for entry in entries]
+
+    if args.stream:
+        stream_merge_files(files_to_merge)
+    elif args.workers > 1:
+        cmdline.write_json(parallel.merge_files(files_to_merge, args.workers))
+    else:
+        cmdline.write_json(merge_all_files(files_to_merge))
 
 
 if __name__ == '__main__':
@@ -3,6 +3,7 @@
 
 from __future__ import print_function
 import argparse
+import glob
 import os
 import sys
 
@@ -11,15 +12,17 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 from electric2go import files
 from electric2go.analysis import cmdline
-from electric2go.analysis.normalize import batch_load_data
+from electric2go.analysis import normalize, parallel, profiling
 
 
 def process_commandline():
     parser = argparse.ArgumentParser()
-    parser.add_argument('system', type=str,
+    parser.add_argument('system', type=str, nargs='?',
                         help='system to be used (e.g. car2go, drivenow, ...)')
-    parser.add_argument('starting_filename', type=str,
-                        help='name of archive of files or the first file')
+    parser.add_argument('starting_filename', type=str, nargs='*',
+                        help='name of archive of files or the first file. '
+                             'Several archives or directories, or a glob pattern '
+                             'like "vancouver_2016-02-*.tgz", are read as one archive')
     parser.add_argument('-st', '--starting-time', type=str,
                         help='optional: if using an archive, first data point '
                              'to process; format YYYY-mm-DD--HH-MM')
@@ -30,11 +33,78 @@ def process_commandline():
                         help='each step is TIME_STEP seconds (default 60)')
     parser.add_argument('-i', '--indent', type=int, default=0,
                         help='indent for output JSON (default 0)')
+    parser.add_argument('-f', '--format', choices=['json', 'npz'], default='json',
+                        help='output format (default json). npz is a columnar '
+                             'binary format that is faster to load; '
+                             'all scripts that read JSON can read it')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='process data in WORKERS parallel processes (default 1)')
+    parser.add_argument('--split', choices=['time', 'vin'], default='time',
+                        help='with --workers, split data between processes '
+                             'by time range or by vehicle (default time)')
+    parser.add_argument('--stream', action='store_true',
+                        help='read a tar archive in a single pass; faster '
+                             'for .tgz archives. Not used with --split time')
+    parser.add_argument('--prefetch', type=int, default=0, metavar='K',
+                        help='load up to K data points in advance in a background '
+                             'thread while processing (default 0, disabled)')
+    parser.add_argument('--engine', choices=['simple', 'framediff'], default='simple',
+                        help='how to find changes between data points (default simple). '
+                             'framediff only processes cars whose data changed; '
+                             'it is faster and gives the same results, but needs numpy')
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help='skip data points identical to the previous one '
+                             'without parsing them; gives the same results')
+    parser.add_argument('--checkpoint', type=str, metavar='FILE',
+                        help='save progress to FILE every few minutes, so that '
+                             'an interrupted run can be continued with --resume FILE')
+    parser.add_argument('--resume', type=str, metavar='FILE',
+                        help='continue an interrupted run from its checkpoint FILE. '
+                             'system, starting_filename and times are taken from FILE')
+    parser.add_argument('--profile', action='store_true',
+                        help='print time taken by each stage of processing, '
+                             'data points per second and peak memory use to stderr')
+    parser.add_argument('--profile-json', type=str, metavar='FILE',
+                        help='like --profile, but also write the numbers to FILE as JSON')
 
     args = parser.parse_args()
 
-    if not os.path.exists(args.starting_filename):
-        sys.exit('file not found: ' + args.starting_filename)
+    if args.resume:
+        if not os.path.exists(args.resume):
+            sys.exit('file not found: ' + args.resume)
+
+        # continue with the same parameters as the interrupted run,
+        # and keep saving progress to the same file
+        checkpoint_params = normalize.read_checkpoint(args.resume)['params']
+        args.system = checkpoint_params['system']
+        args.starting_filename = checkpoint_params['starting_filename']
+        args.time_step = checkpoint_params['time_step']
+        args.checkpoint = args.resume
+    elif not args.system or not args.starting_filename:
+        parser.error('system and starting_filename are required')
+
+    if (args.checkpoint or args.resume) and args.workers > 1:
+        sys.exit('--checkpoint and --resume are not supported with --workers')
+
+    if (args.profile or args.profile_json) and args.workers > 1:
+        sys.exit('--profile is not supported with --workers')
+
+    if not isinstance(args.starting_filename, list):
+        # as saved in a checkpoint
+        args.starting_filename = [args.starting_filename]
+
+    starting_filenames = []
+    for name in args.starting_filename:
+        # expand patterns the shell didn't, e.g. if quoted
+        matching = sorted(glob.glob(name))
+        if not matching:
+            sys.exit('file not found: ' + name)
+        starting_filenames.extend(matching)
+
+    if len(starting_filenames) == 1:
+        args.starting_filename = starting_filenames[0]
+    else:
+        args.starting_filename = starting_filenames
 
     # TODO: also support more standard YYYY-mm-DDTHH-MM (ISO 8601)
     # in addition to YYYY-mm-DD--HH-MM when parsing dates here.
@@ -53,21 +123,84 @@ def process_commandline():
         except ValueError:
             sys.exit('time format not recognized: ' + args.ending_time)
 
+    if args.resume:
+        args.starting_time = checkpoint_params['starting_time']
+        args.ending_time = checkpoint_params['ending_time']
+
+    if args.workers < 1:
+        sys.exit('workers must be at least 1')
+
+    if args.prefetch < 0:
+        sys.exit('prefetch must not be negative')
+
+    if args.profile or args.profile_json or args.skip_unchanged:
+        # also counts data points skipped as unchanged
+        profiler = profiling.Profiler()
+    else:
+        profiler = profiling.NULL_PROFILER
+
     try:
-        result = batch_load_data(args.system, args.starting_filename,
-                                 args.starting_time, args.ending_time,
-                                 args.time_step)
+        if args.workers > 1 and args.split == 'vin':
+            result = parallel.batch_load_data_by_vin(args.system, args.starting_filename,
+                                                     args.starting_time, args.ending_time,
+                                                     args.time_step, args.workers,
+                                                     stream=args.stream,
+                                                     prefetch_depth=args.prefetch,
+                                                     engine=args.engine,
+                                                     skip_unchanged=args.skip_unchanged,
+                                                     profiler=profiler)
+        elif args.workers > 1:
+            result = parallel.batch_load_data(args.system, args.starting_filename,
+                                              args.starting_time, args.ending_time,
+                                              args.time_step, args.workers,
+                                              prefetch_depth=args.prefetch,
+                                              engine=args.engine,
+                                              skip_unchanged=args.skip_unchanged,
+                                              profiler=profiler)
+        else:
+            result = normalize.batch_load_data(args.system, args.starting_filename,
+                                               args.starting_time, args.ending_time,
+                                               args.time_step, stream=args.stream,
+                                               prefetch_depth=args.prefetch,
+                                               engine=args.engine,
+                                               skip_unchanged=args.skip_unchanged,
+                                               checkpoint_filename=args.checkpoint,
+                                               resume=bool(args.resume),
+                                               profiler=profiler)
     except ValueError as e:
         # raised when an invalid system is encountered
         # or the first data file is invalid
         sys.exit(e)
 
+    if args.skip_unchanged:
+        print('skipped {count} unchanged data points'.format(
+            count=profiler.counts.get('skipped_unchanged', 0)), file=sys.stderr)
+
     if args.ending_time and args.ending_time > result['metadata']['ending_time']:
         print('warning: requested ending_time was {et}, but only found data up to {at}; using {at}'.
               format(et=args.ending_time, at=result['metadata']['ending_time']),
               file=sys.stderr)
 
-    cmdline.write_json(result, indent=args.indent)
+    if args.format == 'npz':
+        # import here so that numpy is only needed if it's actually used
+        from electric2go.analysis import columnar
+        with profiler.stage('write'):
+            columnar.write_npz(result, getattr(sys.stdout, 'buffer', sys.stdout))
+    else:
+        cmdline.write_json(result, indent=args.indent, profiler=profiler)
+
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        # the run is done, its checkpoint is no longer needed
+        os.remove(args.checkpoint)
+
+    if args.profile or args.profile_json:
+        profiler.print_summary()
+
+    if args.profile_json:
+        with open(args.profile_json, 'w') as f:
+            summary = profiler.get_summary()
+            summary['arguments'] = sys.argv[1:]
+            cmdline.write_json(summary, f, indent=2)
 
 
 if __name__ == '__main__':
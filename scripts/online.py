@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+
+# ask script to look for the electric2go package in one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from electric2go import systems
+from electric2go.analysis import cmdline, online
+
+
+def process_commandline():
+    parser = argparse.ArgumentParser(
+        description='print the result_dict for the current day built up so far '
+                    'by `download.py SYSTEM CITY normalize`, in the same format '
+                    'as normalize.py')
+    parser.add_argument('system', type=str,
+                        help='system to be used (e.g. car2go, drivenow, ...)')
+    parser.add_argument('city', type=str,
+                        help='city to print data for')
+    parser.add_argument('-i', '--indent', type=int, default=0,
+                        help='indent for output JSON (default 0)')
+    args = parser.parse_args()
+
+    try:
+        city_data = systems.get_city_by_name(args.system, args.city)
+    except (ImportError, KeyError):
+        sys.exit('unknown system or city: {system} {city}'.format(
+            system=args.system, city=args.city))
+
+    normalizer = online.OnlineNormalizer(city_data['system'], city_data['name'],
+                                         state_filename=online.get_state_file_path(city_data))
+
+    result_dict = normalizer.get_result_dict()
+    if not result_dict:
+        sys.exit('no data for {city} yet'.format(city=args.city))
+
+    cmdline.write_json(result_dict, indent=args.indent)
+
+
+if __name__ == '__main__':
+    process_commandline()
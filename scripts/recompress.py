@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+
+# ask script to look for the electric2go package in one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from electric2go.analysis.normalize import convert_tar_to_zip
+
+
+def process_commandline():
+    parser = argparse.ArgumentParser(
+        description='recompress a .tgz data archive into a .zip archive, '
+                    'which allows reading single data points quickly')
+    parser.add_argument('archive', type=str,
+                        help='.tgz archive to recompress')
+    parser.add_argument('output', type=str, nargs='?',
+                        help='name of the .zip archive to create '
+                             '(default: ARCHIVE with extension changed to .zip)')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.archive):
+        sys.exit('file not found: ' + args.archive)
+
+    output = args.output
+    if not output:
+        output = os.path.splitext(args.archive)[0] + '.zip'
+
+    if os.path.exists(output):
+        sys.exit('output file already exists: ' + output)
+
+    convert_tar_to_zip(args.archive, output)
+
+    print(output)
+
+
+if __name__ == '__main__':
+    process_commandline()
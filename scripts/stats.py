@@ -17,10 +17,13 @@ def process_commandline():
     parser = argparse.ArgumentParser()
     parser.add_argument('-tz', '--tz-offset', type=float, default=0,
                         help='offset times when days are split by TZ_OFFSET hours')
+    parser.add_argument('--dataset', type=str, metavar='DIR',
+                        help='read data from dataset directory DIR made with '
+                             'scripts/dataset.py instead of standard input')
 
     args = parser.parse_args()
 
-    result_dict = cmdline.read_json()
+    result_dict = cmdline.read_data(args.dataset)
 
     output_file = output_file_name('stats', 'csv')
 
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+from __future__ import print_function
+import argparse
+import datetime
+import os
+import sys
+
+# ask script to look for the electric2go package in one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from electric2go import files
+from electric2go.analysis import synthetic
+
+
+def process_commandline():
+    parser = argparse.ArgumentParser(
+        description='write an archive of made-up data points, for benchmarking. '
+                    'The same parameters always give the same data')
+    parser.add_argument('system', type=str, choices=sorted(synthetic.CAR_PROPERTIES),
+                        help='system whose data format to use')
+    parser.add_argument('city', type=str,
+                        help='city, positions are within its bounds')
+    parser.add_argument('output', type=str, nargs='?',
+                        help='archive to write: .tgz, .zip, or a directory if it ends '
+                             'in a slash (default: CITY_YYYY-mm-DD.tgz)')
+    parser.add_argument('-st', '--starting-time', type=str, default='2016-02-09--00-00',
+                        help='time of the first data point; format YYYY-mm-DD--HH-MM '
+                             '(default 2016-02-09--00-00)')
+    parser.add_argument('--hours', type=float, default=24,
+                        help='hours of data to make (default 24)')
+    parser.add_argument('-step', '--time-step', type=int, default=60,
+                        help='each step is TIME_STEP seconds (default 60)')
+    parser.add_argument('--fleet-size', type=int, default=500,
+                        help='number of cars (default 500)')
+    parser.add_argument('--trip-rate', type=float, default=5,
+                        help='average trips per car per day (default 5)')
+    parser.add_argument('--missing-rate', type=float, default=0.01,
+                        help='chance of each data point being missing (default 0.01)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default 0)')
+    args = parser.parse_args()
+
+    try:
+        starting_time = files.parse_date(args.starting_time)
+    except ValueError:
+        sys.exit('time format not recognized: ' + args.starting_time)
+
+    output = args.output
+    if not output:
+        output = '{city}_{t:%Y-%m-%d}.tgz'.format(city=args.city, t=starting_time)
+
+    if os.path.exists(output) and not output.endswith(os.path.sep):
+        sys.exit('output file already exists: ' + output)
+
+    try:
+        count = synthetic.write_archive(output, args.system, args.city,
+                                        starting_time=starting_time,
+                                        duration=datetime.timedelta(hours=args.hours),
+                                        time_step=args.time_step,
+                                        fleet_size=args.fleet_size,
+                                        trip_rate=args.trip_rate,
+                                        missing_rate=args.missing_rate,
+                                        seed=args.seed)
+    except KeyError:
+        sys.exit('unknown city: ' + args.city)
+
+    print('{count} data points written to {output}'.format(count=count, output=output),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    process_commandline()
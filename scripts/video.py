@@ -28,10 +28,13 @@ def process_commandline():
     parser.add_argument('--symbol', type=str, default='.',
                         help='matplotlib symbol to indicate vehicles on the images' +
                              ' (default \'.\', larger \'o\')')
+    parser.add_argument('--dataset', type=str, metavar='DIR',
+                        help='read data from dataset directory DIR made with '
+                             'scripts/dataset.py instead of standard input')
 
     args = parser.parse_args()
 
-    result_dict = cmdline.read_json()
+    result_dict = cmdline.read_data(args.dataset)
 
     metadata = result_dict['metadata']
 
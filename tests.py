@@ -4,16 +4,22 @@
 from __future__ import unicode_literals
 import unittest
 import os
+import sys
 import numpy as np
 import json
 import csv
 import tempfile
+import threading
 import shutil
+import tarfile
+import zipfile
+import io
 from subprocess import Popen, PIPE
 from datetime import datetime, timedelta
 
 from electric2go import current_git_revision, files, download, systems
-from electric2go.analysis import normalize, merge, generate
+from electric2go.analysis import cmdline, columnar, dataset, jsonbackend, normalize, merge, generate, online, ranges
+from electric2go.analysis import catalog, parallel, profiling, records, synthetic
 from electric2go.analysis import graph as process_graph
 from electric2go.analysis import stats as process_stats
 
@@ -96,7 +102,7 @@ class DownloadTest(unittest.TestCase):
         for city in self.test_cities:
             city_data = systems.get_city_by_name(city[0], city[1])
 
-            t, failures = download.save(city[0], city[1], should_archive=True)
+            t, failures, _ = download.save(city[0], city[1], should_archive=True)
 
             self.assertEqual(len(failures), 0)
 
@@ -119,7 +125,7 @@ class DownloadTest(unittest.TestCase):
             shutil.rmtree(data_dir)
 
         # download
-        t, failures = download.save(city_data['system'], city_data['name'], False)
+        t, failures, _ = download.save(city_data['system'], city_data['name'], False)
         file_current = files.get_current_file_path(city_data)
 
         # test it was downloaded
@@ -135,7 +141,7 @@ class DownloadTest(unittest.TestCase):
             city_data = systems.get_city_by_name(city[0], city[1])
 
             # warm up the cache
-            _, _ = download.save(city[0], city[1], should_archive=False)
+            _, _, _ = download.save(city[0], city[1], should_archive=False)
 
             text, cache = download.get_current(city_data, max_cache_age=30)
 
@@ -290,9 +296,9 @@ class StatsTest(unittest.TestCase):
                     "starting_time": datetime(2015, 6, 19, 0, 0, 0),
                     "ending_time": datetime(2015, 6, 19, 23, 59, 0),
                     "missing": [
-                        datetime(2015, 6, 19, 6, 46, 0),
-                        datetime(2015, 6, 19, 7, 9, 0),
-                        datetime(2015, 6, 19, 17, 33, 0)
+                        [datetime(2015, 6, 19, 6, 46, 0), datetime(2015, 6, 19, 6, 46, 0)],
+                        [datetime(2015, 6, 19, 7, 9, 0), datetime(2015, 6, 19, 7, 9, 0)],
+                        [datetime(2015, 6, 19, 17, 33, 0), datetime(2015, 6, 19, 17, 33, 0)]
                     ],
                     "time_step": 60
                 }
@@ -340,9 +346,9 @@ class StatsTest(unittest.TestCase):
                     "starting_time": datetime(2015, 6, 19, 0, 0, 0),
                     "ending_time": datetime(2015, 6, 19, 23, 59, 0),
                     "missing": [
-                        datetime(2015, 6, 19, 6, 46, 0),
-                        datetime(2015, 6, 19, 7, 9, 0),
-                        datetime(2015, 6, 19, 17, 33, 0)
+                        [datetime(2015, 6, 19, 6, 46, 0), datetime(2015, 6, 19, 6, 46, 0)],
+                        [datetime(2015, 6, 19, 7, 9, 0), datetime(2015, 6, 19, 7, 9, 0)],
+                        [datetime(2015, 6, 19, 17, 33, 0), datetime(2015, 6, 19, 17, 33, 0)]
                     ],
                     "time_step": 60
                 }
@@ -488,6 +494,10 @@ class StatsTest(unittest.TestCase):
 
 class MergeTest(unittest.TestCase):
     # Like StatsTest, also hardcoded to a dataset I have.
+    # The numbers are from before merge_two_dicts was made to give the same
+    # result as one normalize run, see its docstring. They have not been
+    # checked against that dataset since, cars that moved or went missing
+    # at midnight can have one more finished parking and trip now.
 
     def test_merge(self):
         filenames = [
@@ -501,7 +511,7 @@ class MergeTest(unittest.TestCase):
 
         self.assertEqual(merged_dict['metadata']['starting_time'], datetime(2015, 6, 1, 0, 0))
         self.assertEqual(merged_dict['metadata']['ending_time'], datetime(2015, 6, 3, 23, 59))
-        self.assertEqual(len(merged_dict['metadata']['missing']), 3)
+        self.assertEqual(ranges.count(merged_dict['metadata']['missing'], 60), 3)
 
         # some test cars that had non-trivial trip history...
         test_vin = 'WMEEJ3BA5EK736813'
@@ -524,8 +534,108 @@ class MergeTest(unittest.TestCase):
                          len(merged_dict['finished_trips'][test_vin3]))
 
 
+class MergeTreeTest(unittest.TestCase):
+    def test_merge_same_as_serial(self):
+        # merging as a tree, serially or in parallel, or streaming the output,
+        # gives the same result as merging in order
+        data_dir = tempfile.mkdtemp()
+        archive_name = os.path.join(data_dir, 'vancouver_2016-02-09.tgz')
+        synthetic.write_archive(archive_name, 'car2go', 'vancouver',
+                                duration=timedelta(hours=5), fleet_size=50,
+                                trip_rate=24, missing_rate=0.1, seed=2)
+
+        filepaths = []
+        for hour in range(5):
+            starting_time = datetime(2016, 2, 9, hour, 0)
+            ending_time = datetime(2016, 2, 9, hour, 59)
+            filepath = os.path.join(data_dir, 'vancouver_{}.json'.format(hour))
+            with open(filepath, 'w') as f:
+                cmdline.write_json(normalize.batch_load_data('car2go', archive_name, starting_time,
+                                                             ending_time, 60), f)
+            filepaths.append(filepath)
+
+        expected = merge.merge_all_files(filepaths)
+        self.assertEqual(merge.merge_tree(merge.load_all_files(filepaths)), expected)
+        self.assertEqual(parallel.merge_files(filepaths, 2), expected)
+
+        streamed = io.StringIO()
+        merge.stream_merge_files(filepaths, streamed)
+        # written by stream_merge_files itself, not the JSON backend
+        self.assertTrue(streamed.getvalue().startswith('{"metadata":'))
+        self.assertEqual(cmdline.read_json(io.BytesIO(streamed.getvalue().encode('utf-8'))), expected)
+
+        # files must still be consecutive
+        with self.assertRaises(ValueError):
+            merge.merge_tree(merge.load_all_files([filepaths[0], filepaths[2]]))
+
+        shutil.rmtree(data_dir)
+
+
+class CatalogTest(unittest.TestCase):
+    def test_catalog(self):
+        # metadata is read from the start of files, and files are
+        # put in order and checked for gaps from their metadata alone
+        data_dir = tempfile.mkdtemp()
+        archive_name = os.path.join(data_dir, 'vancouver_2016-02-09.tgz')
+        synthetic.write_archive(archive_name, 'car2go', 'vancouver',
+                                duration=timedelta(hours=4), fleet_size=20, seed=3)
+
+        results_dir = os.path.join(data_dir, 'results')
+        os.makedirs(results_dir)
+
+        results = []
+        for hour in range(4):
+            result_dict = normalize.batch_load_data('car2go', archive_name,
+                                                    datetime(2016, 2, 9, hour, 0),
+                                                    datetime(2016, 2, 9, hour, 59), 60)
+            results.append(result_dict)
+
+            with open(os.path.join(results_dir, 'hour_{}.json'.format(3 - hour)), 'w') as f:
+                cmdline.write_json(result_dict, f)
+
+        # metadata is written first, and can be read without the rest of the file
+        self.assertEqual(list(cmdline.metadata_first(results[0]))[0], 'metadata')
+        filepath = os.path.join(results_dir, 'hour_3.json')
+        self.assertEqual(cmdline.read_metadata(filepath), results[0]['metadata'])
+
+        npz_filepath = os.path.join(data_dir, 'hour_0.npz')
+        with open(npz_filepath, 'wb') as f:
+            columnar.write_npz(results[0], f)
+        self.assertEqual(cmdline.read_metadata(npz_filepath), results[0]['metadata'])
+
+        # files written with metadata last are read in full
+        old_filepath = os.path.join(data_dir, 'old.json')
+        with open(old_filepath, 'w') as f:
+            old_dict = dict(results[0])
+            old_dict['metadata'] = old_dict.pop('metadata')
+            json.dump(old_dict, f, default=cmdline.json_serializer)
+        self.assertEqual(cmdline.read_metadata(old_filepath), results[0]['metadata'])
+
+        entries = catalog.sort_entries(catalog.catalog_paths([results_dir]))
+        self.assertEqual([os.path.basename(entry['filename']) for entry in entries],
+                         ['hour_3.json', 'hour_2.json', 'hour_1.json', 'hour_0.json'])
+        self.assertEqual(catalog.find_problems(entries), [])
+
+        # catalog is cached, and gives the same result when read back
+        self.assertTrue(os.path.exists(catalog.get_catalog_file_name(results_dir)))
+        self.assertEqual(catalog.sort_entries(catalog.catalog_directory(results_dir)), entries)
+
+        selected = catalog.select_time_range(entries, datetime(2016, 2, 9, 1, 30),
+                                             datetime(2016, 2, 9, 2, 0))
+        self.assertEqual(selected, entries[1:3])
+
+        problems = catalog.find_problems([entries[0], entries[2], entries[3]])
+        self.assertEqual(problems, [('gap', entries[0], entries[2])])
+        problems = catalog.find_problems([entries[0], entries[0]])
+        self.assertEqual(problems, [('overlap', entries[0], entries[0])])
+
+        shutil.rmtree(data_dir)
+
+
 class IntegrationTest(unittest.TestCase):
     # Like StatsTest, also hardcoded to a dataset I have.
+    # As in MergeTest, the numbers predate merge_two_dicts matching
+    # a single normalize run and have not been checked since.
 
     def test_merge_pipeline(self):
         # comprehensive test using command-line interfaces:
@@ -826,6 +936,735 @@ class GenerateTest(unittest.TestCase):
         self.assertEqual(expected_remainder, actual_remainder, msg=error_msg)
 
 
+class SyntheticArchiveTestCase(unittest.TestCase):
+    # Base for tests that normalize a small synthetic archive in different
+    # ways, and check that the result is the same as for a plain
+    # batch_load_data run. The archive is made in setUpClass.
+
+    system = 'car2go'
+    city = 'vancouver'
+    archive_params = {
+        'starting_time': datetime(2016, 2, 9, 0, 0),
+        'duration': timedelta(hours=3),
+        'fleet_size': 40,
+        'trip_rate': 24,
+        'missing_rate': 0.05,
+        'seed': 4
+    }
+    time_step = 60
+
+    @classmethod
+    def setUpClass(cls):
+        cls.archive_dir = tempfile.mkdtemp()
+        cls.archive_name = os.path.join(cls.archive_dir, '{city}_{t:%Y-%m-%d}.tgz'.format(
+            city=cls.city, t=cls.archive_params['starting_time']))
+        synthetic.write_archive(cls.archive_name, cls.system, cls.city,
+                                time_step=cls.time_step, **cls.archive_params)
+
+        cls.expected = cls.load()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.archive_dir, ignore_errors=True)
+
+    @classmethod
+    def load(cls, starting_filename=None, starting_time=None, ending_time=None, **kwargs):
+        return normalize.batch_load_data(cls.system, starting_filename or cls.archive_name,
+                                         starting_time, ending_time, cls.time_step, **kwargs)
+
+    def assertFirstDataPointCarsParked(self, result_dict):
+        # each car in the first data point is parked from the starting time
+        parser = systems.get_parser(self.system)
+        starting_time = result_dict['metadata']['starting_time']
+
+        data_archive = normalize.Electric2goDataArchive(self.city, self.archive_name)
+        first_cars = parser.get_cars(data_archive.load_data_point(starting_time))
+        data_archive.close()
+        self.assertGreater(len(first_cars), 0)
+
+        for car in first_cars:
+            vin = parser.get_car_basics(car)[0]
+            parkings = result_dict['finished_parkings'].get(vin)
+            first_parking = parkings[0] if parkings else result_dict['unfinished_parkings'][vin]
+            self.assertEqual(first_parking['starting_time'], starting_time)
+
+    def assertSameAsExpected(self, result_dict):
+        # processing_started is different for each run
+        result_dict['metadata']['processing_started'] = \
+            self.expected['metadata']['processing_started']
+
+        self.assertEqual(result_dict, self.expected)
+
+
+class StreamTest(SyntheticArchiveTestCase):
+    def test_same_as_random_access(self):
+        # reading the archive in a single pass should give the same result
+        # as random access to its files
+        self.assertSameAsExpected(self.load(stream=True))
+
+
+class FrameDiffTest(SyntheticArchiveTestCase):
+    def test_same_as_process_data(self):
+        # the framediff engine should give exactly the same result
+        # as process_data
+        self.assertSameAsExpected(self.load(engine='framediff'))
+
+
+class SkipUnchangedTest(SyntheticArchiveTestCase):
+    # few enough trips that some data points are the same as the previous one
+    archive_params = dict(SyntheticArchiveTestCase.archive_params,
+                          fleet_size=5, trip_rate=6)
+
+    def test_same_result(self):
+        data_archive = normalize.Electric2goDataArchive(self.city, self.archive_name)
+        raw_data_points = [raw_data for _, raw_data in data_archive.iter_raw_data_points(
+            self.expected['metadata']['starting_time'],
+            self.expected['metadata']['ending_time'], self.time_step)]
+        data_archive.close()
+        self.assertTrue(any(raw_data is not None and raw_data == previous
+                            for previous, raw_data in zip(raw_data_points, raw_data_points[1:])))
+
+        # skipping data points identical to the previous one
+        # should not change the result
+        for engine in ('simple', 'framediff'):
+            profiler = profiling.Profiler()
+            self.assertSameAsExpected(self.load(engine=engine, skip_unchanged=True,
+                                                profiler=profiler))
+            self.assertGreater(profiler.counts['skipped_unchanged'], 0)
+
+    def test_parallel_count(self):
+        # each process's count of data points skipped is added up
+        # in the profiler that was passed in
+        profiler = profiling.Profiler()
+        self.load(skip_unchanged=True, profiler=profiler)
+
+        parallel_profiler = profiling.Profiler()
+        self.assertSameAsExpected(parallel.batch_load_data(
+            self.system, self.archive_name, None, None, self.time_step, 2,
+            skip_unchanged=True, profiler=parallel_profiler))
+        self.assertGreater(parallel_profiler.counts['skipped_unchanged'], 0)
+        self.assertLessEqual(parallel_profiler.counts['skipped_unchanged'],
+                             profiler.counts['skipped_unchanged'])
+
+
+class CheckpointTest(SyntheticArchiveTestCase):
+    def test_resume_same_as_uninterrupted(self):
+        # continuing from a checkpoint should give the same result
+        # as an uninterrupted run
+        checkpoint_dir = tempfile.mkdtemp()
+        checkpoint_filename = os.path.join(checkpoint_dir, 'checkpoint')
+
+        # checkpoint as often as possible, then continue from the last one
+        self.load(checkpoint_filename=checkpoint_filename, checkpoint_interval=0)
+        self.assertTrue(os.path.exists(checkpoint_filename))
+
+        resumed_data = self.load(checkpoint_filename=checkpoint_filename, resume=True)
+        shutil.rmtree(checkpoint_dir)
+
+        self.assertSameAsExpected(resumed_data)
+
+
+class MultiArchiveTest(SyntheticArchiveTestCase):
+    def test_same_as_one_archive(self):
+        # reading the data split over two archives should give the same
+        # result as reading the original archive
+        archive_dir = tempfile.mkdtemp()
+        archive_names = [os.path.join(archive_dir, 'vancouver_first.tgz'),
+                         os.path.join(archive_dir, 'vancouver_second.zip')]
+
+        with tarfile.open(self.archive_name) as original:
+            members = [m for m in original.getmembers() if m.isfile()]
+            half = len(members) // 2
+
+            with tarfile.open(archive_names[0], 'w:gz') as first:
+                for member in members[:half]:
+                    first.addfile(member, original.extractfile(member))
+
+            with zipfile.ZipFile(archive_names[1], 'w') as second:
+                for member in members[half:]:
+                    second.writestr(member.name, original.extractfile(member).read())
+
+        # order of the archives given shouldn't matter
+        multi_data = self.load(list(reversed(archive_names)), stream=True)
+        shutil.rmtree(archive_dir)
+
+        self.assertSameAsExpected(multi_data)
+
+
+class TimeSplitTest(SyntheticArchiveTestCase):
+    # Normalizing the archive in two parts and merging them, or in parallel
+    # with parallel.batch_load_data, gives the same result as in one go.
+    # Boundaries are chosen to have the cases merge_two_dicts handles.
+
+    def load_parts(self, first_ending_time, second_starting_time):
+        return self.load(ending_time=first_ending_time), self.load(starting_time=second_starting_time)
+
+    def boundaries(self):
+        # possible starting times for the second part, at data points
+        # that aren't missing and aren't right at the start or end
+        step = timedelta(seconds=self.time_step)
+        metadata = self.expected['metadata']
+        t = metadata['starting_time'] + 2 * step
+        while t < metadata['ending_time'] - step:
+            if not ranges.contains(metadata['missing'], t):
+                yield t
+            t += step
+
+    def all_records(self, key):
+        return [record for vin in sorted(self.expected[key]) for record in self.expected[key][vin]]
+
+    def test_parking_spans_boundary(self):
+        step = timedelta(seconds=self.time_step)
+        boundary, parking = next((t, parking) for t in self.boundaries()
+                                 for parking in self.all_records('finished_parkings')
+                                 if parking['starting_time'] < t - step and parking['ending_time'] > t)
+
+        merged = merge.merge_two_dicts(*self.load_parts(boundary - step, boundary))
+
+        # joined back up into one parking
+        self.assertIn(parking, merged['finished_parkings'][parking['vin']])
+        self.assertSameAsExpected(merged)
+
+    def test_trip_ends_at_boundary(self):
+        step = timedelta(seconds=self.time_step)
+        boundaries = set(self.boundaries())
+
+        # trips ending at the first data point of the second part,
+        # and at the last data point of the first part
+        for offset in (0, 1):
+            boundary, trip = next((trip['end']['time'] + offset * step, trip)
+                                  for trip in self.all_records('finished_trips')
+                                  if trip['end']['time'] + offset * step in boundaries
+                                  and trip['start']['time'] < trip['end']['time'] - step)
+
+            merged = merge.merge_two_dicts(*self.load_parts(boundary - step, boundary))
+
+            self.assertIn(trip, merged['finished_trips'][trip['vin']])
+            self.assertSameAsExpected(merged)
+
+    def test_missing_at_boundary(self):
+        step = timedelta(seconds=self.time_step)
+        missing = self.expected['metadata']['missing']
+        boundary = next(t for t in self.boundaries() if ranges.contains(missing, t - step))
+
+        # the first part ends with a missing data point
+        first, second = self.load_parts(boundary - step, boundary)
+        self.assertTrue(ranges.contains(first['metadata']['missing'], boundary - step))
+        self.assertLess(first['metadata']['ending_time'], boundary - step)
+        self.assertSameAsExpected(merge.merge_two_dicts(first, second))
+
+        # data points that aren't known to be missing can't be left out
+        later_boundary = next(t for t in self.boundaries() if t > boundary + step)
+        with self.assertRaises(ValueError):
+            merge.merge_two_dicts(*self.load_parts(boundary - step, later_boundary))
+
+    def test_vehicles_in_one_part(self):
+        step = timedelta(seconds=self.time_step)
+        metadata = self.expected['metadata']
+
+        # cars on a trip during a short first part are only seen
+        # in the second part, and the other way round
+        first_data_points = [t for t in (metadata['starting_time'] + step * i for i in range(1, 5))
+                             if not ranges.contains(metadata['missing'], t)]
+        for boundary in (first_data_points[0], metadata['ending_time']):
+            first, second = self.load_parts(boundary - step, boundary)
+            first_vins = set(first['vehicles'])
+            second_vins = set(second['vehicles'])
+            if boundary == metadata['ending_time']:
+                self.assertTrue(first_vins - second_vins)
+            else:
+                self.assertTrue(second_vins - first_vins)
+
+            merged = merge.merge_two_dicts(first, second)
+            self.assertEqual(set(merged['vehicles']), first_vins | second_vins)
+            self.assertSameAsExpected(merged)
+
+    def test_workers_same_as_serial(self):
+        for workers in (2, 3, 5):
+            self.assertSameAsExpected(parallel.batch_load_data(
+                self.system, self.archive_name, None, None, self.time_step, workers))
+
+
+class VinShardTest(SyntheticArchiveTestCase):
+    # enough trips that some cars are away at the start of the archive
+    archive_params = dict(SyntheticArchiveTestCase.archive_params, trip_rate=96)
+
+    def test_shards_same_as_serial(self):
+        step = timedelta(seconds=self.time_step)
+        metadata = self.expected['metadata']
+
+        # the data has a car first seen partway through,
+        # and a trip spanning missing data points
+        self.assertTrue(any(trip['end']['time'] > metadata['starting_time']
+                            for trip in self.expected['unstarted_trips'].values()))
+        self.assertTrue(any(ranges.clip(metadata['missing'], trip['start']['time'] + step,
+                                        trip['end']['time'] - step, self.time_step)
+                            for vin_trips in self.expected['finished_trips'].values()
+                            for trip in vin_trips))
+
+        for workers in (2, 3):
+            for stream in (False, True):
+                self.assertSameAsExpected(parallel.batch_load_data_by_vin(
+                    self.system, self.archive_name, None, None, self.time_step, workers,
+                    stream=stream))
+
+    def test_each_vin_in_one_shard(self):
+        shard_count = 3
+        shard_results = [self.load(vin_shard=(shard_index, shard_count))
+                         for shard_index in range(shard_count)]
+
+        shard_vins = [set(result['vehicles']) for result in shard_results]
+        for shard_index, vins in enumerate(shard_vins):
+            self.assertTrue(vins)
+            for vin in vins:
+                self.assertEqual(normalize.get_vin_shard(vin, shard_count), shard_index)
+
+        self.assertEqual(set.union(*shard_vins), set(self.expected['vehicles']))
+        self.assertSameAsExpected(parallel.merge_vin_shards(shard_results))
+
+
+class TarIndexTest(SyntheticArchiveTestCase):
+    def setUp(self):
+        self.index_name = normalize.get_index_file_name(self.archive_name)
+        if os.path.isdir(self.index_name):
+            shutil.rmtree(self.index_name)
+        elif os.path.exists(self.index_name):
+            os.remove(self.index_name)
+
+    def open_archive(self):
+        data_archive = normalize.Electric2goDataArchive(self.city, self.archive_name)
+        last_file_time = data_archive.last_file_time
+        data_archive.close()
+        return last_file_time
+
+    def read_index(self):
+        with open(self.index_name) as f:
+            return json.load(f)
+
+    def write_index(self, index):
+        with open(self.index_name, 'w') as f:
+            json.dump(index, f)
+
+    def test_index_reused(self):
+        last_file_time = self.open_archive()
+        index = self.read_index()
+        self.assertEqual(index['size'], os.path.getsize(self.archive_name))
+
+        # an index that is up to date is used instead of scanning the archive,
+        # so the archive seems to end earlier when the last member is left out
+        index['members'].pop()
+        self.write_index(index)
+        self.assertLess(self.open_archive(), last_file_time)
+
+    def test_stale_index_rebuilt(self):
+        last_file_time = self.open_archive()
+        full_index = self.read_index()
+
+        short_index = dict(full_index, members=full_index['members'][:-1])
+
+        # archive size changed
+        self.write_index(dict(short_index, size=short_index['size'] + 1))
+        self.assertEqual(self.open_archive(), last_file_time)
+        self.assertEqual(self.read_index(), full_index)
+
+        # archive mtime changed
+        archive_mtime = os.path.getmtime(self.archive_name)
+        os.utime(self.archive_name, (archive_mtime, archive_mtime - 60))
+        try:
+            self.write_index(short_index)
+            self.assertEqual(self.open_archive(), last_file_time)
+            self.assertEqual(self.read_index()['members'], full_index['members'])
+            self.assertEqual(self.read_index()['mtime'], archive_mtime - 60)
+        finally:
+            os.utime(self.archive_name, (archive_mtime, archive_mtime))
+
+    def test_corrupt_index(self):
+        self.open_archive()
+        full_index = self.read_index()
+
+        for contents in ('{"size": ', '[]', '{}'):
+            with open(self.index_name, 'w') as f:
+                f.write(contents)
+
+            self.assertSameAsExpected(self.load())
+            self.assertEqual(self.read_index(), full_index)
+
+    def test_unwritable_index(self):
+        # the index can't be read or replaced when its name is taken by a directory
+        os.mkdir(self.index_name)
+
+        self.assertSameAsExpected(self.load())
+        self.assertTrue(os.path.isdir(self.index_name))
+
+    def test_zip_same_as_tar(self):
+        zip_dir = tempfile.mkdtemp()
+        try:
+            zip_name = os.path.join(zip_dir, os.path.basename(self.archive_name)[:-len('.tgz')] + '.zip')
+            normalize.convert_tar_to_zip(self.archive_name, zip_name)
+            self.assertTrue(zipfile.is_zipfile(zip_name))
+            self.assertSameAsExpected(self.load(starting_filename=zip_name))
+        finally:
+            shutil.rmtree(zip_dir)
+
+    def test_recompress_script(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts', 'recompress.py')
+        zip_name = self.archive_name[:-len('.tgz')] + '.zip'
+
+        try:
+            p = Popen([sys.executable, script, self.archive_name], stdout=PIPE)
+            output = p.communicate()[0]
+            self.assertEqual(p.returncode, 0)
+            self.assertEqual(output.decode('utf-8').strip(), zip_name)
+            self.assertSameAsExpected(self.load(starting_filename=zip_name))
+
+            # won't overwrite an existing file
+            p = Popen([sys.executable, script, self.archive_name], stdout=PIPE, stderr=PIPE)
+            p.communicate()
+            self.assertNotEqual(p.returncode, 0)
+        finally:
+            if os.path.exists(zip_name):
+                os.remove(zip_name)
+
+
+class DrivenowNormalizeTest(SyntheticArchiveTestCase):
+    # drivenow's get_everything_except_cars has to leave the data point's
+    # cars alone, as the first data point is used again to process its cars
+    system = 'drivenow'
+    city = 'berlin'
+
+    def test_first_data_point_cars(self):
+        self.assertFirstDataPointCarsParked(self.expected)
+
+    def test_time_split_same_as_serial(self):
+        # each chunk starts by reading its first data point
+        self.assertSameAsExpected(parallel.batch_load_data(
+            self.system, self.archive_name, None, None, self.time_step, 3))
+
+    def test_stream_same_as_random_access(self):
+        self.assertSameAsExpected(self.load(stream=True))
+
+
+class OnlineTest(SyntheticArchiveTestCase):
+    def test_same_as_batch(self):
+        # adding data points one at a time, with state saved and loaded
+        # in between like when run from download.py, should give the same
+        # result as batch_load_data
+        state_dir = tempfile.mkdtemp()
+        state_filename = os.path.join(state_dir, 'online_{city}.json'.format(city=self.city))
+
+        data_archive = normalize.Electric2goDataArchive(self.city, self.archive_name)
+        for t, raw_data in data_archive.iter_raw_data_points(
+                self.expected['metadata']['starting_time'],
+                self.expected['metadata']['ending_time'], self.time_step):
+            normalizer = online.OnlineNormalizer(self.system, self.city, self.time_step, state_filename)
+            normalizer.add_data_point(t, raw_data)
+            normalizer.save()
+        data_archive.close()
+
+        online_data = online.OnlineNormalizer(self.system, self.city, self.time_step,
+                                              state_filename).get_result_dict()
+        shutil.rmtree(state_dir)
+
+        for key in ('processing_started', 'electric2go_revision'):
+            online_data['metadata'][key] = self.expected['metadata'][key]
+
+        self.assertFirstDataPointCarsParked(online_data)
+        self.assertEqual(json_round_trip(online_data), json_round_trip(self.expected))
+
+
+class DrivenowOnlineTest(OnlineTest):
+    # the first data point is used for both system information and cars
+    system = 'drivenow'
+    city = 'berlin'
+
+
+@unittest.skipIf(online.fcntl is None, 'needs fcntl')
+class OnlineLockTest(unittest.TestCase):
+    def test_lock_state_file(self):
+        # a second run waits until the first is done with the state file
+        state_dir = tempfile.mkdtemp()
+        state_filename = os.path.join(state_dir, 'online_vancouver.json')
+        events = []
+
+        def second_run():
+            with online.lock_state_file(state_filename):
+                events.append('second')
+
+        with online.lock_state_file(state_filename):
+            thread = threading.Thread(target=second_run)
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            events.append('first')
+
+        thread.join()
+        self.assertEqual(events, ['first', 'second'])
+        self.assertTrue(os.path.exists(online.get_lock_file_name(state_filename)))
+
+        shutil.rmtree(state_dir)
+
+
+class JsonBackendTest(unittest.TestCase):
+    def test_backends_round_trip(self):
+        data = {
+            'metadata': {
+                'starting_time': datetime(2016, 2, 9, 0, 0),
+                'missing': [[datetime(2016, 2, 9, 0, 5), datetime(2016, 2, 9, 0, 6)]]
+            },
+            'finished_parkings': {
+                'WMEEJ3BA5EK736813': [{
+                    'starting_time': datetime(2016, 2, 9, 0, 1),
+                    'changing_data': [(datetime(2016, 2, 9, 0, 2), {'fuel': 50})],
+                    'lat': 49.25199
+                }]
+            },
+            'finished_trips': {
+                'WMEEJ3BA5EK736813': [{
+                    'start': {'time': datetime(2016, 2, 9, 0, 3), 'fuel': 50},
+                    'end': {'time': datetime(2016, 2, 9, 0, 9), 'fuel': 48},
+                    'duration': 360.0
+                }]
+            },
+            'unstarted_trips': {
+                'WMEEJ3BAXEK733745': {
+                    'end': {'time': datetime(2016, 2, 9, 0, 0), 'fuel': 20}
+                }
+            }
+        }
+
+        original_backend = jsonbackend.backend
+        try:
+            for name in jsonbackend.available_backends():
+                jsonbackend.set_backend(name)
+
+                for indent in (0, 2):
+                    written = io.StringIO()
+                    cmdline.write_json(data, written, indent=indent)
+
+                    written.seek(0)
+                    self.assertEqual(cmdline.read_json(written), data,
+                                     '{name}, indent {indent}'.format(name=name, indent=indent))
+        finally:
+            jsonbackend.backend = original_backend
+
+    def test_write_utf8(self):
+        text = '{"city": "M\u00fcnchen", "name": "\u6771\u4eac \U0001f697"}' * 3
+        data = text.encode('utf-8')
+
+        original_chunk_size = jsonbackend.WRITE_CHUNK_SIZE
+        try:
+            # chunk sizes that split multi-byte characters
+            for chunk_size in (1, 2, 3, 7, len(data)):
+                jsonbackend.WRITE_CHUNK_SIZE = chunk_size
+
+                written = io.StringIO()
+                written.write('[')
+                jsonbackend.write_utf8(written, data)
+                self.assertEqual(written.getvalue(), '[' + text, chunk_size)
+        finally:
+            jsonbackend.WRITE_CHUNK_SIZE = original_chunk_size
+
+        # streams with a binary buffer are written to directly,
+        # after any text written before
+        binary = io.BytesIO()
+        written = io.TextIOWrapper(binary, encoding='utf-8')
+        written.write('[')
+        jsonbackend.write_utf8(written, data)
+        written.write(']')
+        written.flush()
+        self.assertEqual(binary.getvalue().decode('utf-8'), '[' + text + ']')
+
+    def test_parse_time(self):
+        self.assertEqual(cmdline.parse_time('2016-02-09T13:05:00'), datetime(2016, 2, 9, 13, 5))
+        self.assertEqual(cmdline.parse_time('2016-02-09T13:05:00.001234'),
+                         datetime(2016, 2, 9, 13, 5, 0, 1234))
+
+        # anything else is returned unchanged
+        self.assertEqual(cmdline.parse_time('2016-02-09 13:05:00'), '2016-02-09 13:05:00')
+        self.assertEqual(cmdline.parse_time('abcd-ef-ghTij:kl:mn'), 'abcd-ef-ghTij:kl:mn')
+        self.assertEqual(cmdline.parse_time(None), None)
+
+    def test_invalid_data_point(self):
+        self.assertEqual(normalize.parse_data_point(b'{"placemarks": ['), False)
+        self.assertEqual(normalize.parse_data_point(None), False)
+        self.assertEqual(normalize.parse_data_point(b'{"placemarks": []}'), {'placemarks': []})
+
+
+def make_sample_result_dict():
+    # small result_dict with a variety of records and values
+    return {
+        'metadata': {
+            'starting_time': datetime(2016, 2, 9, 0, 0),
+            'ending_time': datetime(2016, 2, 9, 0, 10),
+            'processing_started': datetime(2016, 2, 10, 1, 2, 3, 456789),
+            'missing': [[datetime(2016, 2, 9, 0, 5), datetime(2016, 2, 9, 0, 5)]]
+        },
+        'system': {'zones': [1, 2]},
+        'vehicles': {'WMEEJ3BA5EK736813': {'vin': 'WMEEJ3BA5EK736813', 'model': None}},
+        'finished_parkings': {
+            'WMEEJ3BA5EK736813': [
+                {
+                    'vin': 'WMEEJ3BA5EK736813',
+                    'starting_time': datetime(2016, 2, 9, 0, 0),
+                    'ending_time': datetime(2016, 2, 9, 0, 2),
+                    'changing_data': [(datetime(2016, 2, 9, 0, 0), (50, False)),
+                                      (datetime(2016, 2, 9, 0, 1), (51, True))],
+                    'fuel': 50,
+                    'address': 'Königstraße 1',
+                    'charging': False
+                },
+                {
+                    'vin': 'WMEEJ3BA5EK736813',
+                    'starting_time': datetime(2016, 2, 9, 0, 7),
+                    'changing_data': [(datetime(2016, 2, 9, 0, 7), (48, False))],
+                    'fuel': None,
+                    'charging': True,
+                    'price_offer_details': {'price': 0.29}
+                }
+            ],
+            'WMEEJ3BAXEK733745': []
+        },
+        'finished_trips': {
+            'WMEEJ3BA5EK736813': [{
+                'vin': 'WMEEJ3BA5EK736813',
+                'start': {'time': datetime(2016, 2, 9, 0, 3), 'lat': 49.25, 'fuel': 51},
+                'end': {'time': datetime(2016, 2, 9, 0, 6), 'lat': 49.26, 'fuel': 48},
+                'duration': 180.0,
+                'speed': 1.5
+            }]
+        },
+        'unfinished_trips': {
+            'WMEEJ3BA3EK732887': {
+                'vin': 'WMEEJ3BA3EK732887',
+                'start': {'time': datetime(2016, 2, 9, 0, 8), 'fuel': 1.5}
+            }
+        },
+        'unstarted_trips': {
+            'WMEEJ3BAXEK733745': {
+                'vin': 'WMEEJ3BAXEK733745',
+                'end': {'time': datetime(2016, 2, 9, 0, 0), 'fuel': 20}
+            }
+        }
+    }
+
+
+def json_round_trip(data):
+    written_json = io.StringIO()
+    cmdline.write_json(data, written_json)
+    written_json.seek(0)
+    return cmdline.read_json(written_json)
+
+
+class ColumnarTest(unittest.TestCase):
+    def test_same_as_json(self):
+        data = make_sample_result_dict()
+
+        written_columnar = io.BytesIO()
+        columnar.write_npz(data, written_columnar)
+        written_columnar.seek(0)
+
+        self.assertEqual(cmdline.read_json(written_columnar), json_round_trip(data))
+
+    def test_mixed_types(self):
+        # integers in a column that also has floats don't become floats
+        data = make_sample_result_dict()
+        trips = data['finished_trips']['WMEEJ3BA5EK736813']
+        trips.append(dict(trips[0]))
+        trips[0]['fuel_use'] = -3
+        trips[1]['fuel_use'] = 1.5
+
+        decoded = columnar.decode(columnar.encode(data))
+        fuel_uses = [trip['fuel_use'] for trip in decoded['finished_trips']['WMEEJ3BA5EK736813']]
+        self.assertEqual(fuel_uses, [-3, 1.5])
+        self.assertIs(type(fuel_uses[0]), int)
+        self.assertEqual(decoded, json_round_trip(data))
+
+
+class DatasetTest(unittest.TestCase):
+    def setUp(self):
+        self.dataset_dir = tempfile.mkdtemp()
+        self.data = make_sample_result_dict()
+        dataset.write_dataset(self.data, self.dataset_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dataset_dir, ignore_errors=True)
+
+    def test_same_as_json(self):
+        loaded = dataset.Dataset(self.dataset_dir)
+
+        self.assertEqual(loaded.to_dict(), json_round_trip(self.data))
+
+        # can be used in place of a result_dict
+        self.assertEqual(json_round_trip(loaded), json_round_trip(self.data))
+
+    def test_lazy(self):
+        loaded = dataset.Dataset(self.dataset_dir)
+
+        trip = loaded['finished_trips']['WMEEJ3BA5EK736813'][0]
+        self.assertEqual(trip['start']['time'], datetime(2016, 2, 9, 0, 3))
+
+        # only records that were accessed have been loaded
+        self.assertEqual(list(loaded['finished_trips'].records), ['WMEEJ3BA5EK736813'])
+        self.assertEqual(loaded['finished_parkings'].records, {})
+
+        # changes are kept
+        trip['duration'] = 1.0
+        self.assertEqual(loaded['finished_trips']['WMEEJ3BA5EK736813'][0]['duration'], 1.0)
+        del loaded['unstarted_trips']['WMEEJ3BAXEK733745']
+        self.assertEqual(len(loaded['unstarted_trips']), 0)
+
+    def test_cache_size(self):
+        loaded = dataset.Dataset(self.dataset_dir, cache_size=1)
+        parkings = loaded['finished_parkings']
+        self.assertGreater(len(parkings), 1)
+
+        # going through all VINs only keeps the last one decoded
+        self.assertEqual(json_round_trip(dict(parkings.items())),
+                         json_round_trip(self.data['finished_parkings']))
+        self.assertEqual(list(parkings.records), [list(parkings)[-1]])
+
+        # changes are kept while the VIN is in the cache
+        first_vin, second_vin = list(parkings)[:2]
+        parkings[first_vin][0]['vin'] = 'changed'
+        self.assertEqual(parkings[first_vin][0]['vin'], 'changed')
+        parkings[second_vin]
+        self.assertEqual(parkings[first_vin][0]['vin'], first_vin)
+
+    def test_write_from_files(self):
+        # merging files into a dataset a few VINs at a time gives
+        # the same dataset as writing the merged result_dict
+        data_dir = tempfile.mkdtemp()
+        archive_name = os.path.join(data_dir, 'vancouver_2016-02-09.tgz')
+        synthetic.write_archive(archive_name, 'car2go', 'vancouver',
+                                duration=timedelta(hours=3), fleet_size=30,
+                                trip_rate=24, missing_rate=0.1, seed=5)
+
+        filepaths = []
+        for hour in range(3):
+            filepath = os.path.join(data_dir, 'vancouver_{}.json'.format(hour))
+            with open(filepath, 'w') as f:
+                cmdline.write_json(normalize.batch_load_data(
+                    'car2go', archive_name, datetime(2016, 2, 9, hour, 0),
+                    datetime(2016, 2, 9, hour, 59), 60), f)
+            filepaths.append(filepath)
+
+        merged_dir = os.path.join(data_dir, 'merged')
+        dataset.write_dataset(merge.merge_all_files(filepaths), merged_dir)
+
+        streamed_dir = os.path.join(data_dir, 'streamed')
+        dataset.write_dataset_from_files(filepaths, streamed_dir, chunk_size=4)
+
+        self.assertEqual(sorted(os.listdir(streamed_dir)), sorted(os.listdir(merged_dir)))
+        for name in os.listdir(merged_dir):
+            self.assertTrue(np.array_equal(np.load(os.path.join(streamed_dir, name)),
+                                           np.load(os.path.join(merged_dir, name))), name)
+
+        self.assertEqual(json_round_trip(dataset.Dataset(streamed_dir).to_dict()),
+                         json_round_trip(merge.merge_all_files(filepaths)))
+
+        shutil.rmtree(data_dir)
+
+
 class HelperFunctionsTest(unittest.TestCase):
     def test_is_latlng_in_bounds(self):
         VALUES = {
@@ -867,6 +1706,334 @@ class HelperFunctionsTest(unittest.TestCase):
         self.assertGreaterEqual(wien_res, 0)
         self.assertLessEqual(wien_res, CITIES['wien']['MAP_SIZES']['MAP_X'])
 
+
+class PrefetchTest(unittest.TestCase):
+    def test_order_and_exceptions(self):
+        # order is preserved whatever the depth
+        for depth in (1, 3, 100):
+            self.assertEqual(list(normalize.prefetch(iter(range(50)), depth)),
+                             list(range(50)))
+
+        def failing_iterator():
+            yield 1
+            raise KeyError('test')
+
+        # exceptions are raised in the consumer
+        with self.assertRaises(KeyError):
+            list(normalize.prefetch(failing_iterator(), 2))
+
+
+class RangesTest(unittest.TestCase):
+    def test_missing_ranges(self):
+        def t(minute):
+            return datetime(2016, 2, 9, 0, minute)
+
+        missing = []
+        for minute in (1, 2, 3, 7, 9, 10):
+            ranges.add(missing, t(minute), 60)
+        self.assertEqual(missing, [[t(1), t(3)], [t(7), t(7)], [t(9), t(10)]])
+        self.assertEqual(ranges.count(missing, 60), 6)
+
+        self.assertTrue(ranges.contains(missing, t(2)))
+        self.assertTrue(ranges.contains(missing, t(10)))
+        self.assertFalse(ranges.contains(missing, t(0)))
+        self.assertFalse(ranges.contains(missing, t(8)))
+        self.assertFalse(ranges.contains(missing, t(11)))
+
+        self.assertEqual(ranges.clip(missing, t(2), t(10), 60),
+                         [[t(2), t(3)], [t(7), t(7)], [t(9), t(9)]])
+        self.assertEqual(ranges.clip(missing, t(4), t(7), 60), [])
+
+        self.assertEqual(ranges.union(missing, [[t(4), t(5)], [t(11), t(11)]], 60),
+                         [[t(1), t(5)], [t(7), t(7)], [t(9), t(11)]])
+
+        # the list of datetimes used before ranges is still read
+        old_format = {'metadata': {'time_step': 60,
+                                   'missing': [t(1).isoformat(), t(2).isoformat(), t(7).isoformat()]}}
+        self.assertEqual(cmdline.decode_result_dict(old_format)['metadata']['missing'],
+                         [[t(1), t(2)], [t(7), t(7)]])
+
+
+class RecordsTest(unittest.TestCase):
+    def test_same_as_dicts(self):
+        parking_dict = {'vin': 'WMEEJ3BA5EK736813', 'lat': 49.2, 'lng': -123.1,
+                        'starting_time': datetime(2016, 2, 9, 0, 1),
+                        'changing_data': [], 'items': 'not a slot', 'odd-key': 1}
+        parking = records.make_parking(parking_dict)
+        self.assertEqual(parking, parking_dict)
+        self.assertEqual(parking['items'], 'not a slot')
+        self.assertEqual(parking.get('ending_time'), None)
+
+        parking['ending_time'] = datetime(2016, 2, 9, 0, 5)
+        self.assertEqual(normalize.calculate_parking(parking)['duration'], 240)
+        self.assertNotIn('ending_time', parking_dict)
+
+        trip = records.make_trip({'vin': 'WMEEJ3BA5EK736813',
+                                  'start': {'lat': 49.2, 'lng': -123.1, 'fuel': 80,
+                                            'time': datetime(2016, 2, 9, 0, 5)},
+                                  'end': {'lat': 49.3, 'lng': -123.1, 'fuel': 70,
+                                          'time': datetime(2016, 2, 9, 0, 20)}})
+        self.assertIsInstance(trip['start'], records.Record)
+        self.assertEqual(normalize.calculate_trip(trip)['fuel_use'], 10)
+
+        # repeated strings are only kept once
+        address = ''.join(['Granville', ' St'])
+        other_parking = records.make_parking(dict(parking_dict, address=address))
+        self.assertIs(other_parking['address'],
+                      records.make_parking(dict(parking_dict, address='Granville St'))['address'])
+
+        # records are written as dicts and read back as records
+        result_dict = {'metadata': {}, 'finished_trips': {trip['vin']: [trip]},
+                       'finished_parkings': {parking['vin']: [parking]}}
+        written = io.StringIO()
+        cmdline.write_json(result_dict, written)
+        loaded = cmdline.decode_result_dict(json.loads(written.getvalue()))
+        self.assertEqual(loaded, result_dict)
+        self.assertIsInstance(loaded['finished_trips'][trip['vin']][0], records.Record)
+
+
+class ProfilingTest(unittest.TestCase):
+    def test_stages(self):
+        profiler = profiling.Profiler()
+        for _ in range(3):
+            profiler.add_data_point()
+            with profiler.stage('parse'):
+                pass
+            with profiler.stage('read'):
+                pass
+
+        summary = profiler.get_summary()
+        self.assertEqual([(stage['name'], stage['calls']) for stage in summary['stages']],
+                         [('read', 3), ('parse', 3)])
+        self.assertEqual(summary['data_points'], 3)
+
+        # exceptions still get timed, and are not swallowed
+        with self.assertRaises(KeyError):
+            with profiler.stage('write'):
+                raise KeyError
+        self.assertEqual(profiler.get_summary()['stages'][-1]['name'], 'write')
+
+        profiler.count('skipped')
+        profiler.count('skipped', 2)
+        self.assertEqual(profiler.get_summary()['counts'], {'skipped': 3})
+
+        output = io.StringIO()
+        profiler.print_summary(output)
+        self.assertIn('3 data points', output.getvalue())
+        self.assertIn('skipped: 3', output.getvalue())
+
+        # NullProfiler takes counts too, but doesn't keep them
+        profiling.NULL_PROFILER.count('skipped')
+
+
+class SyntheticTest(unittest.TestCase):
+    def test_archive(self):
+        archive_dir = tempfile.mkdtemp()
+        archive_names = [os.path.join(archive_dir, 'vancouver_2016-02-09.tgz'),
+                         os.path.join(archive_dir, 'vancouver_copy.tgz')]
+
+        for archive_name in archive_names:
+            synthetic.write_archive(archive_name, 'car2go', 'vancouver',
+                                    duration=timedelta(hours=1), fleet_size=50,
+                                    trip_rate=24, missing_rate=0.1, seed=1)
+
+        # the same parameters give the same archive
+        with open(archive_names[0], 'rb') as first, open(archive_names[1], 'rb') as second:
+            self.assertEqual(first.read(), second.read())
+
+        result = normalize.batch_load_data('car2go', archive_names[0], None, None, 60)
+        self.assertEqual(len(result['vehicles']), 50)
+        self.assertGreater(sum(len(trips) for trips in result['finished_trips'].values()), 0)
+        self.assertGreater(ranges.count(result['metadata']['missing'], 60), 0)
+        self.assertEqual(result['metadata']['ending_time'], datetime(2016, 2, 9, 0, 59))
+
+        shutil.rmtree(archive_dir)
+
+
+class StatsFunctionsTest(unittest.TestCase):
+    # unlike StatsTest, works on small made-up data
+    def test_trips_table(self):
+        trips = {
+            'A': [{'duration': 60, 'distance': 0.03, 'fuel_use': 0},
+                  {'duration': 900, 'distance': 2.5, 'fuel_use': -3}],
+            'B': [{'duration': 120, 'distance': 0.005, 'fuel_use': 1},
+                  {'duration': 180, 'distance': 0.005, 'fuel_use': -5}],
+            'C': []
+        }
+
+        trips_table = process_stats.get_trips_table(trips)
+        self.assertEqual(trips_table['vins'], ['A', 'B', 'C'])
+        self.assertEqual(trips_table['vin_index'].tolist(), [0, 0, 1, 1])
+
+        # vectorized criteria are the same as for single trips
+        all_trips = [trip for vin in trips for trip in trips[vin]]
+        self.assertEqual(process_stats.get_weird_trips_mask(trips_table).tolist(),
+                         [process_stats.is_trip_weird(trip) for trip in all_trips])
+
+        data_dict = {
+            'finished_trips': trips,
+            'finished_parkings': {},
+            'unfinished_trips': {},
+            'unfinished_parkings': {'D': {}},
+            'unstarted_trips': {},
+            'metadata': {'starting_time': datetime(2016, 2, 9, 0, 0),
+                         'ending_time': datetime(2016, 2, 9, 23, 59),
+                         'time_step': 60, 'missing': []}
+        }
+        stats = process_stats.stats_dict(data_dict)
+        self.assertEqual(stats['total vehicles'], 4)
+        self.assertEqual(stats['total trips'], 2)
+        self.assertEqual(stats['weird trip count'], 2)
+        # ties are in the order first seen, as with Counter.most_common
+        self.assertEqual(stats['trips per car most common binned values'], [(1, 2), (0, 2)])
+        self.assertEqual(stats['fuel use stats under 1 ratio'], 1.0)
+        self.assertEqual(stats['duration per trip over 120 ratio'], 0.0)
+
+    def test_fuel_use_types(self):
+        # integer fuel uses stay integers, also when some are floats
+        trips = {
+            'A': [{'duration': 900, 'distance': 2.5, 'fuel_use': -3},
+                  {'duration': 900, 'distance': 2.5, 'fuel_use': -3.0},
+                  {'duration': 900, 'distance': 2.5, 'fuel_use': 1.5}],
+            'B': [{'duration': 900, 'distance': 2.5, 'fuel_use': 2.0},
+                  {'duration': 900, 'distance': 2.5, 'fuel_use': 2}]
+        }
+
+        self.assertEqual(process_stats.get_trips_table({'A': trips['A'][:1]})['fuel_use'].dtype.kind, 'i')
+
+        data_dict = {
+            'finished_trips': trips,
+            'finished_parkings': {},
+            'unfinished_trips': {},
+            'unfinished_parkings': {},
+            'unstarted_trips': {},
+            'metadata': {'starting_time': datetime(2016, 2, 9, 0, 0),
+                         'ending_time': datetime(2016, 2, 9, 23, 59),
+                         'time_step': 60, 'missing': []}
+        }
+        stats = process_stats.stats_dict(data_dict)
+        most_common = stats['fuel use stats most common binned values']
+
+        # same as Counter, which keeps the type a value is first seen as
+        self.assertEqual(most_common, [(-3, 2), (2.0, 2), (1.5, 1)])
+        self.assertEqual([type(value) for value, _ in most_common], [int, float, float])
+
+    def test_stats_slice(self):
+        def trip(start, end):
+            return records.make_trip({'vin': 'A', 'duration': (end - start).total_seconds(),
+                                      'start': {'time': start}, 'end': {'time': end}})
+
+        def parking(start, end):
+            return records.make_parking({'vin': 'A', 'duration': (end - start).total_seconds(),
+                                         'starting_time': start, 'ending_time': end})
+
+        day = datetime(2016, 2, 9)
+        data_dict = {
+            'finished_trips': {'A': [trip(day + timedelta(hours=h), day + timedelta(hours=h + 1))
+                                     for h in (1, 11, 23, 40)]},
+            'finished_parkings': {'A': [parking(day + timedelta(hours=2), day + timedelta(hours=11)),
+                                        parking(day + timedelta(hours=12), day + timedelta(hours=23)),
+                                        parking(day + timedelta(hours=24), day + timedelta(hours=40))]},
+            'unfinished_trips': {},
+            'unfinished_parkings': {},
+            'unstarted_trips': {},
+            'metadata': {'starting_time': day, 'ending_time': day + timedelta(hours=47, minutes=59),
+                         'time_step': 60, 'missing': []}
+        }
+
+        from_time = day + timedelta(hours=6)
+        to_time = day + timedelta(hours=23, minutes=30)
+        sliced = process_stats.stats_slice(data_dict, from_time, to_time)
+
+        # only the trips and parkings in the slice, trimmed to it
+        self.assertEqual([(t['start']['time'], t['end']['time']) for t in sliced['finished_trips']['A']],
+                         [(day + timedelta(hours=11), day + timedelta(hours=12)),
+                          (day + timedelta(hours=23), to_time)])
+        self.assertEqual(sliced['finished_trips']['A'][-1]['duration'], 30 * 60)
+        self.assertEqual([(p['starting_time'], p['ending_time']) for p in sliced['finished_parkings']['A']],
+                         [(from_time, day + timedelta(hours=11)),
+                          (day + timedelta(hours=12), day + timedelta(hours=23))])
+
+        # data_dict itself is not changed
+        self.assertEqual(data_dict['finished_trips']['A'][2]['end']['time'], day + timedelta(hours=24))
+        self.assertEqual(data_dict['finished_parkings']['A'][0]['starting_time'], day + timedelta(hours=2))
+
+        # a prebuilt index gives the same slices
+        time_index = process_stats.build_time_index(data_dict)
+        self.assertEqual(process_stats.stats_slice(data_dict, from_time, to_time, time_index),
+                         process_stats.stats_slice(data_dict, from_time, to_time))
+        self.assertEqual(process_stats.stats_slice(data_dict, day + timedelta(hours=30),
+                                                   day + timedelta(hours=35), time_index)['finished_trips'],
+                         {})
+
+    def test_stats_slices_independent(self):
+        # a trip over midnight is trimmed to each day it is in,
+        # and trimming it for one day doesn't change it for the next
+        day = datetime(2016, 2, 9)
+        trip_start = day + timedelta(hours=22)
+        trip_end = day + timedelta(hours=26)
+        data_dict = {
+            'finished_trips': {'A': [records.make_trip({
+                'vin': 'A', 'duration': (trip_end - trip_start).total_seconds(),
+                'start': {'time': trip_start}, 'end': {'time': trip_end}})]},
+            'finished_parkings': {},
+            'unfinished_trips': {},
+            'unfinished_parkings': {},
+            'unstarted_trips': {},
+            'metadata': {'starting_time': day, 'ending_time': day + timedelta(hours=47, minutes=59),
+                         'time_step': 60, 'missing': []}
+        }
+
+        time_index = process_stats.build_time_index(data_dict)
+        days = [process_stats.stats_slice(data_dict, day + timedelta(days=i),
+                                          day + timedelta(days=i, hours=23, minutes=59), time_index)
+                for i in range(2)]
+
+        self.assertEqual([[(t['start']['time'], t['end']['time'], t['duration'])
+                           for t in sliced['finished_trips']['A']]
+                          for sliced in days],
+                         [[(trip_start, day + timedelta(hours=23, minutes=59), 7140.0)],
+                          [(day + timedelta(days=1), trip_end, 7200.0)]])
+
+        trip = data_dict['finished_trips']['A'][0]
+        self.assertEqual((trip['start']['time'], trip['end']['time'], trip['duration']),
+                         (trip_start, trip_end, 14400.0))
+
+        # a slice over both days afterwards is the same as on untouched data
+        both_days = process_stats.stats_slice(data_dict, day + timedelta(hours=1),
+                                              day + timedelta(hours=47), time_index)
+        self.assertEqual(both_days['finished_trips']['A'][0]['end']['time'], trip_end)
+
+
+class DataArchiveTest(unittest.TestCase):
+    def test_directory_manifest(self):
+        parent_dir = tempfile.mkdtemp()
+        data_dir = os.path.join(parent_dir, 'data')
+        os.mkdir(data_dir)
+
+        def add_file(name):
+            with open(os.path.join(data_dir, name), 'w') as f:
+                f.write('{}')
+
+        for name in ('vancouver_2016-02-09--00-00', 'vancouver_2016-02-09--00-02',
+                     'toronto_2016-02-09--00-01', 'current_vancouver'):
+            add_file(name)
+
+        manifest = normalize.get_directory_manifest(data_dir, 'vancouver')
+        self.assertEqual(sorted(manifest), ['vancouver_2016-02-09--00-00',
+                                            'vancouver_2016-02-09--00-02'])
+        self.assertEqual(manifest['vancouver_2016-02-09--00-00'][0], 2)  # size
+
+        # files added later are picked up
+        add_file('vancouver_2016-02-09--00-03')
+        data_archive = normalize.Electric2goDataArchive(
+            'vancouver', os.path.join(data_dir, 'vancouver_2016-02-09--00-00'))
+        self.assertEqual(data_archive.last_file_time, datetime(2016, 2, 9, 0, 3))
+        self.assertEqual(data_archive.load_data_point(datetime(2016, 2, 9, 0, 3)), {})
+        self.assertFalse(data_archive.load_data_point(datetime(2016, 2, 9, 0, 1)))
+
+        shutil.rmtree(parent_dir)
+
  
 if __name__ == '__main__':
     unittest.main(module='tests')  # allow profiling, otherwise no tests are found